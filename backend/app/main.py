@@ -2,6 +2,7 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 import firebase_admin
 from firebase_admin import credentials
+import asyncio
 import os
 from dotenv import load_dotenv
 
@@ -64,8 +65,10 @@ app.add_middleware(
     CORSMiddleware,
     allow_origins=allowed_origins,
     allow_credentials=True,
-    allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+    allow_methods=["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
     allow_headers=["*"],
+    # Read by clients of resumable uploads and proxied downloads
+    expose_headers=["Location", "Upload-Offset", "Upload-Length", "ETag", "Content-Range"],
 )
 
 # Include routers
@@ -73,6 +76,27 @@ from app.routes import files, admin
 app.include_router(files.router, prefix="/api/files", tags=["files"])
 app.include_router(admin.router, prefix="/api/admin", tags=["admin"])
 
+@app.on_event("startup")
+async def startup_event():
+    # Pick up purge jobs left behind by instances that stopped mid-purge
+    from app.services.concurrency import run_blocking
+    try:
+        resumed = await run_blocking(admin.purge_service.sync.resume_stale_jobs)
+        if resumed:
+            print(f"Resumed {resumed} purge jobs")
+    except Exception as e:
+        print(f"Failed to resume purge jobs: {e}")
+    # Remove objects and reservations left by abandoned upload sessions
+    app.state.upload_session_sweeper = asyncio.create_task(files.sweep_upload_sessions_periodically())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    from app.services.concurrency import shutdown_executor
+    app.state.upload_session_sweeper.cancel()
+    files.thumbnail_service.shutdown()
+    admin.event_broker.stop()
+    shutdown_executor()
+
 @app.get("/")
 async def root():
     return {"message": "DataGate API is running"}
@@ -1,19 +1,25 @@
-from fastapi import HTTPException, Depends, Request
+from fastapi import HTTPException, Depends, Request, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import firebase_admin
-from firebase_admin import auth, firestore
+from firebase_admin import auth
 from typing import Optional, Dict, Any
+from datetime import datetime, timedelta
+from app.services.concurrency import run_blocking
+from app.services.cache import TTLCache
+from app.services.firestore import FirestoreService
+import hashlib
 import os
+import secrets
 
 security = HTTPBearer()
 
-def get_firestore_client():
-    """Get Firestore client, initializing if needed"""
-    try:
-        return firestore.client()
-    except Exception as e:
-        print(f"Failed to get Firestore client: {e}")
-        return None
+# Verified ID tokens, keyed by a hash of the token and kept until the token's own expiry
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 10000))
+token_cache = TTLCache(max_size=TOKEN_CACHE_SIZE)
+
+# Stream tickets stand in for the ID token on EventSource URLs, which end up
+# in access logs and browser history; each works once, within this many seconds
+STREAM_TICKET_TTL = int(os.getenv('STREAM_TICKET_TTL', 60))
 
 class AuthUser:
     def __init__(self, uid: str, email: str, user_type: str, file_limit: int = 500, file_count: int = 0, file_size_limit: int = 100 * 1024 * 1024):
@@ -24,43 +30,49 @@ class AuthUser:
         self.file_count = file_count
         self.file_size_limit = file_size_limit  # File size limit in bytes (default 100MB)
 
+def auth_user_from_profile(uid: str, user_data: Dict[str, Any]) -> AuthUser:
+    """Build an AuthUser from a Firestore user profile, with safe defaults"""
+    return AuthUser(
+        uid=uid,
+        email=user_data.get('email', ''),
+        user_type=user_data.get('userType', 'user'),
+        file_limit=user_data.get('fileLimit', 500),
+        file_count=user_data.get('fileCount', 0),
+        # Default file size limit is 100MB (100 * 1024 * 1024 bytes)
+        file_size_limit=user_data.get('fileSizeLimit', 100 * 1024 * 1024)
+    )
+
+async def verify_token(token: str) -> Dict[str, Any]:
+    """
+    Verify a Firebase ID token, reusing the decoded claims of tokens that
+    were already verified and have not expired yet
+    """
+    cache_key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    decoded_token = token_cache.get(cache_key)
+    if decoded_token is None:
+        decoded_token = await run_blocking(auth.verify_id_token, token)
+        token_cache.set(cache_key, decoded_token, expires_at=decoded_token['exp'])
+    return decoded_token
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> AuthUser:
     """
     Verify Firebase ID token and get user information from Firestore
     """
+    return await user_from_token(credentials.credentials)
+
+async def user_from_token(token: str) -> AuthUser:
+    """Verify a Firebase ID token and load the user's profile"""
     try:
         # Verify the Firebase ID token
-        decoded_token = auth.verify_id_token(credentials.credentials)
+        decoded_token = await verify_token(token)
         uid = decoded_token['uid']
         
-        # Get user document from Firestore
-        db = get_firestore_client()
-        if not db:
-            raise HTTPException(status_code=500, detail="Database connection failed")
-        
-        user_doc = db.collection('users').document(uid).get()
-        
-        if not user_doc.exists:
+        # Get user profile (cached briefly, invalidated when admins change it)
+        user_data = await run_blocking(FirestoreService.get_user_profile, uid)
+        if not user_data:
             raise HTTPException(status_code=404, detail="User not found in database")
         
-        user_data = user_doc.to_dict()
-        
-        # Extract user information with safe defaults
-        email = user_data.get('email', '')
-        user_type = user_data.get('userType', 'user')
-        file_limit = user_data.get('fileLimit', 500)
-        file_count = user_data.get('fileCount', 0)
-        # Default file size limit is 100MB (100 * 1024 * 1024 bytes)
-        file_size_limit = user_data.get('fileSizeLimit', 100 * 1024 * 1024)
-        
-        return AuthUser(
-            uid=uid,
-            email=email,
-            user_type=user_type,
-            file_limit=file_limit,
-            file_count=file_count,
-            file_size_limit=file_size_limit
-        )
+        return auth_user_from_profile(uid, user_data)
         
     except Exception as e:
         raise HTTPException(status_code=401, detail=f"Invalid authentication: {str(e)}")
@@ -73,6 +85,33 @@ async def get_admin_user(current_user: AuthUser = Depends(get_current_user)) ->
         raise HTTPException(status_code=403, detail="Admin access required")
     return current_user
 
+def stream_ticket_key(ticket: str) -> str:
+    """Stream tickets are stored under a hash, so stored keys cannot be replayed"""
+    return hashlib.sha256(ticket.encode('utf-8')).hexdigest()
+
+async def create_stream_ticket(current_user: AuthUser) -> str:
+    """Mint a short-lived, single-use ticket for opening an event stream"""
+    ticket = secrets.token_urlsafe(32)
+    expires_at = datetime.utcnow() + timedelta(seconds=STREAM_TICKET_TTL)
+    await run_blocking(FirestoreService.create_stream_ticket, stream_ticket_key(ticket), current_user.uid, expires_at)
+    return ticket
+
+async def get_admin_user_from_ticket(ticket: Optional[str] = Query(None, description="Stream ticket")) -> AuthUser:
+    """
+    Ensure the user a stream ticket was issued to is an admin, using up the
+    ticket. Only for endpoints like EventSource streams, where browsers
+    cannot send an Authorization header.
+    """
+    if not ticket:
+        raise HTTPException(status_code=403, detail="Not authenticated")
+    uid = await run_blocking(FirestoreService.redeem_stream_ticket, stream_ticket_key(ticket))
+    if not uid:
+        raise HTTPException(status_code=401, detail="Invalid or expired stream ticket")
+    user_data = await run_blocking(FirestoreService.get_user_profile, uid)
+    if not user_data:
+        raise HTTPException(status_code=401, detail="User not found in database")
+    return await get_admin_user(auth_user_from_profile(uid, user_data))
+
 async def get_optional_user(request: Request) -> Optional[AuthUser]:
     """
     Get current user if authenticated, otherwise return None
@@ -83,25 +122,13 @@ async def get_optional_user(request: Request) -> Optional[AuthUser]:
             return None
             
         token = auth_header.split(" ")[1]
-        decoded_token = auth.verify_id_token(token)
+        decoded_token = await verify_token(token)
         uid = decoded_token['uid']
         
-        db = get_firestore_client()
-        if not db:
-            return None
-            
-        user_doc = db.collection('users').document(uid).get()
-        if not user_doc.exists:
+        user_data = await run_blocking(FirestoreService.get_user_profile, uid)
+        if not user_data:
             return None
             
-        user_data = user_doc.to_dict()
-        return AuthUser(
-            uid=uid,
-            email=user_data.get('email', ''),
-            user_type=user_data.get('userType', 'user'),
-            file_limit=user_data.get('fileLimit', 500),
-            file_count=user_data.get('fileCount', 0),
-            file_size_limit=user_data.get('fileSizeLimit', 100 * 1024 * 1024)
-        )
+        return auth_user_from_profile(uid, user_data)
     except:
         return None
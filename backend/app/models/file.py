@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import Optional, List
+from pydantic import BaseModel, Field
+from typing import Optional, List, Dict
 from datetime import datetime
 
 class FileUpload(BaseModel):
@@ -15,6 +15,7 @@ class FileResponse(BaseModel):
     content_type: str
     uploaded_at: datetime
     download_url: Optional[str] = None
+    thumbnail_url: Optional[str] = None  # Small JPEG preview, once one has been generated
     user_id: Optional[str] = None  # For admin view to show file owner
 
 class FileUploadResponse(BaseModel):
@@ -30,6 +31,25 @@ class BatchUploadResponse(BaseModel):
     successful_count: int
     failed_count: int
 
+class UploadSessionRequest(BaseModel):
+    file_name: str
+    file_size: int  # Declared size in bytes, checked again on finalize
+    content_type: str
+
+class UploadSessionResponse(BaseModel):
+    session_id: str
+    upload_url: str  # Signed URL the client PUTs the file to
+    upload_method: str = "PUT"
+    upload_headers: dict  # Headers the client must send with the upload
+    expires_at: datetime
+
+class ResumableUploadResponse(BaseModel):
+    session_id: str
+    upload_url: str  # PATCH chunks here, HEAD for the current offset
+    upload_offset: int = 0
+    chunk_size: int  # Send chunks of this size; only the last may be shorter
+    expires_at: datetime
+
 class UserResponse(BaseModel):
     uid: str
     email: str
@@ -49,3 +69,46 @@ class FileListResponse(BaseModel):
     total_count: int
     user_file_limit: int
     user_file_count: int
+    next_cursor: Optional[str] = None  # Pass back as `cursor` to get the next page
+    sync_token: Optional[str] = None  # First page only; pass as `since` to /changes
+
+class AdminFileListResponse(BaseModel):
+    files: List[FileResponse]
+    next_cursor: Optional[str] = None  # Pass back as `cursor` to get the next page
+    sync_token: Optional[str] = None  # First page only; pass as `since` to /changes
+
+class FileChangesResponse(BaseModel):
+    files: List[FileResponse]  # Created since the token; may repeat files already seen
+    deleted: List[str]  # IDs of files deleted since the token
+    sync_token: str  # Pass as `since` next time
+    reset: bool = False  # Too many changes: reload the full list instead
+
+class FileIdsRequest(BaseModel):
+    file_ids: List[str] = Field(..., min_length=1, max_length=500)
+
+class BulkDeleteResponse(BaseModel):
+    deleted: List[str]  # IDs of the files that were deleted
+    errors: Dict[str, str]  # file_id -> reason it was not deleted
+
+class PurgeJobResponse(BaseModel):
+    user_id: str
+    status: str  # running, completed or failed
+    phase: str  # records, objects, user or done
+    files_deleted: int
+    objects_deleted: int
+    bytes_deleted: int
+    started_at: datetime
+    updated_at: datetime
+    finished_at: Optional[datetime] = None
+    error: Optional[str] = None
+
+class StreamTicketResponse(BaseModel):
+    ticket: str  # Passed as ?ticket= to the event stream; works once
+    expires_in: int  # Seconds
+
+class ZipDownloadRequest(BaseModel):
+    file_ids: Optional[List[str]] = Field(None, min_length=1, max_length=500)  # None = the whole library
+
+class DownloadUrlsResponse(BaseModel):
+    download_urls: Dict[str, str]  # file_id -> signed URL
+    errors: Dict[str, str]  # file_id -> reason it was not signed
@@ -1,20 +1,97 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
-from typing import List
-from app.middleware.auth import get_admin_user, AuthUser
-from app.services.firestore import FirestoreService
-from app.services.storage import StorageService
-from app.models.file import UserResponse, FileResponse, UpdateUserRequest
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response, StreamingResponse
+from typing import List, Optional
+from app.middleware.auth import (
+    get_admin_user, get_admin_user_from_ticket, create_stream_ticket, AuthUser, token_cache, STREAM_TICKET_TTL
+)
+from app.services.firestore import (
+    FirestoreService, SyncTokenExpiredError, new_sync_token, profile_cache, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+)
+from app.services.concurrency import AsyncService
+from app.services.storage import StorageService, signed_url_cache
+from app.services.dedup import DedupService
+from app.services.archive import ArchiveService, archive_entries
+from app.services.purge import PurgeService
+from app.services.downloads import DownloadService, listing_etag, listing_cache_headers, etag_matches
+from app.services.events import EventBroker
+from app.models.file import (
+    UserResponse, FileResponse, AdminFileListResponse, UpdateUserRequest,
+    FileIdsRequest, DownloadUrlsResponse, BulkDeleteResponse, PurgeJobResponse, FileChangesResponse,
+    StreamTicketResponse
+)
 from datetime import datetime
+import asyncio
+import json
+import os
 
 router = APIRouter()
-firestore_service = FirestoreService()
-storage_service = StorageService()
+firestore_service = AsyncService(FirestoreService())
+storage_service = AsyncService(StorageService())
+dedup_service = AsyncService(DedupService(storage_service.sync))
+archive_service = ArchiveService(storage_service.sync)
+purge_service = AsyncService(PurgeService(storage_service.sync))
+download_service = AsyncService(DownloadService(storage_service.sync))
+event_broker = EventBroker()
+
+# Seconds between keep-alive comments on an idle event stream
+EVENT_KEEPALIVE_SECONDS = int(os.getenv('EVENT_KEEPALIVE_SECONDS', 15))
+# Event streams are closed after this long so clients reconnect with a fresh
+# ticket, which checks again that they are still an admin
+EVENT_STREAM_MAX_SECONDS = int(os.getenv('EVENT_STREAM_MAX_SECONDS', 50 * 60))
+
+def zip_response(files_data: List[dict], archive_name: str) -> StreamingResponse:
+    """Stream the given files as a ZIP archive download"""
+    return StreamingResponse(
+        archive_service.stream_zip(archive_entries(files_data)),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{archive_name}"'}
+    )
+
+@router.post("/events/ticket", response_model=StreamTicketResponse)
+async def get_event_stream_ticket(current_user: AuthUser = Depends(get_admin_user)):
+    """Get a single-use ticket for opening the event stream (admin only)"""
+    try:
+        ticket = await create_stream_ticket(current_user)
+        return StreamTicketResponse(ticket=ticket, expires_in=STREAM_TICKET_TTL)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to create stream ticket: {str(e)}")
+
+@router.get("/events")
+async def stream_events(current_user: AuthUser = Depends(get_admin_user_from_ticket)):
+    """
+    Push file-created, file-deleted, user-updated and user-deleted events as
+    server-sent events (admin only). A reset event means events were
+    dropped and the lists should be reloaded.
+    """
+    async def event_stream():
+        queue = await event_broker.subscribe()
+        try:
+            # Browsers wait this long before reconnecting a dropped stream
+            yield "retry: 3000\n\n"
+            deadline = asyncio.get_running_loop().time() + EVENT_STREAM_MAX_SECONDS
+            while asyncio.get_running_loop().time() < deadline:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=EVENT_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    # A comment line keeps proxies from closing an idle connection
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(jsonable_encoder(event['data']))}\n\n"
+        finally:
+            await event_broker.unsubscribe(queue)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @router.get("/users", response_model=List[UserResponse])
 async def get_all_users(current_user: AuthUser = Depends(get_admin_user)):
     """Get all users (admin only)"""
     try:
-        users_data = firestore_service.get_all_users()
+        users_data = await firestore_service.get_all_users()
         
         users = []
         for user_data in users_data:
@@ -33,49 +110,171 @@ async def get_all_users(current_user: AuthUser = Depends(get_admin_user)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get users: {str(e)}")
 
-@router.get("/files", response_model=List[FileResponse])
-async def get_all_files(current_user: AuthUser = Depends(get_admin_user)):
-    """Get all files across all users (admin only)"""
+@router.get("/files", response_model=AdminFileListResponse)
+async def get_all_files(
+    request: Request,
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Page size"),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    include_download_urls: bool = Query(True, description="Sign a download URL for every file"),
+    current_user: AuthUser = Depends(get_admin_user)
+):
+    """Get one page of files across all users, newest first (admin only)"""
     try:
-        files_data = firestore_service.get_all_files()
+        # One aggregation over the stats shards tells whether any file changed
+        etag = listing_etag(
+            await firestore_service.get_global_change_version(),
+            limit, cursor, include_download_urls
+        )
+        if etag_matches(request.headers.get('if-none-match'), etag):
+            return Response(status_code=304, headers=listing_cache_headers(etag))
+        response.headers.update(listing_cache_headers(etag))
+        
+        # Issued before reading the page, so a delta sync from it misses nothing
+        sync_token = None if cursor else new_sync_token()
+        try:
+            files_data, next_cursor = await firestore_service.get_files_page(None, limit, cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        # Sign every file's URL in one call; repeat views hit the signed URL cache.
+        # Clients that sign on demand via /download-urls can skip this entirely.
+        download_urls = {}
+        if include_download_urls:
+            download_urls = await storage_service.generate_signed_urls(
+                [file_data['gcs_path'] for file_data in files_data]
+            )
+        # Previews are a few KB each, so they are always signed
+        thumbnail_urls = await storage_service.generate_signed_urls(
+            [file_data['thumbnail_path'] for file_data in files_data if file_data.get('thumbnail_path')]
+        )
         
         files = []
         for file_data in files_data:
-            # Generate signed URL for each file
-            try:
-                download_url = storage_service.generate_signed_url(file_data['gcs_path'])
-            except:
-                download_url = None
-            
             files.append(FileResponse(
                 id=file_data['id'],
                 file_name=file_data['file_name'],
                 file_size=file_data['file_size'],
                 content_type=file_data['content_type'],
                 uploaded_at=file_data['uploaded_at'],
-                download_url=download_url,
+                download_url=download_urls.get(file_data['gcs_path']),
+                thumbnail_url=thumbnail_urls.get(file_data.get('thumbnail_path')),
                 user_id=file_data.get('user_id')  # Include user_id for admin view
             ))
         
-        return files
+        return AdminFileListResponse(files=files, next_cursor=next_cursor, sync_token=sync_token)
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get files: {str(e)}")
 
+@router.get("/files/changes", response_model=FileChangesResponse)
+async def get_file_changes(
+    since: str = Query(..., description="sync_token from a listing or a previous call"),
+    include_download_urls: bool = Query(True, description="Sign a download URL for every new file"),
+    current_user: AuthUser = Depends(get_admin_user)
+):
+    """Get files created and deleted across all users since a sync token (admin only)"""
+    try:
+        try:
+            changes = await firestore_service.get_changes(None, since)
+        except SyncTokenExpiredError as e:
+            raise HTTPException(status_code=410, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        files_data = changes['files']
+        download_urls = {}
+        if include_download_urls:
+            download_urls = await storage_service.generate_signed_urls(
+                [file_data['gcs_path'] for file_data in files_data]
+            )
+        thumbnail_urls = await storage_service.generate_signed_urls(
+            [file_data['thumbnail_path'] for file_data in files_data if file_data.get('thumbnail_path')]
+        )
+        
+        files = []
+        for file_data in files_data:
+            files.append(FileResponse(
+                id=file_data['id'],
+                file_name=file_data['file_name'],
+                file_size=file_data['file_size'],
+                content_type=file_data['content_type'],
+                uploaded_at=file_data['uploaded_at'],
+                download_url=download_urls.get(file_data['gcs_path']),
+                thumbnail_url=thumbnail_urls.get(file_data.get('thumbnail_path')),
+                user_id=file_data.get('user_id')  # Include user_id for admin view
+            ))
+        
+        return FileChangesResponse(
+            files=files,
+            deleted=changes['deleted'],
+            sync_token=changes['sync_token'],
+            reset=changes['reset']
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get file changes: {str(e)}")
+
+@router.post("/files/download-urls", response_model=DownloadUrlsResponse)
+async def get_download_urls_admin(request: FileIdsRequest, current_user: AuthUser = Depends(get_admin_user)):
+    """Get signed download URLs for a page of any users' files (admin only)"""
+    try:
+        file_ids = list(dict.fromkeys(request.file_ids))
+        files_data = await firestore_service.get_files_by_ids(file_ids)
+        
+        errors = {file_id: "File not found" for file_id in file_ids if file_id not in files_data}
+        signed_urls = await storage_service.generate_signed_urls(
+            [file_data['gcs_path'] for file_data in files_data.values()]
+        )
+        
+        download_urls = {}
+        for file_id, file_data in files_data.items():
+            if signed_urls.get(file_data['gcs_path']):
+                download_urls[file_id] = signed_urls[file_data['gcs_path']]
+            else:
+                errors[file_id] = "Failed to generate download URL"
+        
+        return DownloadUrlsResponse(download_urls=download_urls, errors=errors)
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to generate download URLs: {str(e)}")
+
+@router.post("/files/download-zip")
+async def download_files_zip(request: FileIdsRequest, current_user: AuthUser = Depends(get_admin_user)):
+    """Download any files as one streamed ZIP archive (admin only)"""
+    try:
+        file_ids = list(dict.fromkeys(request.file_ids))
+        found = await firestore_service.get_files_by_ids(file_ids)
+        missing = [file_id for file_id in file_ids if file_id not in found]
+        if missing:
+            raise HTTPException(status_code=404, detail=f"File not found: {missing[0]}")
+        
+        files_data = [found[file_id] for file_id in file_ids]
+        return zip_response(files_data, f"files-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.zip")
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to create archive: {str(e)}")
+
 @router.get("/files/{file_id}/download")
 async def get_download_url_admin(file_id: str, current_user: AuthUser = Depends(get_admin_user)):
     """Get signed download URL for any file (admin only)"""
     try:
         # Get file record
-        file_data = firestore_service.get_file_by_id(file_id)
+        file_data = await firestore_service.get_file_by_id(file_id)
         if not file_data:
             raise HTTPException(status_code=404, detail="File not found")
         
         # Generate signed URL (admins can download any file)
-        download_url = storage_service.generate_signed_url(file_data['gcs_path'])
+        download_url = await storage_service.generate_signed_url(file_data['gcs_path'])
         
         # Update the file record with the new download URL
-        firestore_service.update_file_download_url(file_id, download_url)
+        await firestore_service.update_file_download_url(file_id, download_url)
         
         return {"download_url": download_url}
         
@@ -84,23 +283,37 @@ async def get_download_url_admin(file_id: str, current_user: AuthUser = Depends(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to generate download URL: {str(e)}")
 
+@router.api_route("/files/{file_id}/content", methods=["GET", "HEAD"])
+async def download_file_content_admin(file_id: str, request: Request, current_user: AuthUser = Depends(get_admin_user)):
+    """Stream any file through the backend, with Range and conditional request support (admin only)"""
+    try:
+        file_data = await firestore_service.get_file_by_id(file_id)
+        if not file_data:
+            raise HTTPException(status_code=404, detail="File not found")
+        
+        return await download_service.response(file_data, request.headers, include_body=request.method != "HEAD")
+        
+    except HTTPException:
+        raise
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to download file: {str(e)}")
+
 @router.delete("/files/{file_id}")
 async def delete_any_file(file_id: str, current_user: AuthUser = Depends(get_admin_user)):
     """Delete any file (admin only)"""
     try:
         # Get file record
-        file_data = firestore_service.get_file_by_id(file_id)
+        file_data = await firestore_service.get_file_by_id(file_id)
         if not file_data:
             raise HTTPException(status_code=404, detail="File not found")
         
-        # Delete from GCS
-        storage_service.delete_file(file_data['gcs_path'])
-        
-        # Delete from Firestore
-        firestore_service.delete_file_record(file_id)
+        # Delete the record and update the owner's file count and the system stats in one commit
+        await firestore_service.commit_file_changes(deleted=[file_data])
         
-        # Update the file owner's file count
-        firestore_service.update_user_file_count(file_data['user_id'], -1)
+        # Delete from GCS, or drop the reference to shared content
+        await dedup_service.release_content(file_data)
         
         return {"message": "File deleted successfully"}
         
@@ -109,6 +322,28 @@ async def delete_any_file(file_id: str, current_user: AuthUser = Depends(get_adm
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete file: {str(e)}")
 
+@router.post("/files/bulk-delete", response_model=BulkDeleteResponse)
+async def bulk_delete_any_files(request: FileIdsRequest, current_user: AuthUser = Depends(get_admin_user)):
+    """Delete many files of any users at once (admin only)"""
+    try:
+        file_ids = list(dict.fromkeys(request.file_ids))
+        found = await firestore_service.get_files_by_ids(file_ids)
+        
+        errors = {file_id: "File not found" for file_id in file_ids if file_id not in found}
+        files_data = [found[file_id] for file_id in file_ids if file_id in found]
+        
+        if files_data:
+            # One aggregated count change per affected owner
+            await firestore_service.commit_file_changes(deleted=files_data)
+            failed_paths = await dedup_service.release_contents(files_data)
+            if failed_paths:
+                print(f"Failed to delete {len(failed_paths)} objects from storage: {failed_paths}")
+        
+        return BulkDeleteResponse(deleted=[file_data['id'] for file_data in files_data], errors=errors)
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to delete files: {str(e)}")
+
 @router.put("/users/{user_id}/file-limit")
 async def update_user_file_limit(
     user_id: str, 
@@ -120,7 +355,7 @@ async def update_user_file_limit(
         if new_limit < 0:
             raise HTTPException(status_code=400, detail="File limit must be non-negative")
         
-        success = firestore_service.update_user_file_limit(user_id, new_limit)
+        success = await firestore_service.update_user_file_limit(user_id, new_limit)
         if not success:
             raise HTTPException(status_code=500, detail="Failed to update file limit")
         
@@ -145,7 +380,7 @@ async def update_user_file_size_limit(
         # Convert MB to bytes
         new_size_limit_bytes = new_size_limit_mb * 1024 * 1024
         
-        success = firestore_service.update_user_file_size_limit(user_id, new_size_limit_bytes)
+        success = await firestore_service.update_user_file_size_limit(user_id, new_size_limit_bytes)
         if not success:
             raise HTTPException(status_code=500, detail="Failed to update file size limit")
         
@@ -171,7 +406,7 @@ async def update_user_type(
         if user_id == current_user.uid and user_type == 'user':
             raise HTTPException(status_code=400, detail="You cannot demote yourself")
         
-        success = firestore_service.update_user_type(user_id, user_type)
+        success = await firestore_service.update_user_type(user_id, user_type)
         if not success:
             raise HTTPException(status_code=500, detail="Failed to update user type")
         
@@ -182,57 +417,171 @@ async def update_user_type(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to update user type: {str(e)}")
 
-@router.get("/users/{user_id}/files", response_model=List[FileResponse])
-async def get_user_files(user_id: str, current_user: AuthUser = Depends(get_admin_user)):
-    """Get files for a specific user (admin only)"""
+@router.get("/users/{user_id}/files", response_model=AdminFileListResponse)
+async def get_user_files(
+    user_id: str,
+    request: Request,
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Page size"),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    include_download_urls: bool = Query(True, description="Sign a download URL for every file"),
+    current_user: AuthUser = Depends(get_admin_user)
+):
+    """Get one page of a specific user's files, newest first (admin only)"""
     try:
-        files_data = firestore_service.get_user_files(user_id)
+        etag = listing_etag(
+            await firestore_service.get_change_version(user_id),
+            user_id, limit, cursor, include_download_urls
+        )
+        if etag_matches(request.headers.get('if-none-match'), etag):
+            return Response(status_code=304, headers=listing_cache_headers(etag))
+        response.headers.update(listing_cache_headers(etag))
+        
+        # Issued before reading the page, so a delta sync from it misses nothing
+        sync_token = None if cursor else new_sync_token()
+        try:
+            files_data, next_cursor = await firestore_service.get_files_page(user_id, limit, cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        # Sign every file's URL in one call; repeat views hit the signed URL cache.
+        # Clients that sign on demand via /download-urls can skip this entirely.
+        download_urls = {}
+        if include_download_urls:
+            download_urls = await storage_service.generate_signed_urls(
+                [file_data['gcs_path'] for file_data in files_data]
+            )
+        # Previews are a few KB each, so they are always signed
+        thumbnail_urls = await storage_service.generate_signed_urls(
+            [file_data['thumbnail_path'] for file_data in files_data if file_data.get('thumbnail_path')]
+        )
         
         files = []
         for file_data in files_data:
-            # Generate signed URL for each file
-            try:
-                download_url = storage_service.generate_signed_url(file_data['gcs_path'])
-            except:
-                download_url = None
-            
             files.append(FileResponse(
                 id=file_data['id'],
                 file_name=file_data['file_name'],
                 file_size=file_data['file_size'],
                 content_type=file_data['content_type'],
                 uploaded_at=file_data['uploaded_at'],
-                download_url=download_url,
+                download_url=download_urls.get(file_data['gcs_path']),
+                thumbnail_url=thumbnail_urls.get(file_data.get('thumbnail_path')),
                 user_id=file_data.get('user_id')  # Include user_id for admin view
             ))
         
-        return files
+        return AdminFileListResponse(files=files, next_cursor=next_cursor, sync_token=sync_token)
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get user files: {str(e)}")
 
+@router.post("/users/{user_id}/files/download-zip")
+async def download_user_files_zip(user_id: str, current_user: AuthUser = Depends(get_admin_user)):
+    """Download a user's whole library as one streamed ZIP archive (admin only)"""
+    try:
+        files_data = await firestore_service.get_user_files(user_id)
+        return zip_response(files_data, f"{user_id}-files-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.zip")
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to create archive: {str(e)}")
+
+@router.post("/users/{user_id}/purge", response_model=PurgeJobResponse, status_code=202)
+async def purge_user(user_id: str, current_user: AuthUser = Depends(get_admin_user)):
+    """Start deleting a user and all of their files in the background (admin only)"""
+    try:
+        if user_id == current_user.uid:
+            raise HTTPException(status_code=400, detail="You cannot purge your own account")
+        
+        try:
+            job = await purge_service.start(user_id, current_user.uid)
+        except LookupError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        return PurgeJobResponse(**job)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to start purge: {str(e)}")
+
+@router.get("/users/{user_id}/purge", response_model=PurgeJobResponse)
+async def get_purge_status(user_id: str, current_user: AuthUser = Depends(get_admin_user)):
+    """Get the progress of a user's purge job (admin only)"""
+    try:
+        job = await purge_service.get_job(user_id)
+        if not job:
+            raise HTTPException(status_code=404, detail="No purge job for this user")
+        return PurgeJobResponse(**job)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get purge status: {str(e)}")
+
 @router.get("/stats")
 async def get_admin_stats(current_user: AuthUser = Depends(get_admin_user)):
-    """Get admin dashboard statistics"""
+    """Get admin dashboard statistics from the materialized stats counters"""
     try:
-        users_data = firestore_service.get_all_users()
-        files_data = firestore_service.get_all_files()
-        
-        total_users = len(users_data)
-        total_files = len(files_data)
-        total_storage = sum(file.get('file_size', 0) for file in files_data)
+        stats, total_users = await asyncio.gather(
+            firestore_service.get_system_stats(),
+            firestore_service.count_users()
+        )
+        if stats is None:
+            # First request on a fresh project: build the counters once
+            stats = await firestore_service.rebuild_system_stats()
         
-        admin_users = len([u for u in users_data if u.get('userType') == 'admin'])
-        regular_users = total_users - admin_users
+        total_storage = stats['total_storage_bytes']
+        admin_users = stats['admin_users']
         
         return {
             "total_users": total_users,
             "admin_users": admin_users,
-            "regular_users": regular_users,
-            "total_files": total_files,
+            "regular_users": total_users - admin_users,
+            "total_files": stats['total_files'],
             "total_storage_bytes": total_storage,
             "total_storage_mb": round(total_storage / (1024 * 1024), 2)
         }
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get stats: {str(e)}")
+
+@router.post("/stats/rebuild")
+async def rebuild_admin_stats(current_user: AuthUser = Depends(get_admin_user)):
+    """Recompute the materialized statistics from the users and files collections (admin only)"""
+    try:
+        stats = await firestore_service.rebuild_system_stats()
+        return {"message": "Statistics rebuilt", "stats": stats}
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to rebuild stats: {str(e)}")
+
+@router.get("/stats/dedup")
+async def get_dedup_stats(current_user: AuthUser = Depends(get_admin_user)):
+    """Get logical vs physical bucket usage for content-addressed storage (admin only)"""
+    try:
+        stats = await firestore_service.get_system_stats()
+        if stats is None:
+            stats = await firestore_service.rebuild_system_stats()
+        return await dedup_service.get_stats(stats['total_storage_bytes'])
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get dedup stats: {str(e)}")
+
+@router.post("/reconcile")
+async def reconcile_file_counts(current_user: AuthUser = Depends(get_admin_user)):
+    """Recompute every user's file count and byte total with aggregation queries (admin only)"""
+    try:
+        report = await firestore_service.reconcile_all_users()
+        return {"message": "File counts reconciled", **report}
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to reconcile file counts: {str(e)}")
+
+@router.get("/cache-stats")
+async def get_cache_stats(current_user: AuthUser = Depends(get_admin_user)):
+    """Get hit/miss counters for this instance's in-process caches (admin only)"""
+    return {
+        "token_cache": token_cache.stats(),
+        "profile_cache": profile_cache.stats(),
+        "signed_url_cache": signed_url_cache.stats()
+    }
@@ -1,18 +1,57 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Query, Request
+from fastapi.responses import Response, StreamingResponse
+from typing import Any, Dict, List, Optional
 from app.middleware.auth import get_current_user, AuthUser
-from app.services.storage import StorageService
-from app.services.firestore import FirestoreService
-from app.models.file import FileResponse, FileUploadResponse, BatchUploadResponse, FileListResponse
-from datetime import datetime
+from app.services.storage import (
+    StorageService, FileTooLargeError, UPLOAD_CHUNK_SIZE, RESUMABLE_ALIGNMENT, RESUMABLE_CHUNK_SIZE
+)
+from app.services.firestore import (
+    FirestoreService, SyncTokenExpiredError, UploadSessionClaimedError, UploadSessionExpiredError,
+    upload_session_claimed, new_sync_token, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, UPLOAD_SESSION_CLAIM_TTL
+)
+from app.services.concurrency import AsyncService, MemoryBudget
+from app.services.quota import QuotaService, QuotaExceededError
+from app.services.dedup import DedupService, DEDUP_STORAGE
+from app.services.archive import ArchiveService, archive_entries
+from app.services.thumbnails import ThumbnailService
+from app.services.sniffing import content_matches_extension, SNIFF_BYTES
+from app.services.downloads import DownloadService, listing_etag, listing_cache_headers, etag_matches
+from app.models.file import (
+    FileResponse, FileUploadResponse, BatchUploadResponse, FileListResponse,
+    UploadSessionRequest, UploadSessionResponse, FileIdsRequest, DownloadUrlsResponse,
+    ZipDownloadRequest, BulkDeleteResponse, FileChangesResponse, ResumableUploadResponse
+)
+from datetime import datetime, timedelta
+import asyncio
 import os
 
 router = APIRouter()
-storage_service = StorageService()
-firestore_service = FirestoreService()
+storage_service = AsyncService(StorageService())
+firestore_service = AsyncService(FirestoreService())
+quota_service = AsyncService(QuotaService())
+dedup_service = AsyncService(DedupService(storage_service.sync))
+# Not wrapped in AsyncService: StreamingResponse iterates the archive in a threadpool itself
+archive_service = ArchiveService(storage_service.sync)
+# Only queues work for its own pools, so it is called directly from handlers
+thumbnail_service = ThumbnailService(storage_service.sync)
+download_service = AsyncService(DownloadService(storage_service.sync))
 
 # Configuration constants
 MAX_FILE_SIZE = 100 * 1024 * 1024  # 100MB
+# How long a signed direct-to-GCS upload URL stays valid
+UPLOAD_SESSION_EXPIRATION_MINUTES = int(os.getenv('UPLOAD_SESSION_EXPIRATION_MINUTES', 60))
+# How long a resumable upload can be continued; GCS keeps sessions for a week
+RESUMABLE_UPLOAD_EXPIRATION_HOURS = int(os.getenv('RESUMABLE_UPLOAD_EXPIRATION_HOURS', 24))
+# Expired upload sessions are swept this often (seconds): their objects,
+# GCS resumable sessions and quota reservations are removed. Sessions also
+# carry expires_at for a Firestore TTL policy, as a backstop.
+UPLOAD_SESSION_SWEEP_INTERVAL = int(os.getenv('UPLOAD_SESSION_SWEEP_INTERVAL', 60 * 60))
+# Most expired sessions removed by one sweep
+UPLOAD_SESSION_SWEEP_LIMIT = int(os.getenv('UPLOAD_SESSION_SWEEP_LIMIT', 500))
+# Maximum number of files from one batch that are uploaded at the same time
+BATCH_UPLOAD_CONCURRENCY = int(os.getenv('BATCH_UPLOAD_CONCURRENCY', 8))
+# Upper bound on bytes buffered by all in-flight uploads in this process
+UPLOAD_MEMORY_BUDGET = int(os.getenv('UPLOAD_MEMORY_BUDGET', 256 * 1024 * 1024))
 ALLOWED_EXTENSIONS = {
     '.txt', '.pdf', '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx',
     '.jpg', '.jpeg', '.png', '.gif', '.bmp', '.svg', '.webp',
@@ -21,39 +60,71 @@ ALLOWED_EXTENSIONS = {
     '.zip', '.rar', '.7z', '.tar', '.gz',
     '.json', '.xml', '.csv', '.sql', '.py', '.js', '.html', '.css'
 }
+ALLOWED_EXTENSIONS_TEXT = ', '.join(sorted(ALLOWED_EXTENSIONS))
+# A tuple lets str.startswith check every prefix in one call
+ALLOWED_MIME_PREFIXES = (
+    'text/', 'image/', 'video/', 'audio/', 'application/pdf',
+    'application/msword', 'application/vnd.openxmlformats-officedocument',
+    'application/vnd.ms-excel', 'application/vnd.ms-powerpoint',
+    'application/zip', 'application/x-rar-compressed', 'application/x-7z-compressed'
+)
 
-def validate_file(file: UploadFile, max_size: int = None) -> None:
-    """Validate uploaded file"""
+upload_memory_budget = MemoryBudget(UPLOAD_MEMORY_BUDGET)
+
+def upload_buffer_size(file: UploadFile) -> int:
+    """Bytes a streamed upload can hold in memory: one read chunk plus one pending GCS chunk"""
+    if file.size is not None:
+        return 2 * min(file.size, UPLOAD_CHUNK_SIZE)
+    return 2 * UPLOAD_CHUNK_SIZE
+
+async def validate_file(file: UploadFile, max_size: int = None) -> None:
+    """Validate uploaded file, including its first bytes, before anything is stored"""
+    validate_file_metadata(
+        file_name=file.filename,
+        content_type=file.content_type,
+        file_size=getattr(file, 'size', None),
+        max_size=max_size
+    )
+    
+    # Sniff the real type from the start of the upload and rewind for the upload
+    # itself; the spooled file may be on disk, so it is read off the event loop
+    head = await file.read(SNIFF_BYTES)
+    await file.seek(0)
+    validate_file_content(file.filename, head)
+
+def validate_file_content(file_name: Optional[str], head: bytes) -> None:
+    """Reject a file whose leading bytes do not match its extension"""
+    if file_name and not content_matches_extension(os.path.splitext(file_name)[1], head):
+        raise HTTPException(
+            status_code=400,
+            detail="File content does not match its extension"
+        )
+
+def validate_file_metadata(file_name: Optional[str], content_type: Optional[str],
+                           file_size: Optional[int], max_size: int = None) -> None:
+    """Validate a file's name, MIME type and size before any bytes are stored"""
     # Use provided max_size or default to global MAX_FILE_SIZE
     size_limit = max_size if max_size is not None else MAX_FILE_SIZE
     
     # Check file size
-    if hasattr(file, 'size') and file.size and file.size > size_limit:
+    if file_size and file_size > size_limit:
         raise HTTPException(
             status_code=413, 
             detail=f"File too large. Maximum size is {size_limit // (1024*1024)}MB"
         )
     
     # Check file extension
-    if file.filename:
-        file_ext = os.path.splitext(file.filename.lower())[1]
+    if file_name:
+        file_ext = os.path.splitext(file_name.lower())[1]
         if file_ext not in ALLOWED_EXTENSIONS:
             raise HTTPException(
                 status_code=400,
-                detail=f"File type not allowed. Allowed extensions: {', '.join(sorted(ALLOWED_EXTENSIONS))}"
+                detail=f"File type not allowed. Allowed extensions: {ALLOWED_EXTENSIONS_TEXT}"
             )
     
     # Check MIME type
-    if file.content_type:
-        # Basic MIME type validation
-        allowed_mime_types = {
-            'text/', 'image/', 'video/', 'audio/', 'application/pdf',
-            'application/msword', 'application/vnd.openxmlformats-officedocument',
-            'application/vnd.ms-excel', 'application/vnd.ms-powerpoint',
-            'application/zip', 'application/x-rar-compressed', 'application/x-7z-compressed'
-        }
-        
-        if not any(file.content_type.startswith(mime) for mime in allowed_mime_types):
+    if content_type:
+        if not content_type.startswith(ALLOWED_MIME_PREFIXES):
             raise HTTPException(
                 status_code=400,
                 detail="Invalid file type. Please upload a valid file."
@@ -67,48 +138,57 @@ async def upload_file(
     """Upload a single file"""
     try:
         # Validate file with user's specific file size limit
-        validate_file(file, max_size=current_user.file_size_limit)
-        
-        # Check file limit
-        if current_user.file_count >= current_user.file_limit:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"File limit reached ({current_user.file_count}/{current_user.file_limit}). Contact admin to increase limit."
-            )
+        await validate_file(file, max_size=current_user.file_size_limit)
         
-        # Read file content
-        file_content = await file.read()
-        file_size = len(file_content)
-        
-        # Additional size check after reading using user's limit
-        if file_size > current_user.file_size_limit:
-            raise HTTPException(
-                status_code=413, 
-                detail=f"File too large. Maximum size is {current_user.file_size_limit // (1024*1024)}MB"
-            )
+        # Reserve a slot atomically so parallel uploads cannot overshoot the file limit
+        try:
+            reservation_id = await quota_service.reserve(current_user.uid, 1, file.size or 0)
+        except QuotaExceededError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
-        # Upload to GCS
-        gcs_path = storage_service.upload_file(
-            file_content=file_content,
-            file_name=file.filename,
-            content_type=file.content_type,
-            user_id=current_user.uid
-        )
-        
-        # Create file record in Firestore
-        file_data = {
-            'user_id': current_user.uid,
-            'file_name': file.filename,
-            'file_size': file_size,
-            'content_type': file.content_type,
-            'gcs_path': gcs_path,
-            'uploaded_at': datetime.utcnow()
-        }
-        
-        file_id = firestore_service.create_file_record(file_data)
+        try:
+            # Stream to GCS, enforcing the user's size limit as bytes arrive
+            try:
+                async with upload_memory_budget.reserve(upload_buffer_size(file)):
+                    upload = await storage_service.upload_stream(
+                        file_obj=file.file,
+                        file_name=file.filename,
+                        content_type=file.content_type,
+                        user_id=current_user.uid,
+                        max_size=current_user.file_size_limit,
+                        sha256=DEDUP_STORAGE
+                    )
+            except FileTooLargeError as e:
+                raise HTTPException(status_code=413, detail=str(e))
+            file_size = upload['size']
+            
+            # Create file record in Firestore
+            file_data = {
+                'user_id': current_user.uid,
+                'file_name': file.filename,
+                'file_size': file_size,
+                'content_type': file.content_type,
+                **await dedup_service.store_upload(upload),
+                'md5_hash': upload['md5_hash'],
+                'crc32c': upload['crc32c'],
+                'uploaded_at': datetime.utcnow()
+            }
+            
+            # Write the record, the file count and the system stats and consume
+            # the reservation in one commit
+            try:
+                file_id, = await firestore_service.commit_file_changes(
+                    created=[file_data],
+                    reservation=(current_user.uid, reservation_id)
+                )
+            except Exception:
+                await dedup_service.release_content(file_data)
+                raise
+        except BaseException:
+            await quota_service.release(current_user.uid, reservation_id)
+            raise
         
-        # Update user's file count
-        firestore_service.update_user_file_count(current_user.uid, 1)
+        thumbnail_service.schedule(file_id, file_data)
         
         return FileUploadResponse(
             file_id=file_id,
@@ -117,9 +197,46 @@ async def upload_file(
             message="File uploaded successfully"
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
+async def _upload_batch_file(file: UploadFile, current_user: AuthUser, semaphore: asyncio.Semaphore) -> Dict[str, Any]:
+    """Validate and upload a single file from a batch; returns its file record data"""
+    async with semaphore:
+        # Validate file with user's specific file size limit
+        await validate_file(file, max_size=current_user.file_size_limit)
+        
+        # Stream to GCS, enforcing the user's size limit as bytes arrive
+        try:
+            async with upload_memory_budget.reserve(upload_buffer_size(file)):
+                upload = await storage_service.upload_stream(
+                    file_obj=file.file,
+                    file_name=file.filename,
+                    content_type=file.content_type,
+                    user_id=current_user.uid,
+                    max_size=current_user.file_size_limit,
+                    sha256=DEDUP_STORAGE
+                )
+        except FileTooLargeError:
+            raise HTTPException(
+                status_code=413,
+                detail=f"File {file.filename} too large. Maximum size is {current_user.file_size_limit // (1024*1024)}MB"
+            )
+        
+        # Records are written together once every file in the batch is done
+        return {
+            'user_id': current_user.uid,
+            'file_name': file.filename,
+            'file_size': upload['size'],
+            'content_type': file.content_type,
+            **await dedup_service.store_upload(upload),
+            'md5_hash': upload['md5_hash'],
+            'crc32c': upload['crc32c'],
+            'uploaded_at': datetime.utcnow()
+        }
+
 @router.post("/upload-batch", response_model=BatchUploadResponse)
 async def upload_batch_files(
     files: List[UploadFile] = File(...),
@@ -127,68 +244,72 @@ async def upload_batch_files(
 ):
     """Upload multiple files at once"""
     try:
-        # Check if adding these files would exceed limit
-        if current_user.file_count + len(files) > current_user.file_limit:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Uploading {len(files)} files would exceed limit. Current: {current_user.file_count}/{current_user.file_limit}"
+        # Reserve slots for the whole batch atomically so parallel uploads cannot
+        # overshoot the file limit; unused slots are given back at commit
+        try:
+            reservation_id = await quota_service.reserve(
+                current_user.uid, len(files), sum(file.size or 0 for file in files)
+            )
+        except QuotaExceededError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        try:
+            # Process files concurrently; gather keeps results in request order
+            semaphore = asyncio.Semaphore(BATCH_UPLOAD_CONCURRENCY)
+            results = await asyncio.gather(
+                *(_upload_batch_file(file, current_user, semaphore) for file in files),
+                return_exceptions=True
             )
+        except BaseException:
+            await quota_service.release(current_user.uid, reservation_id)
+            raise
         
-        successful_uploads = []
         failed_uploads = []
+        uploaded_records = []
+        for file, result in zip(files, results):
+            if isinstance(result, BaseException):
+                failed_uploads.append({
+                    'file_name': file.filename,
+                    'error': str(result)
+                })
+            else:
+                uploaded_records.append(result)
         
-        for file in files:
+        # Write every record, the file count and the system stats and consume
+        # the reservation in batched commits
+        file_ids = []
+        if uploaded_records:
             try:
-                # Validate file with user's specific file size limit
-                validate_file(file, max_size=current_user.file_size_limit)
-                
-                # Read file content
-                file_content = await file.read()
-                file_size = len(file_content)
-                
-                # Additional size check after reading using user's limit
-                if file_size > current_user.file_size_limit:
-                    raise HTTPException(
-                        status_code=413,
-                        detail=f"File {file.filename} too large. Maximum size is {current_user.file_size_limit // (1024*1024)}MB"
-                    )
-                
-                # Upload to GCS
-                gcs_path = storage_service.upload_file(
-                    file_content=file_content,
-                    file_name=file.filename,
-                    content_type=file.content_type,
-                    user_id=current_user.uid
+                file_ids = await firestore_service.commit_file_changes(
+                    created=uploaded_records,
+                    reservation=(current_user.uid, reservation_id)
                 )
-                
-                # Create file record
-                file_data = {
-                    'user_id': current_user.uid,
-                    'file_name': file.filename,
-                    'file_size': file_size,
-                    'content_type': file.content_type,
-                    'gcs_path': gcs_path,
-                    'uploaded_at': datetime.utcnow()
-                }
-                
-                file_id = firestore_service.create_file_record(file_data)
-                
-                successful_uploads.append(FileUploadResponse(
-                    file_id=file_id,
-                    file_name=file.filename,
-                    file_size=file_size,
-                    message="Uploaded successfully"
-                ))
-                
             except Exception as e:
-                failed_uploads.append({
-                    'file_name': file.filename,
-                    'error': str(e)
-                })
+                # Without records the uploaded objects are unreachable, so remove them
+                await asyncio.gather(*(
+                    dedup_service.release_content(record) for record in uploaded_records
+                ))
+                failed_uploads.extend(
+                    {'file_name': record['file_name'], 'error': f"Failed to save file record: {str(e)}"}
+                    for record in uploaded_records
+                )
+        
+        for file_id, record in zip(file_ids, uploaded_records):
+            thumbnail_service.schedule(file_id, record)
         
-        # Update user's file count with successful uploads
-        if successful_uploads:
-            firestore_service.update_user_file_count(current_user.uid, len(successful_uploads))
+        if not file_ids:
+            # Nothing was recorded, so give every reserved slot back
+            await quota_service.release(current_user.uid, reservation_id)
+        
+        successful_uploads = [
+            FileUploadResponse(
+                file_id=file_id,
+                file_name=record['file_name'],
+                file_size=record['file_size'],
+                message="Uploaded successfully"
+            )
+            for file_id, record in zip(file_ids, uploaded_records)
+        ]
         
         return BatchUploadResponse(
             successful_uploads=successful_uploads,
@@ -198,48 +319,602 @@ async def upload_batch_files(
             failed_count=len(failed_uploads)
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Batch upload failed: {str(e)}")
 
+@router.post("/upload-sessions", response_model=UploadSessionResponse)
+async def create_upload_session(
+    request: UploadSessionRequest,
+    current_user: AuthUser = Depends(get_current_user)
+):
+    """
+    Start a direct-to-GCS upload. The client PUTs the file to the returned
+    signed URL and then calls the finalize endpoint, so file bytes never
+    pass through the backend.
+    """
+    try:
+        validate_file_metadata(
+            file_name=request.file_name,
+            content_type=request.content_type,
+            file_size=request.file_size,
+            max_size=current_user.file_size_limit
+        )
+        
+        # Hold a slot until the session is finalized or expires
+        try:
+            reservation_id = await quota_service.reserve(
+                current_user.uid, 1, request.file_size,
+                ttl=UPLOAD_SESSION_EXPIRATION_MINUTES * 60
+            )
+        except QuotaExceededError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        gcs_path = storage_service.sync.generate_object_path(request.file_name, current_user.uid)
+        upload_url = await storage_service.generate_signed_upload_url(
+            gcs_path,
+            content_type=request.content_type,
+            expiration_minutes=UPLOAD_SESSION_EXPIRATION_MINUTES
+        )
+        
+        expires_at = datetime.utcnow() + timedelta(minutes=UPLOAD_SESSION_EXPIRATION_MINUTES)
+        session_id = await firestore_service.create_upload_session({
+            'user_id': current_user.uid,
+            'file_name': request.file_name,
+            'file_size': request.file_size,
+            'content_type': request.content_type,
+            'gcs_path': gcs_path,
+            'reservation_id': reservation_id,
+            'created_at': datetime.utcnow(),
+            'expires_at': expires_at
+        })
+        
+        return UploadSessionResponse(
+            session_id=session_id,
+            upload_url=upload_url,
+            upload_headers={'Content-Type': request.content_type},
+            expires_at=expires_at
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to create upload session: {str(e)}")
+
+async def claim_upload_session(session_id: str, current_user: AuthUser, status: str = 'finalizing') -> Dict[str, Any]:
+    """Take an upload session for this request alone, to finalize, cancel or write to it"""
+    try:
+        return await firestore_service.claim_upload_session(session_id, current_user.uid, status)
+    except LookupError:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    except PermissionError:
+        raise HTTPException(status_code=403, detail="You can only access your own uploads")
+    except UploadSessionExpiredError:
+        raise HTTPException(status_code=410, detail="Upload session has expired")
+    except UploadSessionClaimedError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@router.post("/upload-sessions/{session_id}/finalize", response_model=FileUploadResponse)
+async def finalize_upload_session(session_id: str, current_user: AuthUser = Depends(get_current_user)):
+    """Check the object uploaded for a session and create its file record"""
+    try:
+        # Only one finalize at a time gets the session, so retries and
+        # concurrent calls cannot create a second record
+        session = await claim_upload_session(session_id, current_user)
+        
+        rejected = False
+        try:
+            # Trust what GCS stored, not what the client declared
+            file_info = await storage_service.get_file_info(session['gcs_path'])
+            if not file_info:
+                raise HTTPException(status_code=400, detail="File has not been uploaded yet")
+            
+            try:
+                validate_file_metadata(
+                    file_name=session['file_name'],
+                    content_type=file_info['content_type'],
+                    file_size=file_info['size'],
+                    max_size=current_user.file_size_limit
+                )
+                if file_info['content_type'] != session['content_type']:
+                    raise HTTPException(status_code=400, detail="Uploaded content type does not match the upload session")
+                # Only the first few KB are fetched, with a ranged read
+                head = await storage_service.read_head(session['gcs_path'], SNIFF_BYTES) if file_info['size'] else b''
+                validate_file_content(session['file_name'], head)
+            except HTTPException:
+                rejected = True
+                await storage_service.delete_file(session['gcs_path'])
+                await quota_service.release(current_user.uid, session.get('reservation_id'))
+                await firestore_service.delete_upload_session(session_id)
+                raise
+            
+            # Create file record in Firestore
+            file_data = {
+                'user_id': current_user.uid,
+                'file_name': session['file_name'],
+                'file_size': file_info['size'],
+                'content_type': file_info['content_type'],
+                'gcs_path': session['gcs_path'],
+                'md5_hash': file_info['md5_hash'],
+                'crc32c': file_info['crc32c'],
+                'uploaded_at': datetime.utcnow()
+            }
+            
+            # Write the record, the file count and the system stats, consume
+            # the session's reservation and delete the session in one commit
+            file_id, = await firestore_service.commit_file_changes(
+                created=[file_data],
+                reservation=(current_user.uid, session.get('reservation_id')),
+                upload_session_id=session_id
+            )
+        except BaseException:
+            # Let the client retry unless the upload was rejected and cleaned up
+            if not rejected:
+                await firestore_service.release_upload_session_claim(session_id)
+            raise
+        
+        thumbnail_service.schedule(file_id, file_data)
+        
+        return FileUploadResponse(
+            file_id=file_id,
+            file_name=session['file_name'],
+            file_size=file_info['size'],
+            message="File uploaded successfully"
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to finalize upload: {str(e)}")
+
+@router.post("/resumable-uploads", response_model=ResumableUploadResponse, status_code=201)
+async def create_resumable_upload(
+    request: UploadSessionRequest,
+    response: Response,
+    current_user: AuthUser = Depends(get_current_user)
+):
+    """
+    Start a resumable upload (tus-style): PATCH the file in chunks at
+    Upload-Offset, HEAD to get the offset after an interruption, then
+    finalize. Each chunk is forwarded to a GCS resumable session.
+    """
+    try:
+        validate_file_metadata(
+            file_name=request.file_name,
+            content_type=request.content_type,
+            file_size=request.file_size,
+            max_size=current_user.file_size_limit
+        )
+        if request.file_size <= 0:
+            raise HTTPException(status_code=400, detail="Empty files are uploaded with /upload")
+        
+        # Hold a slot until the upload is finalized or expires
+        try:
+            reservation_id = await quota_service.reserve(
+                current_user.uid, 1, request.file_size,
+                ttl=RESUMABLE_UPLOAD_EXPIRATION_HOURS * 3600
+            )
+        except QuotaExceededError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        gcs_path = storage_service.sync.generate_object_path(request.file_name, current_user.uid)
+        try:
+            resumable_uri = await storage_service.create_resumable_session(
+                gcs_path, request.content_type, request.file_size
+            )
+        except Exception:
+            await quota_service.release(current_user.uid, reservation_id)
+            raise
+        
+        # Resumable uploads are upload sessions that carry a GCS session URI,
+        # so finalizing works exactly as for direct uploads
+        expires_at = datetime.utcnow() + timedelta(hours=RESUMABLE_UPLOAD_EXPIRATION_HOURS)
+        session_id = await firestore_service.create_upload_session({
+            'user_id': current_user.uid,
+            'file_name': request.file_name,
+            'file_size': request.file_size,
+            'content_type': request.content_type,
+            'gcs_path': gcs_path,
+            'resumable_uri': resumable_uri,
+            'reservation_id': reservation_id,
+            'created_at': datetime.utcnow(),
+            'expires_at': expires_at
+        })
+        
+        upload_url = f"/api/files/resumable-uploads/{session_id}"
+        response.headers['Location'] = upload_url
+        return ResumableUploadResponse(
+            session_id=session_id,
+            upload_url=upload_url,
+            chunk_size=RESUMABLE_CHUNK_SIZE,
+            expires_at=expires_at
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to create resumable upload: {str(e)}")
+
+async def get_resumable_session(session_id: str, current_user: AuthUser, allow_claimed: bool = False) -> Dict[str, Any]:
+    """
+    Load a resumable upload session that belongs to the current user. Unless
+    allow_claimed, a session busy with a finalize or a chunk upload gets 409.
+    """
+    session = await firestore_service.get_upload_session(session_id)
+    if not session or not session.get('resumable_uri'):
+        raise HTTPException(status_code=404, detail="Resumable upload not found")
+    if session['user_id'] != current_user.uid:
+        raise HTTPException(status_code=403, detail="You can only access your own uploads")
+    if session['expires_at'].replace(tzinfo=None) < datetime.utcnow():
+        raise HTTPException(status_code=410, detail="Resumable upload has expired")
+    if not allow_claimed and upload_session_claimed(session):
+        raise HTTPException(status_code=409, detail=f"Resumable upload is already {session.get('status', 'finalizing')}")
+    return session
+
+@router.head("/resumable-uploads/{session_id}")
+async def get_resumable_upload_offset(session_id: str, current_user: AuthUser = Depends(get_current_user)):
+    """Report how many bytes of a resumable upload are stored, in Upload-Offset"""
+    try:
+        # Read-only, so it also answers while a chunk is being written
+        session = await get_resumable_session(session_id, current_user, allow_claimed=True)
+        offset = await storage_service.resumable_offset(session['resumable_uri'], session['file_size'])
+        return Response(status_code=200, headers={
+            'Upload-Offset': str(offset),
+            'Upload-Length': str(session['file_size']),
+            'Cache-Control': 'no-store'
+        })
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get upload offset: {str(e)}")
+
+@router.patch("/resumable-uploads/{session_id}", status_code=204)
+async def patch_resumable_upload(session_id: str, request: Request, current_user: AuthUser = Depends(get_current_user)):
+    """
+    Append the request body to a resumable upload at Upload-Offset. The body
+    is forwarded in RESUMABLE_CHUNK_SIZE pieces as it arrives; a tail that
+    is not on a 256KB boundary (unless it ends the file) is not stored, and
+    the returned Upload-Offset tells the client where to continue.
+    """
+    try:
+        session = await get_resumable_session(session_id, current_user)
+        if request.headers.get('content-type') != 'application/offset+octet-stream':
+            raise HTTPException(status_code=415, detail="Content-Type must be application/offset+octet-stream")
+        try:
+            offset = int(request.headers['upload-offset'])
+        except (KeyError, ValueError):
+            raise HTTPException(status_code=400, detail="Upload-Offset header is required")
+        
+        # Only one PATCH at a time may check the offset and write, and none
+        # while a finalize or cancel holds the session
+        session = await claim_upload_session(session_id, current_user, status='uploading')
+        try:
+            resumable_uri = session['resumable_uri']
+            size = session['file_size']
+            stored = await storage_service.resumable_offset(resumable_uri, size)
+            if offset != stored:
+                raise HTTPException(
+                    status_code=409,
+                    detail="Upload-Offset does not match the stored offset",
+                    headers={'Upload-Offset': str(stored)}
+                )
+            
+            buffer = bytearray()
+            claimed_at = asyncio.get_running_loop().time()
+            
+            async def send(length: int) -> None:
+                nonlocal offset, claimed_at
+                # GCS may persist less than it was sent; the rest stays buffered
+                persisted = await storage_service.write_resumable_chunk(resumable_uri, offset, bytes(buffer[:length]), size)
+                if persisted <= offset:
+                    raise Exception("GCS did not accept any bytes")
+                del buffer[:persisted - offset]
+                offset = persisted
+                # A long upload keeps its claim from going stale
+                if asyncio.get_running_loop().time() - claimed_at > UPLOAD_SESSION_CLAIM_TTL / 2:
+                    await firestore_service.refresh_upload_session_claim(session_id)
+                    claimed_at = asyncio.get_running_loop().time()
+            
+            async with upload_memory_budget.reserve(2 * RESUMABLE_CHUNK_SIZE):
+                async for data in request.stream():
+                    if offset + len(buffer) + len(data) > size:
+                        raise HTTPException(status_code=400, detail="Upload exceeds the declared file size")
+                    buffer += data
+                    while len(buffer) >= RESUMABLE_CHUNK_SIZE:
+                        await send(RESUMABLE_CHUNK_SIZE)
+                while buffer:
+                    if offset + len(buffer) == size:
+                        await send(len(buffer))
+                    elif len(buffer) >= RESUMABLE_ALIGNMENT:
+                        await send(len(buffer) - len(buffer) % RESUMABLE_ALIGNMENT)
+                    else:
+                        break
+        finally:
+            await firestore_service.release_upload_session_claim(session_id)
+        
+        return Response(status_code=204, headers={'Upload-Offset': str(offset)})
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to upload chunk: {str(e)}")
+
+@router.post("/resumable-uploads/{session_id}/finalize", response_model=FileUploadResponse)
+async def finalize_resumable_upload(session_id: str, current_user: AuthUser = Depends(get_current_user)):
+    """Create the file record once every byte of a resumable upload is stored"""
+    await get_resumable_session(session_id, current_user)
+    return await finalize_upload_session(session_id, current_user)
+
+@router.delete("/resumable-uploads/{session_id}", status_code=204)
+async def cancel_resumable_upload(session_id: str, current_user: AuthUser = Depends(get_current_user)):
+    """Abandon a resumable upload and give back its quota"""
+    try:
+        await get_resumable_session(session_id, current_user)
+        # Claimed like a finalize, so the two cannot both go ahead
+        session = await claim_upload_session(session_id, current_user)
+        try:
+            await storage_service.cancel_resumable_session(session['resumable_uri'])
+        except Exception as e:
+            print(f"Error cancelling resumable session: {e}")
+        await quota_service.release(current_user.uid, session.get('reservation_id'))
+        await firestore_service.delete_upload_session(session_id)
+        return Response(status_code=204)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to cancel upload: {str(e)}")
+
+async def sweep_expired_upload_sessions() -> int:
+    """Clean up after upload sessions that expired without being finalized; returns how many"""
+    swept = 0
+    for session in await firestore_service.get_expired_upload_sessions(UPLOAD_SESSION_SWEEP_LIMIT):
+        # Expired sessions cannot be claimed, but a finalize may have claimed
+        # one just before it expired
+        if upload_session_claimed(session):
+            continue
+        if session.get('resumable_uri'):
+            try:
+                await storage_service.cancel_resumable_session(session['resumable_uri'])
+            except Exception as e:
+                print(f"Error cancelling resumable session: {e}")
+        # No record points at the object: finalizing deletes the session
+        await storage_service.delete_file(session['gcs_path'])
+        await quota_service.release(session['user_id'], session.get('reservation_id'))
+        await firestore_service.delete_upload_session(session['id'])
+        swept += 1
+    return swept
+
+async def sweep_upload_sessions_periodically() -> None:
+    """Run sweep_expired_upload_sessions every UPLOAD_SESSION_SWEEP_INTERVAL seconds"""
+    while True:
+        try:
+            swept = await sweep_expired_upload_sessions()
+            if swept:
+                print(f"Swept {swept} expired upload sessions")
+        except Exception as e:
+            print(f"Error sweeping upload sessions: {e}")
+        await asyncio.sleep(UPLOAD_SESSION_SWEEP_INTERVAL)
+
 @router.get("/my-files", response_model=FileListResponse)
-async def get_my_files(current_user: AuthUser = Depends(get_current_user)):
-    """Get current user's files"""
+async def get_my_files(
+    request: Request,
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Page size"),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    include_download_urls: bool = Query(True, description="Sign a download URL for every file"),
+    current_user: AuthUser = Depends(get_current_user)
+):
+    """Get one page of the current user's files, newest first"""
     try:
-        files_data = firestore_service.get_user_files(current_user.uid)
+        # A single document read tells whether the page can have changed
+        etag = listing_etag(
+            await firestore_service.get_change_version(current_user.uid),
+            current_user.uid, limit, cursor, include_download_urls,
+            current_user.file_count, current_user.file_limit
+        )
+        if etag_matches(request.headers.get('if-none-match'), etag):
+            return Response(status_code=304, headers=listing_cache_headers(etag))
+        response.headers.update(listing_cache_headers(etag))
+        
+        # Issued before reading the page, so a delta sync from it misses nothing
+        sync_token = None if cursor else new_sync_token()
+        try:
+            files_data, next_cursor = await firestore_service.get_files_page(current_user.uid, limit, cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        # Sign every file's URL in one call; repeat views hit the signed URL cache.
+        # Clients that sign on demand via /download-urls can skip this entirely.
+        download_urls = {}
+        if include_download_urls:
+            download_urls = await storage_service.generate_signed_urls(
+                [file_data['gcs_path'] for file_data in files_data]
+            )
+        # Previews are a few KB each, so they are always signed
+        thumbnail_urls = await storage_service.generate_signed_urls(
+            [file_data['thumbnail_path'] for file_data in files_data if file_data.get('thumbnail_path')]
+        )
         
         files = []
         for file_data in files_data:
-            # Generate signed URL for each file
-            try:
-                download_url = storage_service.generate_signed_url(file_data['gcs_path'])
-            except:
-                download_url = None
-            
             files.append(FileResponse(
                 id=file_data['id'],
                 file_name=file_data['file_name'],
                 file_size=file_data['file_size'],
                 content_type=file_data['content_type'],
                 uploaded_at=file_data['uploaded_at'],
-                download_url=download_url
+                download_url=download_urls.get(file_data['gcs_path']),
+                thumbnail_url=thumbnail_urls.get(file_data.get('thumbnail_path'))
             ))
         
         return FileListResponse(
             files=files,
-            total_count=len(files),
+            total_count=current_user.file_count,
             user_file_limit=current_user.file_limit,
-            user_file_count=len(files)  # Use actual file count from database
+            user_file_count=current_user.file_count,
+            next_cursor=next_cursor,
+            sync_token=sync_token
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get files: {str(e)}")
 
+@router.get("/changes", response_model=FileChangesResponse)
+async def get_my_file_changes(
+    since: str = Query(..., description="sync_token from a listing or a previous call"),
+    include_download_urls: bool = Query(True, description="Sign a download URL for every new file"),
+    current_user: AuthUser = Depends(get_current_user)
+):
+    """Get the current user's files created and deleted since a sync token"""
+    try:
+        try:
+            changes = await firestore_service.get_changes(current_user.uid, since)
+        except SyncTokenExpiredError as e:
+            raise HTTPException(status_code=410, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        files_data = changes['files']
+        download_urls = {}
+        if include_download_urls:
+            download_urls = await storage_service.generate_signed_urls(
+                [file_data['gcs_path'] for file_data in files_data]
+            )
+        thumbnail_urls = await storage_service.generate_signed_urls(
+            [file_data['thumbnail_path'] for file_data in files_data if file_data.get('thumbnail_path')]
+        )
+        
+        files = []
+        for file_data in files_data:
+            files.append(FileResponse(
+                id=file_data['id'],
+                file_name=file_data['file_name'],
+                file_size=file_data['file_size'],
+                content_type=file_data['content_type'],
+                uploaded_at=file_data['uploaded_at'],
+                download_url=download_urls.get(file_data['gcs_path']),
+                thumbnail_url=thumbnail_urls.get(file_data.get('thumbnail_path'))
+            ))
+        
+        return FileChangesResponse(
+            files=files,
+            deleted=changes['deleted'],
+            sync_token=changes['sync_token'],
+            reset=changes['reset']
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get file changes: {str(e)}")
+
+@router.post("/download-urls", response_model=DownloadUrlsResponse)
+async def get_download_urls(request: FileIdsRequest, current_user: AuthUser = Depends(get_current_user)):
+    """Get signed download URLs for a page of the current user's files"""
+    try:
+        file_ids = list(dict.fromkeys(request.file_ids))
+        files_data = await firestore_service.get_files_by_ids(file_ids)
+        
+        errors = {}
+        gcs_paths = {}
+        for file_id in file_ids:
+            file_data = files_data.get(file_id)
+            if not file_data:
+                errors[file_id] = "File not found"
+            elif file_data['user_id'] != current_user.uid:
+                errors[file_id] = "You can only download your own files"
+            else:
+                gcs_paths[file_id] = file_data['gcs_path']
+        
+        signed_urls = await storage_service.generate_signed_urls(list(gcs_paths.values()))
+        
+        download_urls = {}
+        for file_id, gcs_path in gcs_paths.items():
+            if signed_urls.get(gcs_path):
+                download_urls[file_id] = signed_urls[gcs_path]
+            else:
+                errors[file_id] = "Failed to generate download URL"
+        
+        return DownloadUrlsResponse(download_urls=download_urls, errors=errors)
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to generate download URLs: {str(e)}")
+
+@router.post("/download-zip")
+async def download_zip(request: Optional[ZipDownloadRequest] = None, current_user: AuthUser = Depends(get_current_user)):
+    """
+    Download several of the current user's files, or all of them (no body,
+    or no file_ids), as one streamed ZIP archive
+    """
+    try:
+        if request is None or request.file_ids is None:
+            files_data = await firestore_service.get_user_files(current_user.uid)
+        else:
+            file_ids = list(dict.fromkeys(request.file_ids))
+            found = await firestore_service.get_files_by_ids(file_ids)
+            files_data = []
+            for file_id in file_ids:
+                file_data = found.get(file_id)
+                if not file_data:
+                    raise HTTPException(status_code=404, detail=f"File not found: {file_id}")
+                if file_data['user_id'] != current_user.uid:
+                    raise HTTPException(status_code=403, detail="You can only download your own files")
+                files_data.append(file_data)
+        
+        archive_name = f"files-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.zip"
+        return StreamingResponse(
+            archive_service.stream_zip(archive_entries(files_data)),
+            media_type="application/zip",
+            headers={"Content-Disposition": f'attachment; filename="{archive_name}"'}
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to create archive: {str(e)}")
+
+@router.post("/bulk-delete", response_model=BulkDeleteResponse)
+async def bulk_delete_files(request: FileIdsRequest, current_user: AuthUser = Depends(get_current_user)):
+    """Delete many of the current user's files at once"""
+    try:
+        file_ids = list(dict.fromkeys(request.file_ids))
+        found = await firestore_service.get_files_by_ids(file_ids)
+        
+        errors = {}
+        files_data = []
+        for file_id in file_ids:
+            file_data = found.get(file_id)
+            if not file_data:
+                errors[file_id] = "File not found"
+            elif file_data['user_id'] != current_user.uid:
+                errors[file_id] = "You can only delete your own files"
+            else:
+                files_data.append(file_data)
+        
+        if files_data:
+            # Records, the file count and the system stats go in batched commits,
+            # then the objects are removed with GCS batch requests
+            await firestore_service.commit_file_changes(deleted=files_data)
+            failed_paths = await dedup_service.release_contents(files_data)
+            if failed_paths:
+                print(f"Failed to delete {len(failed_paths)} objects from storage: {failed_paths}")
+        
+        return BulkDeleteResponse(deleted=[file_data['id'] for file_data in files_data], errors=errors)
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to delete files: {str(e)}")
+
 @router.delete("/{file_id}")
 async def delete_file(file_id: str, current_user: AuthUser = Depends(get_current_user)):
     """Delete a file (user can only delete their own files)"""
     try:
         # Get file record
-        file_data = firestore_service.get_file_by_id(file_id)
+        file_data = await firestore_service.get_file_by_id(file_id)
         if not file_data:
             raise HTTPException(status_code=404, detail="File not found")
         
@@ -247,14 +922,11 @@ async def delete_file(file_id: str, current_user: AuthUser = Depends(get_current
         if file_data['user_id'] != current_user.uid:
             raise HTTPException(status_code=403, detail="You can only delete your own files")
         
-        # Delete from GCS
-        storage_service.delete_file(file_data['gcs_path'])
+        # Delete the record and update the file count and system stats in one commit
+        await firestore_service.commit_file_changes(deleted=[file_data])
         
-        # Delete from Firestore
-        firestore_service.delete_file_record(file_id)
-        
-        # Update user's file count
-        firestore_service.update_user_file_count(current_user.uid, -1)
+        # Delete from GCS, or drop the reference to shared content
+        await dedup_service.release_content(file_data)
         
         return {"message": "File deleted successfully"}
         
@@ -268,7 +940,7 @@ async def get_download_url(file_id: str, current_user: AuthUser = Depends(get_cu
     """Get signed download URL for a file"""
     try:
         # Get file record
-        file_data = firestore_service.get_file_by_id(file_id)
+        file_data = await firestore_service.get_file_by_id(file_id)
         if not file_data:
             raise HTTPException(status_code=404, detail="File not found")
         
@@ -277,10 +949,10 @@ async def get_download_url(file_id: str, current_user: AuthUser = Depends(get_cu
             raise HTTPException(status_code=403, detail="You can only download your own files")
         
         # Generate signed URL
-        download_url = storage_service.generate_signed_url(file_data['gcs_path'])
+        download_url = await storage_service.generate_signed_url(file_data['gcs_path'])
         
         # Update the file record with the new download URL
-        firestore_service.update_file_download_url(file_id, download_url)
+        await firestore_service.update_file_download_url(file_id, download_url)
         
         return {"download_url": download_url}
         
@@ -288,3 +960,24 @@ async def get_download_url(file_id: str, current_user: AuthUser = Depends(get_cu
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to generate download URL: {str(e)}")
+
+@router.api_route("/{file_id}/content", methods=["GET", "HEAD"])
+async def download_file_content(file_id: str, request: Request, current_user: AuthUser = Depends(get_current_user)):
+    """Stream a file through the backend, with Range and conditional request support"""
+    try:
+        file_data = await firestore_service.get_file_by_id(file_id)
+        if not file_data:
+            raise HTTPException(status_code=404, detail="File not found")
+        
+        # Check if user owns this file
+        if file_data['user_id'] != current_user.uid:
+            raise HTTPException(status_code=403, detail="You can only download your own files")
+        
+        return await download_service.response(file_data, request.headers, include_body=request.method != "HEAD")
+        
+    except HTTPException:
+        raise
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to download file: {str(e)}")
@@ -0,0 +1,144 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from typing import Any, Dict, Iterator, List
+from datetime import datetime
+from app.services.storage import StorageService
+import io
+import os
+import queue
+import threading
+import zipfile
+
+# Files read ahead of the one currently being written to the archive
+ZIP_PREFETCH_FILES = int(os.getenv('ZIP_PREFETCH_FILES', 4))
+# Size of each ranged read from GCS, and how many read chunks a file may
+# have queued. Memory per archive stays under roughly
+# ZIP_PREFETCH_FILES * (ZIP_PREFETCH_CHUNKS + 2) * ZIP_READ_CHUNK_SIZE.
+ZIP_READ_CHUNK_SIZE = int(os.getenv('ZIP_READ_CHUNK_SIZE', 4 * 1024 * 1024))
+ZIP_PREFETCH_CHUNKS = int(os.getenv('ZIP_PREFETCH_CHUNKS', 2))
+
+# Marks the end of a file in its prefetch queue
+_END_OF_FILE = object()
+
+class _ArchiveSink(io.RawIOBase):
+    """
+    Unseekable output for ZipFile. ZipFile then writes sizes and CRCs in
+    data descriptors after each entry instead of seeking back, so the
+    archive can be sent as it is produced.
+    """
+    
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+    
+    def writable(self) -> bool:
+        return True
+    
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+    
+    def drain(self) -> bytes:
+        """Take everything written since the last drain"""
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def archive_entries(files_data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Turn file records into archive entries with unique names, in the given order"""
+    used_names = set()
+    entries = []
+    for file_data in files_data:
+        name = os.path.basename(file_data['file_name'].replace('\\', '/')) or file_data['id']
+        stem, extension = os.path.splitext(name)
+        copy = 1
+        while name.lower() in used_names:
+            name = f"{stem} ({copy}){extension}"
+            copy += 1
+        used_names.add(name.lower())
+        entries.append({
+            'name': name,
+            'gcs_path': file_data['gcs_path'],
+            'size': file_data.get('file_size', 0),
+            'modified': file_data.get('uploaded_at') or datetime.utcnow()
+        })
+    return entries
+
+class ArchiveService:
+    """Builds ZIP archives of stored files on the fly"""
+    
+    def __init__(self, storage: StorageService):
+        self.storage = storage
+    
+    def stream_zip(self, entries: List[Dict[str, Any]]) -> Iterator[bytes]:
+        """
+        Yield a ZIP archive of the given entries (see archive_entries) piece by
+        piece. Entries are stored uncompressed; the next ZIP_PREFETCH_FILES
+        files are read from GCS in background threads into bounded queues
+        while the current one is written, so neither a whole file nor the
+        whole archive is ever held in memory.
+        """
+        cancelled = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=max(1, ZIP_PREFETCH_FILES))
+        remaining = iter(entries)
+        prefetching = deque()
+        
+        def prefetch_more():
+            while len(prefetching) < max(1, ZIP_PREFETCH_FILES):
+                entry = next(remaining, None)
+                if entry is None:
+                    return
+                chunks = queue.Queue(maxsize=ZIP_PREFETCH_CHUNKS)
+                executor.submit(self._prefetch, entry['gcs_path'], chunks, cancelled)
+                prefetching.append((entry, chunks))
+        
+        sink = _ArchiveSink()
+        try:
+            with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+                prefetch_more()
+                while prefetching:
+                    entry, chunks = prefetching.popleft()
+                    prefetch_more()
+                    
+                    zip_info = zipfile.ZipInfo(entry['name'], date_time=entry['modified'].timetuple()[:6])
+                    zip_info.compress_type = zipfile.ZIP_STORED
+                    # The expected size lets ZipFile decide up front whether the entry needs ZIP64
+                    zip_info.file_size = entry['size']
+                    with archive.open(zip_info, 'w') as member:
+                        while True:
+                            chunk = chunks.get()
+                            if chunk is _END_OF_FILE:
+                                break
+                            if isinstance(chunk, Exception):
+                                raise chunk
+                            member.write(chunk)
+                            yield sink.drain()
+                    yield sink.drain()
+            # Closing the archive writes the central directory
+            yield sink.drain()
+        finally:
+            # Also runs when the client disconnects and the generator is closed
+            cancelled.set()
+            executor.shutdown(wait=False)
+    
+    def _prefetch(self, gcs_path: str, chunks: queue.Queue, cancelled: threading.Event) -> None:
+        """Read an object into its queue, blocking while the queue is full"""
+        try:
+            for chunk in self.storage.iter_chunks(gcs_path, ZIP_READ_CHUNK_SIZE):
+                if not self._put(chunks, chunk, cancelled):
+                    return
+            self._put(chunks, _END_OF_FILE, cancelled)
+        except Exception as e:
+            print(f"Error reading {gcs_path} for archive: {e}")
+            self._put(chunks, e, cancelled)
+    
+    @staticmethod
+    def _put(chunks: queue.Queue, item: Any, cancelled: threading.Event) -> bool:
+        """Put an item in a bounded queue unless the archive is abandoned first"""
+        while not cancelled.is_set():
+            try:
+                chunks.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, Callable
+import asyncio
+import functools
+import os
+
+# Number of threads used for blocking google-cloud calls. Setting this to 0
+# runs the calls directly on the event loop (the old behaviour), which is
+# useful for comparing latency with and without the pool.
+IO_THREAD_POOL_SIZE = int(os.getenv('IO_THREAD_POOL_SIZE', 32))
+
+_executor = ThreadPoolExecutor(
+    max_workers=IO_THREAD_POOL_SIZE,
+    thread_name_prefix='gcloud-io'
+) if IO_THREAD_POOL_SIZE > 0 else None
+
+async def run_blocking(func: Callable, *args, **kwargs) -> Any:
+    """Run a blocking call on the I/O thread pool without stalling the event loop"""
+    if _executor is None:
+        return func(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+def shutdown_executor() -> None:
+    """Wait for in-flight calls and stop the I/O thread pool"""
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+
+class AsyncService:
+    """
+    Wrap a synchronous service so every method call runs on the I/O thread
+    pool and has to be awaited. The wrapped service is available as `sync`
+    for code that already runs off the event loop.
+    """
+    def __init__(self, service: Any):
+        self.sync = service
+    
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self.sync, name)
+        if not callable(attr):
+            return attr
+        
+        @functools.wraps(attr)
+        async def call_in_pool(*args, **kwargs):
+            return await run_blocking(attr, *args, **kwargs)
+        
+        return call_in_pool
+
+class MemoryBudget:
+    """
+    Process-wide cap on the number of bytes buffered by in-flight work.
+    Callers reserve their buffer size before starting and wait while the
+    budget is exhausted.
+    """
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        self._condition = asyncio.Condition()
+    
+    @asynccontextmanager
+    async def reserve(self, amount: int):
+        # A single reservation may never exceed the whole budget
+        amount = min(amount, self.limit)
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_use + amount <= self.limit)
+            self.in_use += amount
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.in_use -= amount
+                self._condition.notify_all()
@@ -0,0 +1,299 @@
+from firebase_admin import firestore
+from typing import Any, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from app.services.firestore import get_firestore_client, FIRESTORE_BATCH_LIMIT
+from app.services.storage import StorageService
+from app.services.thumbnails import thumbnail_path
+import os
+
+# Store identical uploads once under their SHA-256 instead of once per upload
+DEDUP_STORAGE = os.getenv('DEDUP_STORAGE', 'false').lower() == 'true'
+# Concurrent uploads or deletes of the same content conflict and are retried
+BLOB_TRANSACTION_ATTEMPTS = int(os.getenv('BLOB_TRANSACTION_ATTEMPTS', 20))
+# Reference releases run in parallel when many files are deleted at once
+BLOB_RELEASE_CONCURRENCY = int(os.getenv('BLOB_RELEASE_CONCURRENCY', 8))
+
+class BlobRefService:
+    """
+    Reference counts for content-addressed objects, kept in the `blobs`
+    collection with one document per SHA-256:
+    {refs, size, referenced_bytes, generation, created_at}.
+    `generation` is the GCS generation of the stored object, or None until
+    the content has been stored.
+    """
+    
+    @staticmethod
+    def _blob_ref(sha256: str):
+        db = get_firestore_client()
+        if not db:
+            raise Exception('Database connection failed')
+        return db, db.collection('blobs').document(sha256)
+    
+    @staticmethod
+    def acquire(sha256: str, size: int) -> bool:
+        """
+        Add a reference to a blob. Returns True if the caller must store the
+        content because no stored copy is known yet.
+        """
+        db, blob_ref = BlobRefService._blob_ref(sha256)
+        
+        @firestore.transactional
+        def acquire_in_transaction(transaction):
+            snapshot = blob_ref.get(transaction=transaction)
+            blob_data = snapshot.to_dict() if snapshot.exists else None
+            if not blob_data or blob_data.get('refs', 0) <= 0:
+                transaction.set(blob_ref, {
+                    'refs': 1,
+                    'size': size,
+                    'referenced_bytes': size,
+                    'generation': None,
+                    'created_at': datetime.utcnow()
+                })
+                return True
+            refs = blob_data['refs'] + 1
+            transaction.update(blob_ref, {
+                'refs': refs,
+                'referenced_bytes': refs * blob_data.get('size', size)
+            })
+            # Another upload holds a reference but has not stored the content
+            # yet; store it too rather than depend on that upload succeeding
+            return blob_data.get('generation') is None
+        
+        return acquire_in_transaction(db.transaction(max_attempts=BLOB_TRANSACTION_ATTEMPTS))
+    
+    @staticmethod
+    def set_generation(sha256: str, generation: int) -> None:
+        """Record the GCS generation of a blob's stored content"""
+        _, blob_ref = BlobRefService._blob_ref(sha256)
+        blob_ref.update({'generation': generation})
+    
+    @staticmethod
+    def release(sha256: str, count: int = 1) -> Tuple[bool, Optional[int]]:
+        """
+        Drop count references to a blob. Returns (unreferenced, generation);
+        when the last reference is gone the document is deleted and the
+        caller should delete the object at that generation.
+        """
+        db, blob_ref = BlobRefService._blob_ref(sha256)
+        
+        @firestore.transactional
+        def release_in_transaction(transaction):
+            snapshot = blob_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                print(f"Blob reference for {sha256} not found")
+                return False, None
+            blob_data = snapshot.to_dict()
+            refs = blob_data.get('refs', 0) - count
+            if refs <= 0:
+                transaction.delete(blob_ref)
+                return True, blob_data.get('generation')
+            transaction.update(blob_ref, {
+                'refs': refs,
+                'referenced_bytes': refs * blob_data.get('size', 0)
+            })
+            return False, None
+        
+        return release_in_transaction(db.transaction(max_attempts=BLOB_TRANSACTION_ATTEMPTS))
+    
+    @staticmethod
+    def release_marked(sha256: str, marks: List[Tuple[Any, Any]]) -> Tuple[bool, Optional[int]]:
+        """
+        Drop one reference for each (marker_ref, record_ref) pair whose marker
+        document still exists and whose file record is gone, deleting those
+        markers in the same transaction. Each marker is released at most once,
+        so repeating a release after a crash is a no-op. Returns the same as
+        release.
+        """
+        db, blob_ref = BlobRefService._blob_ref(sha256)
+        
+        @firestore.transactional
+        def release_in_transaction(transaction):
+            snapshot = blob_ref.get(transaction=transaction)
+            refs_to_read = [ref for mark in marks for ref in mark]
+            existing = {doc.reference.path for doc in db.get_all(refs_to_read, transaction=transaction) if doc.exists}
+            due = [marker_ref for marker_ref, record_ref in marks
+                   if marker_ref.path in existing and record_ref.path not in existing]
+            if not due:
+                return False, None
+            for marker_ref in due:
+                transaction.delete(marker_ref)
+            if not snapshot.exists:
+                print(f"Blob reference for {sha256} not found")
+                return False, None
+            blob_data = snapshot.to_dict()
+            refs = blob_data.get('refs', 0) - len(due)
+            if refs <= 0:
+                transaction.delete(blob_ref)
+                return True, blob_data.get('generation')
+            transaction.update(blob_ref, {
+                'refs': refs,
+                'referenced_bytes': refs * blob_data.get('size', 0)
+            })
+            return False, None
+        
+        return release_in_transaction(db.transaction(max_attempts=BLOB_TRANSACTION_ATTEMPTS))
+    
+    @staticmethod
+    def get_totals() -> Dict[str, int]:
+        """Sum stored and referenced bytes over all blobs with an aggregation query"""
+        db = get_firestore_client()
+        if not db:
+            raise Exception('Database connection failed')
+        query = db.collection('blobs')
+        results = query.count(alias='blobs').sum('size', alias='stored').sum('referenced_bytes', alias='referenced').get()[0]
+        results = {result.alias: result.value for result in results}
+        return {
+            'blob_count': int(results.get('blobs') or 0),
+            'stored_bytes': int(results.get('stored') or 0),
+            'referenced_bytes': int(results.get('referenced') or 0)
+        }
+
+class DedupService:
+    """
+    Places streamed uploads in content-addressed storage when DEDUP_STORAGE
+    is enabled, and releases file content on delete. File records of
+    deduplicated uploads carry a `content_hash`; other records own their
+    object outright.
+    """
+    
+    def __init__(self, storage: StorageService):
+        self.storage = storage
+    
+    def store_upload(self, upload: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Take the result of StorageService.upload_stream and return the
+        storage fields for the file record
+        """
+        if not DEDUP_STORAGE:
+            return {'gcs_path': upload['gcs_path']}
+        
+        sha256 = upload['sha256']
+        try:
+            must_store = BlobRefService.acquire(sha256, upload['size'])
+        except Exception:
+            self.storage.delete_file(upload['gcs_path'])
+            raise
+        try:
+            if must_store:
+                generation = self.storage.store_content(upload['gcs_path'], sha256)
+                BlobRefService.set_generation(sha256, generation)
+            else:
+                # The content is already stored, so the new copy is not needed
+                self.storage.delete_file(upload['gcs_path'])
+        except Exception:
+            self.storage.delete_file(upload['gcs_path'])
+            BlobRefService.release(sha256)
+            raise
+        
+        return {
+            'gcs_path': self.storage.content_path(sha256),
+            'content_hash': sha256
+        }
+    
+    def release_content(self, file_data: Dict[str, Any]) -> bool:
+        """Delete a file's stored object, or drop its reference if the content is shared"""
+        sha256 = file_data.get('content_hash')
+        if not sha256:
+            if file_data.get('thumbnail_path'):
+                self.storage.delete_file(file_data['thumbnail_path'])
+            return self.storage.delete_file(file_data['gcs_path'])
+        try:
+            unreferenced, generation = BlobRefService.release(sha256)
+        except Exception as e:
+            print(f"Error releasing blob reference: {e}")
+            return False
+        if unreferenced and generation is not None:
+            # The shared preview goes with the last reference
+            self.storage.delete_file(thumbnail_path(file_data['gcs_path']))
+            # The generation check keeps an upload that re-stored the same
+            # content after the last reference was dropped
+            return self.storage.delete_file(file_data['gcs_path'], if_generation_match=generation)
+        return True
+    
+    def release_contents(self, files_data: List[Dict[str, Any]]) -> List[str]:
+        """
+        release_content for many files: references are dropped once per
+        distinct blob and unreferenced objects are deleted with batch
+        requests. Returns the GCS paths that could not be deleted.
+        """
+        objects = []
+        for file_data in files_data:
+            if not file_data.get('content_hash'):
+                objects.append((file_data['gcs_path'], None))
+                if file_data.get('thumbnail_path'):
+                    objects.append((file_data['thumbnail_path'], None))
+        counts: Dict[str, int] = {}
+        for file_data in files_data:
+            if file_data.get('content_hash'):
+                counts[file_data['content_hash']] = counts.get(file_data['content_hash'], 0) + 1
+        
+        def release(item):
+            sha256, count = item
+            try:
+                return sha256, BlobRefService.release(sha256, count)
+            except Exception as e:
+                print(f"Error releasing blob reference: {e}")
+                return sha256, (False, None)
+        
+        if counts:
+            with ThreadPoolExecutor(max_workers=max(1, BLOB_RELEASE_CONCURRENCY)) as executor:
+                for sha256, (unreferenced, generation) in executor.map(release, counts.items()):
+                    if unreferenced and generation is not None:
+                        objects.append((self.storage.content_path(sha256), generation))
+                        objects.append((thumbnail_path(self.storage.content_path(sha256)), None))
+        
+        return self.storage.delete_files(objects) if objects else []
+    
+    def release_marked_contents(self, marks: List[Dict[str, Any]]) -> List[str]:
+        """
+        Release shared content through release markers: each mark is a dict
+        with 'content_hash', 'marker' (a document written before the file
+        record was deleted) and 'record' (the file record's reference).
+        Unreferenced objects are deleted with batch requests. Returns the GCS
+        paths that could not be deleted.
+        """
+        by_hash: Dict[str, List[Tuple[Any, Any]]] = {}
+        for mark in marks:
+            by_hash.setdefault(mark['content_hash'], []).append((mark['marker'], mark['record']))
+        # A transaction deletes every due marker plus the blob document
+        chunk_size = FIRESTORE_BATCH_LIMIT - 1
+        work = [
+            (sha256, pairs[start:start + chunk_size])
+            for sha256, pairs in by_hash.items()
+            for start in range(0, len(pairs), chunk_size)
+        ]
+        
+        def release(item):
+            sha256, pairs = item
+            try:
+                return sha256, BlobRefService.release_marked(sha256, pairs)
+            except Exception as e:
+                print(f"Error releasing blob reference: {e}")
+                return sha256, (False, None)
+        
+        objects = []
+        if work:
+            with ThreadPoolExecutor(max_workers=max(1, BLOB_RELEASE_CONCURRENCY)) as executor:
+                for sha256, (unreferenced, generation) in executor.map(release, work):
+                    if unreferenced and generation is not None:
+                        objects.append((self.storage.content_path(sha256), generation))
+                        objects.append((thumbnail_path(self.storage.content_path(sha256)), None))
+        
+        return self.storage.delete_files(objects) if objects else []
+    
+    def get_stats(self, total_storage_bytes: int) -> Dict[str, Any]:
+        """
+        Bucket-level dedup metrics. total_storage_bytes is the logical size of
+        every file record (see FirestoreService.get_system_stats).
+        """
+        totals = BlobRefService.get_totals()
+        physical_bytes = total_storage_bytes - totals['referenced_bytes'] + totals['stored_bytes']
+        return {
+            'enabled': DEDUP_STORAGE,
+            'blob_count': totals['blob_count'],
+            'logical_bytes': total_storage_bytes,
+            'physical_bytes': physical_bytes,
+            'saved_bytes': total_storage_bytes - physical_bytes,
+            'dedup_ratio': round(total_storage_bytes / physical_bytes, 3) if physical_bytes else 1.0
+        }
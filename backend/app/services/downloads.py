@@ -0,0 +1,155 @@
+from fastapi.responses import Response, StreamingResponse
+from typing import Any, Dict, Optional, Tuple
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from urllib.parse import quote
+from app.services.storage import StorageService, SIGNED_URL_REFRESH_MARGIN
+import hashlib
+import os
+import time
+
+# Size of each ranged read from GCS while a download is streamed; this is
+# what one download holds in memory
+DOWNLOAD_CHUNK_SIZE = int(os.getenv('DOWNLOAD_CHUNK_SIZE', 1024 * 1024))
+
+class RangeNotSatisfiableError(Exception):
+    """Raised when a Range header asks for bytes past the end of the file"""
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a Range header into an inclusive (start, end) byte range.
+    Returns None when the whole file should be sent: no header, a header
+    that cannot be parsed, or several ranges (which servers may ignore).
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, _, last = header[len('bytes='):].strip().partition('-')
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+            if last and end < start:
+                return None
+        else:
+            # Suffix range: the last N bytes
+            suffix = int(last)
+            if suffix == 0:
+                raise RangeNotSatisfiableError()
+            start, end = max(size - suffix, 0), size - 1
+    except ValueError:
+        return None
+    if start < 0 or start >= size:
+        raise RangeNotSatisfiableError()
+    return start, min(end, size - 1)
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """Check an If-None-Match or If-Range value against an ETag, using weak comparison"""
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    strip_weak = lambda tag: tag.strip()[2:] if tag.strip().startswith('W/') else tag.strip()
+    return strip_weak(etag) in (strip_weak(tag) for tag in header.split(','))
+
+def listing_etag(version: int, *params: Any) -> str:
+    """
+    Weak ETag for a listing page, from the change version of what it lists
+    and the query parameters. Listings embed signed URLs, so the tag also
+    changes every SIGNED_URL_REFRESH_MARGIN seconds: a revalidated listing
+    is never older than that, and its URLs are then still valid.
+    """
+    window = int(time.time() // SIGNED_URL_REFRESH_MARGIN)
+    digest = hashlib.sha256(repr((version, window) + params).encode('utf-8')).hexdigest()[:32]
+    return f'W/"{digest}"'
+
+def listing_cache_headers(etag: str) -> Dict[str, str]:
+    """Headers that let a client cache a listing and revalidate it on every use"""
+    return {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+
+def content_disposition(file_name: str) -> str:
+    """Attachment header that keeps non-ASCII file names intact"""
+    fallback = file_name.encode('ascii', 'replace').decode('ascii').replace('"', '')
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(file_name)}"
+
+class DownloadService:
+    """
+    Serves stored files through the backend, for clients that cannot reach
+    GCS or want cacheable URLs. Responses carry an ETag built from the GCS
+    generation, so a version of an object keeps its ETag while it exists.
+    """
+    
+    def __init__(self, storage: StorageService):
+        self.storage = storage
+    
+    def response(self, file_data: Dict[str, Any], headers: Dict[str, str], include_body: bool = True) -> Response:
+        """
+        Build the response to a GET (or HEAD) for a file record, honouring
+        Range, If-Range, If-None-Match and If-Modified-Since. Raises
+        LookupError if the object is missing from storage.
+        """
+        info = self.storage.get_object_info(file_data['gcs_path'])
+        if info is None:
+            raise LookupError("File content not found")
+        
+        size = info['size']
+        etag = f"\"{info['generation']}\""
+        base_headers = {
+            'ETag': etag,
+            'Accept-Ranges': 'bytes',
+            # Downloads need auth, so only the browser may cache them, revalidating with the ETag
+            'Cache-Control': 'private, no-cache'
+        }
+        if info['updated']:
+            base_headers['Last-Modified'] = format_datetime(info['updated'].astimezone(timezone.utc), usegmt=True)
+        
+        if self._not_modified(headers, etag, info['updated']):
+            return Response(status_code=304, headers=base_headers)
+        
+        content_type = file_data.get('content_type') or info['content_type'] or 'application/octet-stream'
+        base_headers['Content-Disposition'] = content_disposition(file_data['file_name'])
+        
+        # A Range that was meant for another version gets the whole new one
+        byte_range = None
+        if_range = headers.get('if-range')
+        if size and (not if_range or etag_matches(if_range, etag)):
+            try:
+                byte_range = parse_range(headers.get('range'), size)
+            except RangeNotSatisfiableError:
+                return Response(status_code=416, headers={**base_headers, 'Content-Range': f"bytes */{size}"})
+        
+        status_code = 200
+        start, end = 0, size - 1
+        if byte_range:
+            status_code = 206
+            start, end = byte_range
+            base_headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+        base_headers['Content-Length'] = str(end - start + 1)
+        
+        if not include_body or size == 0:
+            return Response(status_code=status_code, headers=base_headers, media_type=content_type)
+        return StreamingResponse(
+            self.storage.iter_range(
+                file_data['gcs_path'], start, end,
+                generation=info['generation'], chunk_size=DOWNLOAD_CHUNK_SIZE
+            ),
+            status_code=status_code,
+            headers=base_headers,
+            media_type=content_type
+        )
+    
+    @staticmethod
+    def _not_modified(headers: Dict[str, str], etag: str, updated: Optional[datetime]) -> bool:
+        if 'if-none-match' in headers:
+            # If-None-Match takes precedence over If-Modified-Since
+            return etag_matches(headers['if-none-match'], etag)
+        if_modified_since = headers.get('if-modified-since')
+        if if_modified_since and updated:
+            try:
+                since = parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=timezone.utc)
+            # HTTP dates have whole seconds
+            return updated.replace(microsecond=0) <= since
+        return False
@@ -0,0 +1,145 @@
+from typing import Any, Dict, List, Optional, Set
+from datetime import datetime
+from app.services.firestore import get_firestore_client
+from app.services.concurrency import run_blocking
+import asyncio
+import os
+
+# Events buffered per subscriber. A subscriber that falls this far behind
+# has its backlog replaced by a single reset event, telling it to reload.
+EVENT_QUEUE_SIZE = int(os.getenv('EVENT_QUEUE_SIZE', 1000))
+
+def file_event_data(file_id: str, file_data: Dict[str, Any]) -> Dict[str, Any]:
+    """The fields of a file record that listings show"""
+    return {
+        'id': file_id,
+        'file_name': file_data.get('file_name'),
+        'file_size': file_data.get('file_size', 0),
+        'content_type': file_data.get('content_type'),
+        'uploaded_at': file_data.get('uploaded_at'),
+        'user_id': file_data.get('user_id')
+    }
+
+def user_event_data(uid: str, user_data: Dict[str, Any]) -> Dict[str, Any]:
+    """A user profile in the shape of UserResponse"""
+    return {
+        'uid': uid,
+        'email': user_data.get('email', ''),
+        'user_type': user_data.get('userType', 'user'),
+        'file_limit': user_data.get('fileLimit', 500),
+        'file_count': user_data.get('fileCount', 0),
+        'file_size_limit': user_data.get('fileSizeLimit', 100 * 1024 * 1024),
+        'created_at': user_data.get('createdAt')
+    }
+
+class EventBroker:
+    """
+    Pushes file and user changes to subscribers in this process. One set of
+    Firestore snapshot listeners feeds every subscriber and runs only while
+    someone is subscribed; events are copied to each subscriber's queue on
+    the event loop.
+    
+    Events are {'type', 'data'} with type file-created, file-deleted,
+    user-updated, user-deleted or reset.
+    """
+    
+    def __init__(self):
+        self._subscribers: Set[asyncio.Queue] = set()
+        self._watches: List[Any] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = asyncio.Lock()
+        # What subscribers were last sent of each user
+        self._user_views: Dict[str, Dict[str, Any]] = {}
+    
+    async def subscribe(self) -> asyncio.Queue:
+        """Get a queue receiving every event from now on"""
+        async with self._lock:
+            queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+            self._subscribers.add(queue)
+            if not self._watches:
+                self._loop = asyncio.get_running_loop()
+                try:
+                    self._watches = await run_blocking(self._start_watches)
+                except Exception:
+                    self._subscribers.discard(queue)
+                    raise
+            return queue
+    
+    async def unsubscribe(self, queue: asyncio.Queue) -> None:
+        """Stop delivering to a queue; the listeners stop with the last subscriber"""
+        async with self._lock:
+            self._subscribers.discard(queue)
+            if not self._subscribers and self._watches:
+                watches, self._watches = self._watches, []
+                await run_blocking(self._stop_watches, watches)
+    
+    def stop(self) -> None:
+        """Stop the listeners, e.g. at shutdown"""
+        watches, self._watches = self._watches, []
+        self._stop_watches(watches)
+    
+    def _start_watches(self) -> List[Any]:
+        db = get_firestore_client()
+        if not db:
+            raise Exception('Database connection failed')
+        # Only documents written from now on, so the listeners start without
+        # reading the collections. File deletes are seen through their
+        # tombstones; users through updatedAt, which writes that change what
+        # the admin view shows set (a purge sets it before the delete).
+        since = datetime.utcnow()
+        self._user_views = {}
+        return [
+            db.collection('files').where('uploaded_at', '>', since).on_snapshot(self._on_files),
+            db.collection('file_tombstones').where('deleted_at', '>', since).on_snapshot(self._on_tombstones),
+            db.collection('users').where('updatedAt', '>', since).on_snapshot(self._on_users)
+        ]
+    
+    @staticmethod
+    def _stop_watches(watches: List[Any]) -> None:
+        for watch in watches:
+            try:
+                watch.unsubscribe()
+            except Exception as e:
+                print(f"Error stopping snapshot listener: {e}")
+    
+    def _on_files(self, docs, changes, read_time) -> None:
+        for change in changes:
+            if change.type.name == 'ADDED':
+                self._publish('file-created', file_event_data(change.document.id, change.document.to_dict()))
+    
+    def _on_tombstones(self, docs, changes, read_time) -> None:
+        for change in changes:
+            if change.type.name == 'ADDED':
+                tombstone = change.document.to_dict()
+                self._publish('file-deleted', {'id': change.document.id, 'user_id': tombstone.get('user_id')})
+    
+    def _on_users(self, docs, changes, read_time) -> None:
+        for change in changes:
+            uid = change.document.id
+            if change.type.name == 'REMOVED':
+                self._user_views.pop(uid, None)
+                self._publish('user-deleted', {'uid': uid})
+                continue
+            # Once a user matches the listener, reservations, change versions and
+            # byte totals written on every upload also reach it; only changes to
+            # the fields the admin view shows are pushed
+            view = user_event_data(uid, change.document.to_dict())
+            if self._user_views.get(uid) != view:
+                self._user_views[uid] = view
+                self._publish('user-updated', view)
+    
+    def _publish(self, event_type: str, data: Dict[str, Any]) -> None:
+        """Called on Firestore's listener threads; hands the event to the event loop"""
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._deliver, {'type': event_type, 'data': data})
+    
+    def _deliver(self, event: Dict[str, Any]) -> None:
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Replace the backlog with one reset rather than block everyone else
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({'type': 'reset', 'data': {}})
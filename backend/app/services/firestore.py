@@ -1,8 +1,100 @@
 from firebase_admin import firestore
-from typing import List, Optional, Dict, Any
-from datetime import datetime
+from typing import List, Optional, Dict, Any, Tuple
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import json
+import random
+from app.services.cache import TTLCache
 import os
 
+# User profiles are read on almost every authenticated request. They are
+# cached for a short time and invalidated whenever this service writes them;
+# the TTL bounds staleness for writes made by other instances or the frontend.
+PROFILE_CACHE_TTL = int(os.getenv('PROFILE_CACHE_TTL', 30))
+PROFILE_CACHE_SIZE = int(os.getenv('PROFILE_CACHE_SIZE', 10000))
+profile_cache = TTLCache(max_size=PROFILE_CACHE_SIZE, default_ttl=PROFILE_CACHE_TTL)
+# Writes that change what the admin view shows of a user (type, limits, file
+# count) also set updatedAt, which scopes the admin event listener
+
+# System statistics are kept as counters spread over several shard documents
+# (stats/system/shards/{n}) so concurrent uploads do not contend on one document
+STATS_SHARD_COUNT = int(os.getenv('STATS_SHARD_COUNT', 10))
+STATS_COUNTERS = ('total_files', 'total_storage_bytes', 'admin_users')
+
+def stats_shards_collection(db):
+    """Get the collection holding the system stats counter shards"""
+    return db.collection('stats').document('system').collection('shards')
+
+# Page sizes for cursor-paginated file listings
+DEFAULT_PAGE_SIZE = int(os.getenv('DEFAULT_PAGE_SIZE', 100))
+MAX_PAGE_SIZE = 1000
+
+def encode_page_cursor(file_data: Dict[str, Any]) -> str:
+    """Encode the position of the last file on a page as an opaque cursor"""
+    position = {'uploaded_at': file_data['uploaded_at'].isoformat(), 'id': file_data['id']}
+    return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('ascii')
+
+def decode_page_cursor(cursor: str) -> Dict[str, Any]:
+    """Decode a cursor into the field values Firestore's start_after expects"""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return {
+            'uploaded_at': datetime.fromisoformat(position['uploaded_at']),
+            '__name__': position['id']
+        }
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+# Deleted files leave a tombstone in file_tombstones/{file_id} so delta syncs
+# can report the delete. Tombstones carry an expires_at field for a
+# Firestore TTL policy on that collection; sync tokens older than the
+# retention are refused.
+TOMBSTONE_RETENTION_DAYS = int(os.getenv('TOMBSTONE_RETENTION_DAYS', 30))
+# Sync tokens point this far before the moment they were issued, so records
+# whose commit landed just after their timestamp, or that were written by an
+# instance with a skewed clock, are not missed. Changes can therefore repeat.
+SYNC_TOKEN_OVERLAP_SECONDS = int(os.getenv('SYNC_TOKEN_OVERLAP_SECONDS', 30))
+# Most created or deleted files reported by one delta sync; beyond that the
+# client is told to reload the full list
+MAX_SYNC_CHANGES = int(os.getenv('MAX_SYNC_CHANGES', 1000))
+
+class SyncTokenExpiredError(Exception):
+    """Raised when a sync token is older than the tombstone retention"""
+
+# A finalize claims its upload session before it checks the object, so a
+# retried or concurrent finalize cannot create a second record; a resumable
+# chunk upload claims it while it writes. A claim left behind by an instance
+# that died can be taken over after this many seconds.
+UPLOAD_SESSION_CLAIM_TTL = int(os.getenv('UPLOAD_SESSION_CLAIM_TTL', 5 * 60))
+
+class UploadSessionClaimedError(Exception):
+    """Raised when an upload session is already being finalized"""
+
+class UploadSessionExpiredError(Exception):
+    """Raised when an upload session is past its expires_at"""
+
+def upload_session_claimed(session: Dict[str, Any]) -> bool:
+    """Check whether a finalize (or cancel) currently holds an upload session"""
+    claimed_at = session.get('claimed_at')
+    return bool(claimed_at) and claimed_at.replace(tzinfo=None) > datetime.utcnow() - timedelta(seconds=UPLOAD_SESSION_CLAIM_TTL)
+
+def new_sync_token() -> str:
+    """Issue an opaque token for the current moment, to pass to a later delta sync"""
+    since = datetime.utcnow() - timedelta(seconds=SYNC_TOKEN_OVERLAP_SECONDS)
+    return base64.urlsafe_b64encode(json.dumps({'since': since.isoformat()}).encode('utf-8')).decode('ascii')
+
+def decode_sync_token(token: str) -> datetime:
+    """Decode a sync token into the (naive UTC) time changes are reported from"""
+    try:
+        since = datetime.fromisoformat(json.loads(base64.urlsafe_b64decode(token.encode('ascii')))['since'])
+    except Exception:
+        raise ValueError("Invalid sync token")
+    # Tokens are issued naive; a crafted one with an offset must not reach naive comparisons
+    if since.tzinfo is not None:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    return since
+
 def get_firestore_client():
     """Get Firestore client, initializing if needed"""
     try:
@@ -11,34 +103,85 @@ def get_firestore_client():
         print(f"Failed to get Firestore client: {e}")
         return None
 
+# Firestore rejects commits with more than 500 writes
+FIRESTORE_BATCH_LIMIT = 500
+
+# Number of users reconciled in parallel; each user costs one document read,
+# one aggregation query and at most one write
+RECONCILE_CONCURRENCY = int(os.getenv('RECONCILE_CONCURRENCY', 16))
+
+class BatchWriter:
+    """
+    Collects writes and commits them in Firestore WriteBatches of at most
+    FIRESTORE_BATCH_LIMIT operations. Each chunk commits atomically, but a
+    write set larger than one chunk is not atomic as a whole.
+    """
+    def __init__(self, db):
+        self._db = db
+        self._batch = db.batch()
+        self._pending = 0
+        self.commits = 0
+    
+    def set(self, ref, data: Dict[str, Any], merge: bool = False) -> None:
+        self._batch.set(ref, data, merge=merge)
+        self._added()
+    
+    def update(self, ref, data: Dict[str, Any]) -> None:
+        self._batch.update(ref, data)
+        self._added()
+    
+    def delete(self, ref) -> None:
+        self._batch.delete(ref)
+        self._added()
+    
+    def _added(self) -> None:
+        self._pending += 1
+        if self._pending >= FIRESTORE_BATCH_LIMIT:
+            self.commit()
+    
+    def commit(self) -> None:
+        """Commit any pending writes"""
+        if self._pending:
+            self._batch.commit()
+            self.commits += 1
+            self._batch = self._db.batch()
+            self._pending = 0
+
 class FirestoreService:
     
     @staticmethod
     def get_user_profile(uid: str) -> Optional[Dict[str, Any]]:
-        """Get user profile from Firestore"""
+        """Get user profile, from the profile cache when possible"""
+        cached_profile = profile_cache.get(uid)
+        if cached_profile is not None:
+            return dict(cached_profile)
         try:
             db = get_firestore_client()
             if not db:
                 return None
             user_doc = db.collection('users').document(uid).get()
             if user_doc.exists:
-                return user_doc.to_dict()
+                user_data = user_doc.to_dict()
+                profile_cache.set(uid, user_data)
+                return dict(user_data)
             return None
         except Exception as e:
             print(f"Error getting user profile: {e}")
             return None
     
     @staticmethod
-    def update_user_file_count(uid: str, increment: int = 1) -> bool:
-        """Update user's file count"""
+    def update_user_file_count(uid: str, increment: int = 1, size_delta: int = 0) -> bool:
+        """Update user's file count and, if size_delta is given, their stored byte total"""
         try:
             db = get_firestore_client()
             if not db:
                 return False
+            updates = {'fileCount': firestore.Increment(increment), 'updatedAt': firestore.SERVER_TIMESTAMP}
+            if size_delta:
+                updates['storageBytes'] = firestore.Increment(size_delta)
             user_ref = db.collection('users').document(uid)
-            user_ref.update({
-                'fileCount': firestore.Increment(increment)
-            })
+            user_ref.update(updates)
+            profile_cache.invalidate(uid)
             return True
         except Exception as e:
             print(f"Error updating file count: {e}")
@@ -53,8 +196,10 @@ class FirestoreService:
                 return False
             user_ref = db.collection('users').document(uid)
             user_ref.update({
-                'fileLimit': new_limit
+                'fileLimit': new_limit,
+                'updatedAt': firestore.SERVER_TIMESTAMP
             })
+            profile_cache.invalidate(uid)
             return True
         except Exception as e:
             print(f"Error updating file limit: {e}")
@@ -69,8 +214,10 @@ class FirestoreService:
                 return False
             user_ref = db.collection('users').document(uid)
             user_ref.update({
-                'fileSizeLimit': new_size_limit
+                'fileSizeLimit': new_size_limit,
+                'updatedAt': firestore.SERVER_TIMESTAMP
             })
+            profile_cache.invalidate(uid)
             return True
         except Exception as e:
             print(f"Error updating file size limit: {e}")
@@ -84,9 +231,23 @@ class FirestoreService:
             if not db:
                 return False
             user_ref = db.collection('users').document(uid)
-            user_ref.update({
-                'userType': user_type
-            })
+            shard_ref = stats_shards_collection(db).document(str(random.randrange(STATS_SHARD_COUNT)))
+            
+            # The role and the materialized admin count change together, so
+            # concurrent role changes cannot count the same user twice
+            @firestore.transactional
+            def update_in_transaction(transaction):
+                user_doc = user_ref.get(transaction=transaction)
+                if not user_doc.exists:
+                    raise Exception('User not found')
+                previous_type = (user_doc.to_dict() or {}).get('userType', 'user')
+                transaction.update(user_ref, {'userType': user_type, 'updatedAt': firestore.SERVER_TIMESTAMP})
+                admin_delta = (user_type == 'admin') - (previous_type == 'admin')
+                if admin_delta:
+                    transaction.set(shard_ref, {'admin_users': firestore.Increment(admin_delta)}, merge=True)
+            
+            update_in_transaction(db.transaction())
+            profile_cache.invalidate(uid)
             return True
         except Exception as e:
             print(f"Error updating user type: {e}")
@@ -115,14 +276,17 @@ class FirestoreService:
             db = get_firestore_client()
             if not db:
                 return []
-            files = db.collection('files').where('user_id', '==', uid).stream()
+            files = (
+                db.collection('files')
+                .where('user_id', '==', uid)
+                .order_by('uploaded_at', direction=firestore.Query.DESCENDING)
+                .stream()
+            )
             file_list = []
             for doc in files:
                 file_data = doc.to_dict()
                 file_data['id'] = doc.id  # Add the document ID as id
                 file_list.append(file_data)
-            # Sort by uploaded_at in Python instead of Firestore
-            file_list.sort(key=lambda x: x.get('uploaded_at', datetime.min), reverse=True)
             return file_list
         except Exception as e:
             print(f"Error getting user files: {e}")
@@ -135,19 +299,106 @@ class FirestoreService:
             db = get_firestore_client()
             if not db:
                 return []
-            files = db.collection('files').stream()
+            files = (
+                db.collection('files')
+                .order_by('uploaded_at', direction=firestore.Query.DESCENDING)
+                .stream()
+            )
             file_list = []
             for doc in files:
                 file_data = doc.to_dict()
                 file_data['id'] = doc.id  # Add the document ID as id
                 file_list.append(file_data)
-            # Sort by uploaded_at in Python instead of Firestore
-            file_list.sort(key=lambda x: x.get('uploaded_at', datetime.min), reverse=True)
             return file_list
         except Exception as e:
             print(f"Error getting all files: {e}")
             return []
     
+    @staticmethod
+    def get_files_page(uid: Optional[str], limit: int, cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Get one page of files, newest first, for a user or across all users
+        when uid is None. Returns the page and a cursor for the next page,
+        or None when this is the last page.
+        """
+        db = get_firestore_client()
+        if not db:
+            raise Exception('Database connection failed')
+        query = db.collection('files')
+        if uid is not None:
+            query = query.where('user_id', '==', uid)
+        # Document ID breaks ties between files uploaded at the same instant
+        query = (
+            query.order_by('uploaded_at', direction=firestore.Query.DESCENDING)
+            .order_by('__name__', direction=firestore.Query.DESCENDING)
+        )
+        if cursor:
+            query = query.start_after(decode_page_cursor(cursor))
+        
+        # Fetch one extra document to know whether there is a next page
+        file_list = []
+        for doc in query.limit(limit + 1).stream():
+            file_data = doc.to_dict()
+            file_data['id'] = doc.id
+            file_list.append(file_data)
+        
+        if len(file_list) > limit:
+            file_list = file_list[:limit]
+            return file_list, encode_page_cursor(file_list[-1])
+        return file_list, None
+    
+    @staticmethod
+    def get_changes(uid: Optional[str], sync_token: str) -> Dict[str, Any]:
+        """
+        Get the files created and the IDs of files deleted since a sync token,
+        for a user or across all users when uid is None. Returns
+        {files, deleted, sync_token, reset}; reset means there were more
+        than MAX_SYNC_CHANGES changes and the client should reload its list.
+        Raises ValueError for a malformed token and SyncTokenExpiredError for
+        one older than the tombstones.
+        """
+        since = decode_sync_token(sync_token)
+        if since < datetime.utcnow() - timedelta(days=TOMBSTONE_RETENTION_DAYS):
+            raise SyncTokenExpiredError("Sync token expired; reload the full list")
+        db = get_firestore_client()
+        if not db:
+            raise Exception('Database connection failed')
+        # Issued before querying so nothing committed meanwhile is skipped next time
+        next_token = new_sync_token()
+        
+        files_query = db.collection('files')
+        tombstones_query = db.collection('file_tombstones')
+        if uid is not None:
+            files_query = files_query.where('user_id', '==', uid)
+            tombstones_query = tombstones_query.where('user_id', '==', uid)
+        # Same ordering as the listings, so the same composite index serves both
+        files_query = (
+            files_query.where('uploaded_at', '>', since)
+            .order_by('uploaded_at', direction=firestore.Query.DESCENDING)
+            .limit(MAX_SYNC_CHANGES + 1)
+        )
+        tombstones_query = (
+            tombstones_query.where('deleted_at', '>', since)
+            .select(['deleted_at'])
+            .limit(MAX_SYNC_CHANGES + 1)
+        )
+        
+        file_docs = list(files_query.stream())
+        deleted_ids = [doc.id for doc in tombstones_query.stream()]
+        
+        if len(file_docs) > MAX_SYNC_CHANGES or len(deleted_ids) > MAX_SYNC_CHANGES:
+            return {'files': [], 'deleted': [], 'sync_token': next_token, 'reset': True}
+        
+        # A file created and deleted since the token only shows up as deleted
+        deleted = set(deleted_ids)
+        file_list = []
+        for doc in file_docs:
+            if doc.id not in deleted:
+                file_data = doc.to_dict()
+                file_data['id'] = doc.id
+                file_list.append(file_data)
+        return {'files': file_list, 'deleted': deleted_ids, 'sync_token': next_token, 'reset': False}
+    
     @staticmethod
     def get_all_users() -> List[Dict[str, Any]]:
         """Get all users (admin only)"""
@@ -194,6 +445,25 @@ class FirestoreService:
             print(f"Error getting file: {e}")
             return None
     
+    @staticmethod
+    def get_files_by_ids(file_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Get many files in a single multi-get, keyed by file ID (missing files are left out)"""
+        try:
+            db = get_firestore_client()
+            if not db:
+                return {}
+            refs = [db.collection('files').document(file_id) for file_id in file_ids]
+            files = {}
+            for doc in db.get_all(refs):
+                if doc.exists:
+                    file_data = doc.to_dict()
+                    file_data['id'] = doc.id
+                    files[doc.id] = file_data
+            return files
+        except Exception as e:
+            print(f"Error getting files by IDs: {e}")
+            raise e
+    
     @staticmethod
     def update_file_download_url(file_id: str, download_url: str) -> bool:
         """Update file with signed download URL"""
@@ -210,21 +480,450 @@ class FirestoreService:
             return False
     
     @staticmethod
-    def sync_user_file_count(uid: str) -> bool:
-        """Sync user's file count with actual files in database"""
+    def create_upload_session(session_data: Dict[str, Any]) -> str:
+        """Create a pending direct-to-GCS upload session"""
+        try:
+            db = get_firestore_client()
+            if not db:
+                raise Exception('Database connection failed')
+            session_ref = db.collection('upload_sessions').document()
+            session_ref.set(session_data)
+            return session_ref.id
+        except Exception as e:
+            print(f"Error creating upload session: {e}")
+            raise e
+    
+    @staticmethod
+    def get_upload_session(session_id: str) -> Optional[Dict[str, Any]]:
+        """Get a pending upload session by ID"""
+        try:
+            db = get_firestore_client()
+            if not db:
+                return None
+            session_doc = db.collection('upload_sessions').document(session_id).get()
+            if session_doc.exists:
+                return session_doc.to_dict()
+            return None
+        except Exception as e:
+            print(f"Error getting upload session: {e}")
+            return None
+    
+    @staticmethod
+    def get_expired_upload_sessions(limit: int) -> List[Dict[str, Any]]:
+        """Get upload sessions past their expires_at, with their IDs"""
+        db = get_firestore_client()
+        if not db:
+            raise Exception('Database connection failed')
+        query = db.collection('upload_sessions').where('expires_at', '<', datetime.utcnow()).limit(limit)
+        return [{**doc.to_dict(), 'id': doc.id} for doc in query.stream()]
+    
+    @staticmethod
+    def delete_upload_session(session_id: str) -> bool:
+        """Delete an upload session once it is finalized"""
         try:
-            # Get actual file count
-            actual_count = len(FirestoreService.get_user_files(uid))
-            
-            # Update user profile with actual count
             db = get_firestore_client()
             if not db:
                 return False
-            user_ref = db.collection('users').document(uid)
-            user_ref.update({
-                'fileCount': actual_count
+            db.collection('upload_sessions').document(session_id).delete()
+            return True
+        except Exception as e:
+            print(f"Error deleting upload session: {e}")
+            return False
+    
+    @staticmethod
+    def claim_upload_session(session_id: str, uid: str, status: str = 'finalizing') -> Dict[str, Any]:
+        """
+        Mark an upload session as busy with status (finalizing, or uploading
+        while a resumable chunk is written), in a transaction; only one
+        caller gets it. Raises LookupError if it does not exist, PermissionError
+        if it belongs to someone else, UploadSessionExpiredError or
+        UploadSessionClaimedError. Returns the session.
+        """
+        db = get_firestore_client()
+        if not db:
+            raise Exception('Database connection failed')
+        session_ref = db.collection('upload_sessions').document(session_id)
+        
+        @firestore.transactional
+        def claim_in_transaction(transaction):
+            snapshot = session_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                raise LookupError("Upload session not found")
+            session = snapshot.to_dict()
+            if session['user_id'] != uid:
+                raise PermissionError("Upload session belongs to another user")
+            now = datetime.utcnow()
+            if session['expires_at'].replace(tzinfo=None) < now:
+                raise UploadSessionExpiredError("Upload session has expired")
+            if upload_session_claimed(session):
+                raise UploadSessionClaimedError(f"Upload is already {session.get('status', 'finalizing')}")
+            transaction.update(session_ref, {'status': status, 'claimed_at': now})
+            return session
+        
+        return claim_in_transaction(db.transaction())
+    
+    @staticmethod
+    def refresh_upload_session_claim(session_id: str) -> None:
+        """Keep a claim from going stale while a long request holds it"""
+        db = get_firestore_client()
+        if not db:
+            raise Exception('Database connection failed')
+        db.collection('upload_sessions').document(session_id).update({'claimed_at': datetime.utcnow()})
+    
+    @staticmethod
+    def release_upload_session_claim(session_id: str) -> bool:
+        """Let an upload session be claimed again, e.g. after a finalize failed"""
+        try:
+            db = get_firestore_client()
+            if not db:
+                return False
+            db.collection('upload_sessions').document(session_id).update({
+                'status': firestore.DELETE_FIELD,
+                'claimed_at': firestore.DELETE_FIELD
             })
             return True
+        except Exception as e:
+            print(f"Error releasing upload session claim: {e}")
+            return False
+    
+    @staticmethod
+    def create_stream_ticket(ticket_key: str, uid: str, expires_at: datetime) -> None:
+        """Store a stream ticket for a user, keyed by a hash of the ticket"""
+        db = get_firestore_client()
+        if not db:
+            raise Exception('Database connection failed')
+        db.collection('stream_tickets').document(ticket_key).set({
+            'user_id': uid,
+            'expires_at': expires_at
+        })
+    
+    @staticmethod
+    def redeem_stream_ticket(ticket_key: str) -> Optional[str]:
+        """
+        Use up a stream ticket in a transaction, so it works once even across
+        instances. Returns its user's ID, or None if it is unknown, used or
+        expired.
+        """
+        db = get_firestore_client()
+        if not db:
+            return None
+        ticket_ref = db.collection('stream_tickets').document(ticket_key)
+        
+        @firestore.transactional
+        def redeem_in_transaction(transaction):
+            snapshot = ticket_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return None
+            transaction.delete(ticket_ref)
+            ticket = snapshot.to_dict()
+            if ticket['expires_at'].replace(tzinfo=None) < datetime.utcnow():
+                return None
+            return ticket['user_id']
+        
+        return redeem_in_transaction(db.transaction())
+    
+    @staticmethod
+    def sync_user_file_count(uid: str) -> bool:
+        """Sync user's file count and byte total with actual files in database"""
+        try:
+            return FirestoreService.reconcile_user(uid) is not None
         except Exception as e:
             print(f"Error syncing file count: {e}")
-            return False
\ No newline at end of file
+            return False
+    
+    @staticmethod
+    def aggregate_user_files(uid: str) -> Dict[str, int]:
+        """Count a user's files and sum their sizes without reading the file documents"""
+        db = get_firestore_client()
+        if not db:
+            raise Exception('Database connection failed')
+        query = db.collection('files').where('user_id', '==', uid)
+        results = query.count(alias='files').sum('file_size', alias='bytes').get()[0]
+        results = {result.alias: result.value for result in results}
+        return {
+            'file_count': int(results.get('files') or 0),
+            'storage_bytes': int(results.get('bytes') or 0)
+        }
+    
+    @staticmethod
+    def reconcile_user(uid: str) -> Optional[Dict[str, Any]]:
+        """
+        Set a user's fileCount and storageBytes from aggregation queries.
+        Returns what was stored before and after, or None if the user does not exist.
+        """
+        db = get_firestore_client()
+        if not db:
+            raise Exception('Database connection failed')
+        user_ref = db.collection('users').document(uid)
+        user_doc = user_ref.get()
+        if not user_doc.exists:
+            return None
+        user_data = user_doc.to_dict()
+        totals = FirestoreService.aggregate_user_files(uid)
+        
+        result = {
+            'uid': uid,
+            'previous_file_count': user_data.get('fileCount', 0),
+            'file_count': totals['file_count'],
+            'previous_storage_bytes': user_data.get('storageBytes'),
+            'storage_bytes': totals['storage_bytes']
+        }
+        result['count_drifted'] = result['previous_file_count'] != result['file_count']
+        result['bytes_drifted'] = result['previous_storage_bytes'] != result['storage_bytes']
+        if result['count_drifted'] or result['bytes_drifted']:
+            user_ref.update({
+                'fileCount': totals['file_count'],
+                'storageBytes': totals['storage_bytes'],
+                'updatedAt': firestore.SERVER_TIMESTAMP
+            })
+            profile_cache.invalidate(uid)
+        return result
+    
+    @staticmethod
+    def reconcile_all_users(max_workers: int = RECONCILE_CONCURRENCY) -> Dict[str, Any]:
+        """
+        Reconcile every user's fileCount and storageBytes, max_workers users at a time.
+        Uploads that commit while a user is being reconciled may be overwritten,
+        so run it when the system is quiet.
+        """
+        db = get_firestore_client()
+        if not db:
+            raise Exception('Database connection failed')
+        # list_documents only fetches references, not user data
+        user_ids = [ref.id for ref in db.collection('users').list_documents()]
+        
+        def reconcile(uid):
+            try:
+                return FirestoreService.reconcile_user(uid)
+            except Exception as e:
+                print(f"Error reconciling user {uid}: {e}")
+                return e
+        
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            results = list(executor.map(reconcile, user_ids))
+        
+        reconciled = [r for r in results if isinstance(r, dict)]
+        failed = [uid for uid, r in zip(user_ids, results) if isinstance(r, Exception)]
+        drifted = [r for r in reconciled if r['count_drifted']]
+        return {
+            'users_checked': len(reconciled),
+            'counts_drifted': len(drifted),
+            'bytes_drifted': sum(1 for r in reconciled if r['bytes_drifted']),
+            'failed_users': failed,
+            'drifted_users': [
+                {'uid': r['uid'], 'previous_file_count': r['previous_file_count'], 'file_count': r['file_count']}
+                for r in drifted
+            ]
+        }
+    
+    @staticmethod
+    def increment_system_stats(**deltas: int) -> bool:
+        """Apply counter deltas (see STATS_COUNTERS) to one randomly chosen stats shard"""
+        try:
+            db = get_firestore_client()
+            if not db:
+                return False
+            updates = {
+                counter: firestore.Increment(delta)
+                for counter, delta in deltas.items() if delta
+            }
+            if not updates:
+                return True
+            shard_ref = stats_shards_collection(db).document(str(random.randrange(STATS_SHARD_COUNT)))
+            shard_ref.set(updates, merge=True)
+            return True
+        except Exception as e:
+            print(f"Error updating system stats: {e}")
+            return False
+    
+    @staticmethod
+    def get_system_stats() -> Optional[Dict[str, int]]:
+        """Sum the stats shards; returns None if the stats were never built"""
+        db = get_firestore_client()
+        if not db:
+            raise Exception('Database connection failed')
+        totals = dict.fromkeys(STATS_COUNTERS, 0)
+        found = False
+        for doc in stats_shards_collection(db).stream():
+            found = True
+            for counter, value in doc.to_dict().items():
+                if counter in totals:
+                    totals[counter] += value
+        return totals if found else None
+    
+    @staticmethod
+    def get_change_version(uid: str) -> int:
+        """
+        Read a user's change version, which goes up whenever their files
+        change. Read directly rather than from the profile cache, since a
+        stale version would let a client keep an outdated listing.
+        """
+        db = get_firestore_client()
+        if not db:
+            raise Exception('Database connection failed')
+        user_doc = db.collection('users').document(uid).get(field_paths=['changeVersion'])
+        if not user_doc.exists:
+            # Distinct from every real version, including that of a user who never changed anything
+            return -1
+        return int((user_doc.to_dict() or {}).get('changeVersion') or 0)
+    
+    @staticmethod
+    def get_global_change_version() -> int:
+        """Sum the change version over the stats shards; goes up whenever any file changes"""
+        db = get_firestore_client()
+        if not db:
+            raise Exception('Database connection failed')
+        result = stats_shards_collection(db).sum('change_version', alias='version').get()[0]
+        return int(result[0].value or 0)
+    
+    @staticmethod
+    def update_file_fields(file_id: str, user_id: str, updates: Dict[str, Any]) -> None:
+        """
+        Update fields of a file record that show up in listings, bumping the
+        owner's and the global change version in the same commit. Raises if
+        the record no longer exists.
+        """
+        db = get_firestore_client()
+        if not db:
+            raise Exception('Database connection failed')
+        batch = db.batch()
+        batch.update(db.collection('files').document(file_id), updates)
+        batch.update(db.collection('users').document(user_id), {'changeVersion': firestore.Increment(1)})
+        shard_ref = stats_shards_collection(db).document(str(random.randrange(STATS_SHARD_COUNT)))
+        batch.set(shard_ref, {'change_version': firestore.Increment(1)}, merge=True)
+        batch.commit()
+    
+    @staticmethod
+    def count_users() -> int:
+        """Count user documents with an aggregation query (users sign up from the frontend)"""
+        db = get_firestore_client()
+        if not db:
+            raise Exception('Database connection failed')
+        result = db.collection('users').count().get()
+        return int(result[0][0].value)
+    
+    @staticmethod
+    def rebuild_system_stats() -> Dict[str, int]:
+        """
+        Recompute the system stats from scratch with aggregation queries and
+        reset the shards. Increments that land while this runs may be lost,
+        so run it when the system is quiet.
+        """
+        db = get_firestore_client()
+        if not db:
+            raise Exception('Database connection failed')
+        files_query = db.collection('files')
+        file_totals = files_query.count(alias='files').sum('file_size', alias='bytes').get()[0]
+        file_totals = {result.alias: result.value for result in file_totals}
+        admin_count = (
+            db.collection('users').where('userType', '==', 'admin').count().get()[0][0].value
+        )
+        totals = {
+            'total_files': int(file_totals.get('files') or 0),
+            'total_storage_bytes': int(file_totals.get('bytes') or 0),
+            'admin_users': int(admin_count)
+        }
+        
+        # Put the totals in shard 0 and zero every other shard in one commit.
+        # Merging leaves the change version alone so listing ETags never repeat.
+        batch = db.batch()
+        shards = stats_shards_collection(db)
+        for shard in range(STATS_SHARD_COUNT):
+            values = totals if shard == 0 else dict.fromkeys(STATS_COUNTERS, 0)
+            batch.set(shards.document(str(shard)), values, merge=True)
+        batch.commit()
+        return totals
+    
+    @staticmethod
+    def batch_writer() -> BatchWriter:
+        """Get a writer for multi-document mutations that commits in WriteBatches"""
+        db = get_firestore_client()
+        if not db:
+            raise Exception('Database connection failed')
+        return BatchWriter(db)
+    
+    @staticmethod
+    def commit_file_changes(created: Optional[List[Dict[str, Any]]] = None,
+                            deleted: Optional[List[Dict[str, Any]]] = None,
+                            reservation: Optional[Tuple[str, str]] = None,
+                            update_owners: bool = True,
+                            upload_session_id: Optional[str] = None) -> List[str]:
+        """
+        Create and delete file records together with one aggregated file count
+        and byte total change per owner and one system stats update, using
+        batched commits. Every deleted record leaves a tombstone.
+        Deleted records must include 'id', 'user_id' and 'file_size'.
+        A (uid, reservation_id) quota reservation is consumed in the same
+        write as that user's count change. update_owners=False leaves the
+        owners' documents alone, e.g. when they are about to be deleted.
+        The upload session a record came from is deleted in the same write.
+        Returns the IDs of the created records, in order.
+        """
+        created = created or []
+        deleted = deleted or []
+        db = get_firestore_client()
+        if not db:
+            raise Exception('Database connection failed')
+        writer = BatchWriter(db)
+        files = db.collection('files')
+        
+        created_ids = []
+        count_deltas: Dict[str, int] = {}
+        size_deltas: Dict[str, int] = {}
+        for file_data in created:
+            file_ref = files.document()
+            file_data['id'] = file_ref.id
+            file_data['uploaded_at'] = datetime.utcnow()
+            writer.set(file_ref, file_data)
+            created_ids.append(file_ref.id)
+            count_deltas[file_data['user_id']] = count_deltas.get(file_data['user_id'], 0) + 1
+            size_deltas[file_data['user_id']] = size_deltas.get(file_data['user_id'], 0) + file_data.get('file_size', 0)
+        
+        tombstones = db.collection('file_tombstones')
+        deleted_at = datetime.utcnow()
+        for file_data in deleted:
+            writer.delete(files.document(file_data['id']))
+            writer.set(tombstones.document(file_data['id']), {
+                'user_id': file_data['user_id'],
+                'deleted_at': deleted_at,
+                'expires_at': deleted_at + timedelta(days=TOMBSTONE_RETENTION_DAYS)
+            })
+            count_deltas[file_data['user_id']] = count_deltas.get(file_data['user_id'], 0) - 1
+            size_deltas[file_data['user_id']] = size_deltas.get(file_data['user_id'], 0) - file_data.get('file_size', 0)
+        
+        # Every owner whose files changed gets a new change version, which
+        # invalidates the ETags of their listings
+        user_updates: Dict[str, Dict[str, Any]] = {
+            uid: {'changeVersion': firestore.Increment(1)}
+            for uid in count_deltas if update_owners
+        }
+        for uid, delta in count_deltas.items() if update_owners else ():
+            if delta:
+                user_updates[uid]['fileCount'] = firestore.Increment(delta)
+                user_updates[uid]['updatedAt'] = firestore.SERVER_TIMESTAMP
+        for uid, delta in size_deltas.items() if update_owners else ():
+            if delta:
+                user_updates.setdefault(uid, {})['storageBytes'] = firestore.Increment(delta)
+        if reservation and reservation[1]:
+            reservation_uid, reservation_id = reservation
+            user_updates.setdefault(reservation_uid, {})[f'reservations.{reservation_id}'] = firestore.DELETE_FIELD
+        for uid, updates in user_updates.items():
+            writer.update(db.collection('users').document(uid), updates)
+        
+        if created or deleted:
+            stats_updates = {
+                'total_files': firestore.Increment(len(created) - len(deleted)),
+                'total_storage_bytes': firestore.Increment(
+                    sum(f.get('file_size', 0) for f in created) - sum(f.get('file_size', 0) for f in deleted)
+                ),
+                'change_version': firestore.Increment(1)
+            }
+            shard_ref = stats_shards_collection(db).document(str(random.randrange(STATS_SHARD_COUNT)))
+            writer.set(shard_ref, stats_updates, merge=True)
+        if upload_session_id:
+            writer.delete(db.collection('upload_sessions').document(upload_session_id))
+        
+        writer.commit()
+        for uid in count_deltas:
+            profile_cache.invalidate(uid)
+        return created_ids
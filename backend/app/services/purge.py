@@ -0,0 +1,229 @@
+from firebase_admin import firestore
+from typing import Any, Dict, List, Optional
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from app.services.firestore import (
+    FirestoreService, get_firestore_client, profile_cache, FIRESTORE_BATCH_LIMIT
+)
+from app.services.storage import StorageService
+from app.services.dedup import DedupService
+import os
+import threading
+import uuid
+
+# File records fetched per page; each page is deleted with parallel WriteBatches
+PURGE_PAGE_SIZE = int(os.getenv('PURGE_PAGE_SIZE', 2000))
+# WriteBatches and GCS batch requests in flight at once
+PURGE_CONCURRENCY = int(os.getenv('PURGE_CONCURRENCY', 8))
+# A running job whose heartbeat is older than this is assumed to have died
+# with its instance and may be resumed
+PURGE_STALE_SECONDS = int(os.getenv('PURGE_STALE_SECONDS', 120))
+
+# Identifies the jobs run by this process
+INSTANCE_ID = uuid.uuid4().hex
+
+class PurgeService:
+    """
+    Deletes a user and all of their data in a background thread. Progress is
+    kept in purge_jobs/{user_id}, and every step is idempotent, so a job that
+    died with its instance is resumed from where it stopped.
+    """
+    
+    def __init__(self, storage: StorageService):
+        self.storage = storage
+        self.dedup = DedupService(storage)
+    
+    @staticmethod
+    def _job_ref(user_id: str):
+        db = get_firestore_client()
+        if not db:
+            raise Exception('Database connection failed')
+        return db, db.collection('purge_jobs').document(user_id)
+    
+    @staticmethod
+    def get_job(user_id: str) -> Optional[Dict[str, Any]]:
+        """Get the purge job for a user, if there is one"""
+        _, job_ref = PurgeService._job_ref(user_id)
+        job_doc = job_ref.get()
+        return job_doc.to_dict() if job_doc.exists else None
+    
+    @staticmethod
+    def _is_stale(job: Dict[str, Any]) -> bool:
+        heartbeat = job.get('updated_at')
+        if heartbeat is None:
+            return True
+        if heartbeat.tzinfo is None:
+            heartbeat = heartbeat.replace(tzinfo=timezone.utc)
+        return datetime.now(timezone.utc) - heartbeat > timedelta(seconds=PURGE_STALE_SECONDS)
+    
+    def start(self, user_id: str, started_by: str) -> Dict[str, Any]:
+        """
+        Start purging a user, or resume a job that failed or has gone stale.
+        A job that is still running is returned unchanged.
+        Raises LookupError if there is neither a job to resume nor a user.
+        """
+        db, job_ref = self._job_ref(user_id)
+        user_ref = db.collection('users').document(user_id)
+        
+        @firestore.transactional
+        def claim(transaction):
+            job_doc = job_ref.get(transaction=transaction)
+            job = job_doc.to_dict() if job_doc.exists else None
+            if job and job['status'] == 'running' and not self._is_stale(job):
+                return job, False
+            if job and job['status'] == 'failed':
+                # Retry a failed job, keeping its progress
+                job.update({'status': 'running', 'error': None})
+            elif not job or job['status'] == 'completed':
+                user_doc = user_ref.get(transaction=transaction)
+                if not user_doc.exists:
+                    raise LookupError("User not found")
+                # Refuse new uploads while the purge runs (see QuotaService.reserve)
+                # updatedAt lets the admin event listener see the user's delete
+                transaction.update(user_ref, {'purging': True, 'updatedAt': firestore.SERVER_TIMESTAMP})
+                job = {
+                    'user_id': user_id,
+                    'status': 'running',
+                    'phase': 'records',
+                    'files_deleted': 0,
+                    'objects_deleted': 0,
+                    'bytes_deleted': 0,
+                    'was_admin': (user_doc.to_dict() or {}).get('userType') == 'admin',
+                    'started_by': started_by,
+                    'started_at': datetime.utcnow(),
+                    'finished_at': None,
+                    'error': None
+                }
+            job.update({'owner': INSTANCE_ID, 'updated_at': datetime.utcnow()})
+            transaction.set(job_ref, job)
+            return job, True
+        
+        job, claimed = claim(db.transaction())
+        if claimed:
+            threading.Thread(target=self.run, args=(user_id,), name=f"purge-{user_id}", daemon=True).start()
+        return job
+    
+    def resume_stale_jobs(self) -> int:
+        """Resume running jobs whose instance stopped sending heartbeats; returns how many"""
+        db = get_firestore_client()
+        if not db:
+            return 0
+        resumed = 0
+        for job_doc in db.collection('purge_jobs').where('status', '==', 'running').stream():
+            job = job_doc.to_dict()
+            if self._is_stale(job):
+                try:
+                    if self.start(job['user_id'], job.get('started_by', ''))['owner'] == INSTANCE_ID:
+                        resumed += 1
+                except Exception as e:
+                    print(f"Error resuming purge of {job['user_id']}: {e}")
+        return resumed
+    
+    def run(self, user_id: str) -> None:
+        """Carry out a claimed purge job, recording progress after every step"""
+        db, job_ref = self._job_ref(user_id)
+        try:
+            job = job_ref.get().to_dict()
+            # Finish releasing shared content for records a previous run deleted
+            self._release_marked(db, job_ref)
+            
+            # File records go first so the user's files disappear from listings
+            # right away; each page is re-queried because the last one is gone
+            files = db.collection('files')
+            while True:
+                page = [
+                    {**doc.to_dict(), 'id': doc.id}
+                    for doc in files.where('user_id', '==', user_id).limit(PURGE_PAGE_SIZE).stream()
+                ]
+                if not page:
+                    break
+                self._delete_records(db, job_ref, page)
+                # Records are deleted without touching the owner, so their
+                # listing version is bumped once per page instead
+                db.collection('users').document(user_id).update({'changeVersion': firestore.Increment(1)})
+                job['files_deleted'] += len(page)
+                job['bytes_deleted'] += sum(f.get('file_size', 0) for f in page)
+                self._heartbeat(job_ref, job)
+            # A release that failed leaves its marker; fail so a retry drains it
+            if list(job_ref.collection('releases').limit(1).stream()):
+                raise Exception("Shared content references could not be released")
+            
+            # Everything the user stored privately lives under their prefix,
+            # including abandoned upload session objects
+            job['phase'] = 'objects'
+            self._heartbeat(job_ref, job)
+            objects_before = job['objects_deleted']
+            
+            def objects_progress(deleted):
+                job['objects_deleted'] = objects_before + deleted
+                self._heartbeat(job_ref, job)
+            
+            _, failed = self.storage.delete_prefix(
+                f"{user_id}/", concurrency=PURGE_CONCURRENCY, progress=objects_progress
+            )
+            if failed:
+                raise Exception(f"Failed to delete {len(failed)} objects")
+            
+            job['phase'] = 'user'
+            self._heartbeat(job_ref, job)
+            for session_doc in db.collection('upload_sessions').where('user_id', '==', user_id).stream():
+                session_doc.reference.delete()
+            db.collection('users').document(user_id).delete()
+            profile_cache.invalidate(user_id)
+            if job.get('was_admin'):
+                FirestoreService.increment_system_stats(admin_users=-1)
+            
+            job.update({'status': 'completed', 'phase': 'done', 'finished_at': datetime.utcnow()})
+            self._heartbeat(job_ref, job)
+            print(f"Purged user {user_id}: {job['files_deleted']} files, {job['objects_deleted']} objects")
+        except Exception as e:
+            print(f"Error purging user {user_id}: {e}")
+            try:
+                job_ref.update({'status': 'failed', 'error': str(e), 'updated_at': datetime.utcnow()})
+            except Exception:
+                pass
+    
+    def _delete_records(self, db, job_ref, page: List[Dict[str, Any]]) -> None:
+        """Delete a page of file records with parallel WriteBatches and drop shared content references"""
+        # Content-addressed blobs are shared, so they are released rather than
+        # deleted by prefix. A release marker per record is written first: the
+        # release consumes it, so a crash between the record deletes and the
+        # release is picked up on resume, and nothing is released twice.
+        shared = [f for f in page if f.get('content_hash')]
+        if shared:
+            writer = FirestoreService.batch_writer()
+            for file_data in shared:
+                writer.set(job_ref.collection('releases').document(file_data['id']), {
+                    'content_hash': file_data['content_hash'],
+                    'gcs_path': file_data['gcs_path']
+                })
+            writer.commit()
+        
+        # Each record costs a delete and a tombstone; one write per batch is
+        # left for the system stats update
+        chunk_size = (FIRESTORE_BATCH_LIMIT - 1) // 2
+        chunks = [page[start:start + chunk_size] for start in range(0, len(page), chunk_size)]
+        with ThreadPoolExecutor(max_workers=max(1, PURGE_CONCURRENCY)) as executor:
+            list(executor.map(
+                lambda chunk: FirestoreService.commit_file_changes(deleted=chunk, update_owners=False),
+                chunks
+            ))
+        if shared:
+            self._release_marked(db, job_ref)
+    
+    def _release_marked(self, db, job_ref) -> None:
+        """Release the shared content behind every release marker whose record is gone"""
+        files = db.collection('files')
+        marks = [
+            {'content_hash': doc.to_dict()['content_hash'], 'marker': doc.reference, 'record': files.document(doc.id)}
+            for doc in job_ref.collection('releases').stream()
+        ]
+        if marks:
+            failed = self.dedup.release_marked_contents(marks)
+            if failed:
+                print(f"Failed to delete {len(failed)} shared objects: {failed}")
+    
+    @staticmethod
+    def _heartbeat(job_ref, job: Dict[str, Any]) -> None:
+        job['updated_at'] = datetime.utcnow()
+        job_ref.set(job)
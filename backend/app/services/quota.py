@@ -0,0 +1,93 @@
+from firebase_admin import firestore
+from app.services.firestore import get_firestore_client
+import os
+import time
+import uuid
+
+# Reservations that are neither committed nor released (e.g. the instance
+# died mid-upload) stop counting against the quota after this many seconds
+QUOTA_RESERVATION_TTL = int(os.getenv('QUOTA_RESERVATION_TTL', 15 * 60))
+# Concurrent reservations for the same user conflict and are retried
+QUOTA_TRANSACTION_ATTEMPTS = int(os.getenv('QUOTA_TRANSACTION_ATTEMPTS', 20))
+
+class QuotaExceededError(Exception):
+    """Raised when a reservation would take a user over their file limit"""
+    pass
+
+class QuotaService:
+    """
+    Reserves file slots against a user's fileLimit before an upload starts.
+    Active reservations live in a `reservations` map on the user document,
+    so a reservation only contends with other uploads by the same user.
+    A reservation is committed together with the upload's file records
+    (see FirestoreService.commit_file_changes) or released on failure.
+    """
+    
+    @staticmethod
+    def reserve(uid: str, file_count: int, byte_count: int = 0, ttl: int = QUOTA_RESERVATION_TTL) -> str:
+        """Atomically reserve slots for file_count files; returns the reservation ID"""
+        db = get_firestore_client()
+        if not db:
+            raise Exception('Database connection failed')
+        user_ref = db.collection('users').document(uid)
+        reservation_id = uuid.uuid4().hex
+        
+        @firestore.transactional
+        def reserve_in_transaction(transaction):
+            snapshot = user_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                raise QuotaExceededError("User not found in database")
+            user_data = snapshot.to_dict()
+            if user_data.get('purging'):
+                raise QuotaExceededError("This account is being deleted")
+            
+            now = time.time()
+            reservations = user_data.get('reservations') or {}
+            active = {
+                rid: reservation for rid, reservation in reservations.items()
+                if reservation.get('expires_at', 0) > now
+            }
+            current_count = user_data.get('fileCount', 0)
+            reserved_count = sum(reservation.get('files', 0) for reservation in active.values())
+            file_limit = user_data.get('fileLimit', 500)
+            
+            if current_count + reserved_count + file_count > file_limit:
+                if file_count == 1:
+                    raise QuotaExceededError(
+                        f"File limit reached ({current_count + reserved_count}/{file_limit}). Contact admin to increase limit."
+                    )
+                raise QuotaExceededError(
+                    f"Uploading {file_count} files would exceed limit. Current: {current_count + reserved_count}/{file_limit}"
+                )
+            
+            # Drop expired reservations while we hold the document
+            updates = {
+                f'reservations.{rid}': firestore.DELETE_FIELD
+                for rid in reservations if rid not in active
+            }
+            updates[f'reservations.{reservation_id}'] = {
+                'files': file_count,
+                'bytes': byte_count,
+                'expires_at': now + ttl
+            }
+            transaction.update(user_ref, updates)
+        
+        reserve_in_transaction(db.transaction(max_attempts=QUOTA_TRANSACTION_ATTEMPTS))
+        return reservation_id
+    
+    @staticmethod
+    def release(uid: str, reservation_id: str) -> bool:
+        """Give back a reservation's slots without adding any files"""
+        if not reservation_id:
+            return True
+        try:
+            db = get_firestore_client()
+            if not db:
+                return False
+            db.collection('users').document(uid).update({
+                f'reservations.{reservation_id}': firestore.DELETE_FIELD
+            })
+            return True
+        except Exception as e:
+            print(f"Error releasing quota reservation: {e}")
+            return False
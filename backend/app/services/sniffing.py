@@ -0,0 +1,112 @@
+from typing import Callable, Dict, Tuple
+import codecs
+
+# Bytes read from the start of a file to identify it. Enough for every
+# signature below (tar's is furthest in, at offset 257).
+SNIFF_BYTES = 4096
+
+def _at(offset: int, magic: bytes) -> Callable[[bytes], bool]:
+    return lambda head: head[offset:offset + len(magic)] == magic
+
+def _within(limit: int, magic: bytes) -> Callable[[bytes], bool]:
+    return lambda head: magic in head[:limit]
+
+def _riff(form: bytes) -> Callable[[bytes], bool]:
+    return lambda head: head[:4] == b'RIFF' and head[8:12] == form
+
+def _mp3(head: bytes) -> bool:
+    # ID3 tag, or straight into an MPEG audio frame header
+    return head[:3] == b'ID3' or (len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0)
+
+def _aac(head: bytes) -> bool:
+    # ADTS frame header, or an ADIF header
+    return head[:4] == b'ADIF' or (len(head) > 1 and head[0] == 0xFF and head[1] & 0xF6 == 0xF0)
+
+def _quicktime(head: bytes) -> bool:
+    # ISO base media (ftyp) or an older QuickTime file starting with another atom
+    return head[4:8] in (b'ftyp', b'moov', b'mdat', b'wide', b'free', b'skip', b'pnot')
+
+# Headers of ELF and Mach-O executables and libraries, which are never text
+_EXECUTABLE_MAGIC = (
+    b'\x7fELF', b'\xca\xfe\xba\xbe', b'\xfe\xed\xfa\xce', b'\xfe\xed\xfa\xcf', b'\xcf\xfa\xed\xfe', b'\xce\xfa\xed\xfe'
+)
+
+def _pe(head: bytes) -> bool:
+    # A Windows executable: a DOS header whose e_lfanew (at 0x3C) points at
+    # the PE signature. "MZ" alone also starts plenty of text.
+    if head[:2] != b'MZ' or len(head) < 0x40:
+        return False
+    pe_offset = int.from_bytes(head[0x3C:0x40], 'little')
+    return head[pe_offset:pe_offset + 4] == b'PE\x00\x00'
+
+def _text(head: bytes) -> bool:
+    """
+    Anything that is not clearly binary. Any 8-bit encoding is accepted
+    (e.g. CSV exported as cp1252 or Latin-1); only NUL bytes outside
+    BOM-marked UTF-16, or an executable header, are rejected.
+    """
+    if head.startswith(_EXECUTABLE_MAGIC) or _pe(head):
+        return False
+    if head[:2] in (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE):
+        return True
+    return b'\x00' not in head
+
+_ZIP = (_at(0, b'PK\x03\x04'), _at(0, b'PK\x05\x06'), _at(0, b'PK\x07\x08'))
+_OLE = (_at(0, b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'),)
+
+# Extension -> signatures, any of which identifies a genuine file of that type.
+# Built once at import; lookups are a dict access and a few slice compares.
+SIGNATURES: Dict[str, Tuple[Callable[[bytes], bool], ...]] = {
+    '.jpg': (_at(0, b'\xff\xd8\xff'),),
+    '.jpeg': (_at(0, b'\xff\xd8\xff'),),
+    '.png': (_at(0, b'\x89PNG\r\n\x1a\n'),),
+    '.gif': (_at(0, b'GIF87a'), _at(0, b'GIF89a')),
+    '.bmp': (_at(0, b'BM'),),
+    '.webp': (_riff(b'WEBP'),),
+    '.svg': (_text,),
+    '.pdf': (_within(1024, b'%PDF-'),),
+    '.doc': _OLE,
+    '.xls': _OLE,
+    '.ppt': _OLE,
+    '.docx': _ZIP,
+    '.xlsx': _ZIP,
+    '.pptx': _ZIP,
+    '.zip': _ZIP,
+    '.rar': (_at(0, b'Rar!\x1a\x07'),),
+    '.7z': (_at(0, b"7z\xbc\xaf\x27\x1c"),),
+    '.gz': (_at(0, b'\x1f\x8b'),),
+    '.tar': (_at(257, b'ustar'),),
+    '.mp4': (_quicktime,),
+    '.mov': (_quicktime,),
+    '.avi': (_riff(b'AVI '),),
+    '.wmv': (_at(0, b'\x30\x26\xb2\x75\x8e\x66\xcf\x11'),),
+    '.flv': (_at(0, b'FLV'),),
+    '.webm': (_at(0, b'\x1a\x45\xdf\xa3'),),
+    '.mp3': (_mp3,),
+    '.wav': (_riff(b'WAVE'),),
+    '.flac': (_at(0, b'fLaC'),),
+    '.aac': (_aac,),
+    '.ogg': (_at(0, b'OggS'),),
+    '.txt': (_text,),
+    '.json': (_text,),
+    '.xml': (_text,),
+    '.csv': (_text,),
+    '.sql': (_text,),
+    '.py': (_text,),
+    '.js': (_text,),
+    '.html': (_text,),
+    '.css': (_text,),
+}
+
+def content_matches_extension(extension: str, head: bytes) -> bool:
+    """
+    Check the first bytes of a file against the signatures for its extension.
+    Extensions without known signatures pass.
+    """
+    signatures = SIGNATURES.get(extension.lower())
+    if signatures is None:
+        return True
+    if not head:
+        # Only text formats can be legitimately empty
+        return signatures == (_text,)
+    return any(signature(head) for signature in signatures)
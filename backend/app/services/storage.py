@@ -1,14 +1,88 @@
 from google.cloud import storage
-from typing import Optional, BinaryIO
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from google.auth.transport.requests import AuthorizedSession
+from concurrent.futures import ThreadPoolExecutor
+from google.resumable_media import DataCorruption
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, BinaryIO
+from app.services.cache import TTLCache
+import base64
+import google.auth
+import google_crc32c
+import hashlib
 import os
+import time
 import uuid
 from datetime import datetime, timedelta
 
+# Resumable uploads are sent in chunks that must be a multiple of 256KB.
+# This is also the largest amount of an upload held in memory at once.
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', 4 * 1024 * 1024))
+
+# Signed download URLs are cached per GCS path and reused until they are
+# within SIGNED_URL_REFRESH_MARGIN seconds of expiring
+SIGNED_URL_CACHE_SIZE = int(os.getenv('SIGNED_URL_CACHE_SIZE', 50000))
+SIGNED_URL_REFRESH_MARGIN = int(os.getenv('SIGNED_URL_REFRESH_MARGIN', 300))
+signed_url_cache = TTLCache(max_size=SIGNED_URL_CACHE_SIZE)
+
+# Requests sent per GCS batch call; GCS recommends no more than 100
+STORAGE_BATCH_SIZE = 100
+
+# Content-addressed objects (see app.services.dedup) live under this prefix
+CONTENT_PREFIX = 'blobs/'
+
+# Resumable uploads are forwarded to GCS in pieces of this size, which must be
+# a multiple of RESUMABLE_ALIGNMENT (a configured size is rounded down to one);
+# only the last piece of a file may be shorter
+RESUMABLE_ALIGNMENT = 256 * 1024
+
+def aligned_chunk_size(size: int) -> int:
+    """Round a chunk size down to a multiple of RESUMABLE_ALIGNMENT, and at least one"""
+    return max(RESUMABLE_ALIGNMENT, size // RESUMABLE_ALIGNMENT * RESUMABLE_ALIGNMENT)
+
+RESUMABLE_CHUNK_SIZE = aligned_chunk_size(int(os.getenv('RESUMABLE_CHUNK_SIZE', 8 * 1024 * 1024)))
+
+class FileTooLargeError(Exception):
+    """Raised when a streamed upload goes over its size limit"""
+    def __init__(self, max_size: int):
+        super().__init__(f"File too large. Maximum size is {max_size // (1024*1024)}MB")
+        self.max_size = max_size
+
+class UploadChecksums:
+    """
+    MD5 and CRC32C of a stream, updated chunk by chunk and encoded the way GCS
+    reports them in object metadata (base64 of the big-endian digest), so an
+    audit can compare a file record with its object without reading bytes.
+    SHA-256 is only computed when asked for, for content addressing.
+    """
+    def __init__(self, sha256: bool = False):
+        self.md5 = hashlib.md5()
+        self.crc32c = google_crc32c.Checksum()
+        self.sha256 = hashlib.sha256() if sha256 else None
+    
+    def update(self, chunk: bytes) -> None:
+        self.md5.update(chunk)
+        self.crc32c.update(chunk)
+        if self.sha256 is not None:
+            self.sha256.update(chunk)
+    
+    def result(self) -> Dict[str, str]:
+        checksums = {
+            'md5_hash': base64.b64encode(self.md5.digest()).decode('ascii'),
+            'crc32c': base64.b64encode(self.crc32c.digest()).decode('ascii')
+        }
+        if self.sha256 is not None:
+            checksums['sha256'] = self.sha256.hexdigest()
+        return checksums
+
 class StorageService:
     def __init__(self):
         self.bucket_name = os.getenv('GCS_BUCKET_NAME', 'globaldashboard-4598e-direct-user-uploads')
-        self.client = storage.Client()
+        credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+        self.client = storage.Client(project=project, credentials=credentials)
         self.bucket = self.client.bucket(self.bucket_name)
+        # Resumable upload sessions are driven with raw requests, on a session
+        # authorized with the same credentials as the client
+        self.http = AuthorizedSession(credentials)
     
     def upload_file(self, file_content: bytes, file_name: str, content_type: str, user_id: str) -> str:
         """
@@ -16,9 +90,7 @@ class StorageService:
         Returns the GCS path of the uploaded file
         """
         try:
-            # Generate unique filename to avoid conflicts
-            file_extension = os.path.splitext(file_name)[1]
-            unique_filename = f"{user_id}/{uuid.uuid4()}{file_extension}"
+            unique_filename = self.generate_object_path(file_name, user_id)
             
             # Create blob and upload
             blob = self.bucket.blob(unique_filename)
@@ -29,22 +101,238 @@ class StorageService:
             print(f"Error uploading file: {e}")
             raise e
     
-    def delete_file(self, gcs_path: str) -> bool:
+    def upload_stream(self, file_obj: BinaryIO, file_name: str, content_type: str, user_id: str,
+                      max_size: Optional[int] = None, sha256: bool = False) -> dict:
+        """
+        Stream a file object to Google Cloud Storage using a resumable upload.
+        Only one chunk is buffered at a time and max_size is enforced as bytes
+        are read, so memory use does not depend on the file size.
+        MD5 and CRC32C (and SHA-256 if requested) are computed as the chunks
+        go by, and GCS's CRC32C of the finalized object is checked against
+        the one computed here; an object that does not match is deleted.
+        Returns a dict with the GCS path, the number of bytes uploaded and
+        the checksums.
+        """
+        unique_filename = self.generate_object_path(file_name, user_id)
+        blob = self.bucket.blob(unique_filename)
+        writer = blob.open('wb', chunk_size=UPLOAD_CHUNK_SIZE, content_type=content_type, checksum='crc32c')
+        total_size = 0
+        checksums = UploadChecksums(sha256=sha256)
+        try:
+            while True:
+                chunk = file_obj.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                total_size += len(chunk)
+                if max_size is not None and total_size > max_size:
+                    raise FileTooLargeError(max_size)
+                checksums.update(chunk)
+                writer.write(chunk)
+            # Closing the writer sends the final chunk and finalizes the object
+            writer.close()
+        except FileTooLargeError:
+            # The resumable session is never finalized, so no object is created
+            raise
+        except DataCorruption as e:
+            # The object was finalized with different bytes than were read
+            print(f"Checksum mismatch for {unique_filename}: {e}")
+            self.delete_file(unique_filename)
+            raise e
+        except Exception as e:
+            print(f"Error streaming file upload: {e}")
+            raise e
+        
+        return {
+            'gcs_path': unique_filename,
+            'size': total_size,
+            **checksums.result()
+        }
+    
+    def create_resumable_session(self, gcs_path: str, content_type: str, size: int) -> str:
+        """
+        Start a GCS resumable upload of size bytes and return its session URI.
+        The object only appears once the last byte has been written.
+        """
+        return self.bucket.blob(gcs_path).create_resumable_upload_session(content_type=content_type, size=size)
+    
+    def resumable_offset(self, session_uri: str, size: int) -> int:
+        """Ask GCS how many bytes of a resumable upload it has persisted"""
+        response = self.http.put(session_uri, headers={'Content-Range': f"bytes */{size}"}, data=b'')
+        return self._persisted_offset(response, size)
+    
+    def write_resumable_chunk(self, session_uri: str, offset: int, data: bytes, size: int) -> int:
+        """
+        Send bytes at offset to a resumable upload. Returns the new persisted
+        offset, which GCS may leave short of the end of the data.
+        """
+        content_range = f"bytes {offset}-{offset + len(data) - 1}/{size}"
+        response = self.http.put(session_uri, headers={'Content-Range': content_range}, data=data)
+        return self._persisted_offset(response, size)
+    
+    def cancel_resumable_session(self, session_uri: str) -> None:
+        """Abandon a resumable upload; GCS answers 499 when it is cancelled"""
+        self.http.delete(session_uri)
+    
+    @staticmethod
+    def _persisted_offset(response, size: int) -> int:
+        if response.status_code in (200, 201):
+            return size
+        if response.status_code == 308:
+            # Range is missing until the first bytes have been persisted
+            persisted = response.headers.get('Range')
+            return int(persisted.rsplit('-', 1)[1]) + 1 if persisted else 0
+        raise Exception(f"Resumable upload failed with status {response.status_code}: {response.text[:200]}")
+    
+    def generate_object_path(self, file_name: str, user_id: str) -> str:
+        """
+        Generate a unique GCS object path for a user's file
+        """
+        # Generate unique filename to avoid conflicts
+        file_extension = os.path.splitext(file_name)[1]
+        return f"{user_id}/{uuid.uuid4()}{file_extension}"
+    
+    def content_path(self, sha256: str) -> str:
+        """
+        Get the GCS object path of content-addressed data
+        """
+        return f"{CONTENT_PREFIX}{sha256}"
+    
+    def store_content(self, gcs_path: str, sha256: str) -> int:
+        """
+        Copy an uploaded object to its content-addressed path and delete the
+        original. The copy happens inside GCS, so no bytes pass through the
+        backend. Returns the generation of the content object.
+        """
+        try:
+            source = self.bucket.blob(gcs_path)
+            destination = self.bucket.blob(self.content_path(sha256))
+            # Large objects can take several rewrite calls
+            token, _, _ = destination.rewrite(source)
+            while token is not None:
+                token, _, _ = destination.rewrite(source, token=token)
+            source.delete()
+            return destination.generation
+        except Exception as e:
+            print(f"Error storing content: {e}")
+            raise e
+    
+    def delete_file(self, gcs_path: str, if_generation_match: Optional[int] = None) -> bool:
         """
-        Delete file from Google Cloud Storage
+        Delete file from Google Cloud Storage. With if_generation_match the
+        object is only deleted if it has not been overwritten since.
         """
         try:
             blob = self.bucket.blob(gcs_path)
-            blob.delete()
+            blob.delete(if_generation_match=if_generation_match)
+            signed_url_cache.invalidate(gcs_path)
             return True
         except Exception as e:
             print(f"Error deleting file: {e}")
             return False
     
+    def iter_chunks(self, gcs_path: str, chunk_size: int = UPLOAD_CHUNK_SIZE) -> Iterator[bytes]:
+        """
+        Read an object from Google Cloud Storage with one ranged request per
+        chunk, holding only the current chunk in memory
+        """
+        with self.bucket.blob(gcs_path).open('rb', chunk_size=chunk_size) as reader:
+            while True:
+                chunk = reader.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    
+    def iter_range(self, gcs_path: str, start: int, end: int, generation: Optional[int] = None,
+                   chunk_size: int = UPLOAD_CHUNK_SIZE) -> Iterator[bytes]:
+        """
+        Read bytes start..end (inclusive) of an object with one ranged request
+        per chunk. Pinning the generation keeps every chunk from the same
+        version even if the object is replaced mid-download.
+        """
+        blob = self.bucket.blob(gcs_path, generation=generation)
+        position = start
+        while position <= end:
+            chunk_end = min(position + chunk_size - 1, end)
+            yield blob.download_as_bytes(start=position, end=chunk_end, checksum=None)
+            position = chunk_end + 1
+    
+    def delete_files(self, objects: List[Tuple[str, Optional[int]]]) -> List[str]:
+        """
+        Delete many files from Google Cloud Storage with batch requests of up
+        to STORAGE_BATCH_SIZE deletes. Each object is a (gcs_path,
+        if_generation_match) pair. Objects that are already gone or were
+        overwritten since count as done. Returns the paths that failed.
+        """
+        failed = []
+        for start in range(0, len(objects), STORAGE_BATCH_SIZE):
+            chunk = objects[start:start + STORAGE_BATCH_SIZE]
+            try:
+                with self.client.batch():
+                    for gcs_path, if_generation_match in chunk:
+                        self.bucket.blob(gcs_path).delete(if_generation_match=if_generation_match)
+            except Exception:
+                # A batch only reports that some request failed (a missing
+                # object counts), so the chunk is retried one delete at a time
+                # to tell real failures apart
+                failed.extend(self._delete_each(chunk))
+            for gcs_path, _ in chunk:
+                signed_url_cache.invalidate(gcs_path)
+        return failed
+    
+    def _delete_each(self, objects: List[Tuple[str, Optional[int]]]) -> List[str]:
+        """Delete objects one request at a time; returns the paths that failed"""
+        failed = []
+        for gcs_path, if_generation_match in objects:
+            try:
+                self.bucket.blob(gcs_path).delete(if_generation_match=if_generation_match)
+            except (NotFound, PreconditionFailed):
+                pass
+            except Exception as e:
+                print(f"Error deleting file: {e}")
+                failed.append(gcs_path)
+        return failed
+    
+    def delete_prefix(self, prefix: str, concurrency: int = 8,
+                      progress: Optional[Callable[[int], None]] = None) -> Tuple[int, List[str]]:
+        """
+        Delete every object under a prefix. Objects are listed a page at a
+        time (names only) and deleted with up to `concurrency` batch requests
+        in flight. progress, if given, is called with the running total after
+        each page. Returns the number of objects deleted and the paths that
+        failed.
+        """
+        deleted = 0
+        failed = []
+        blobs = self.client.list_blobs(self.bucket, prefix=prefix, fields='items(name),nextPageToken')
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            for page in blobs.pages:
+                names = [blob.name for blob in page]
+                chunks = [
+                    [(name, None) for name in names[start:start + STORAGE_BATCH_SIZE]]
+                    for start in range(0, len(names), STORAGE_BATCH_SIZE)
+                ]
+                # Batches run on separate threads; the client keeps its batch stack per thread
+                for chunk, chunk_failed in zip(chunks, executor.map(self.delete_files, chunks)):
+                    deleted += len(chunk) - len(chunk_failed)
+                    failed.extend(chunk_failed)
+                if progress:
+                    progress(deleted)
+        return deleted, failed
+    
+    def read_head(self, gcs_path: str, size: int) -> bytes:
+        """
+        Read the first size bytes of an object with a single ranged request
+        """
+        return self.bucket.blob(gcs_path).download_as_bytes(start=0, end=size - 1)
+    
     def generate_signed_url(self, gcs_path: str, expiration_hours: int = 1) -> str:
         """
-        Generate a signed URL for file download
+        Generate a signed URL for file download. A previously signed URL for
+        the same path is reused until it is close to expiring.
         """
+        cached = signed_url_cache.get(gcs_path)
+        if cached is not None and cached[0] == expiration_hours:
+            return cached[1]
         try:
             blob = self.bucket.blob(gcs_path)
             
@@ -57,11 +345,51 @@ class StorageService:
                 method="GET"
             )
             
+            signed_url_cache.set(
+                gcs_path,
+                (expiration_hours, url),
+                ttl=expiration_hours * 3600 - SIGNED_URL_REFRESH_MARGIN
+            )
             return url
         except Exception as e:
             print(f"Error generating signed URL: {e}")
             raise e
     
+    def generate_signed_urls(self, gcs_paths: List[str], expiration_hours: int = 1) -> Dict[str, Optional[str]]:
+        """
+        Generate signed download URLs for many files at once.
+        Paths that cannot be signed map to None.
+        """
+        urls = {}
+        for gcs_path in gcs_paths:
+            try:
+                urls[gcs_path] = self.generate_signed_url(gcs_path, expiration_hours)
+            except Exception:
+                urls[gcs_path] = None
+        return urls
+    
+    def generate_signed_upload_url(self, gcs_path: str, content_type: str, expiration_minutes: int = 15) -> str:
+        """
+        Generate a signed URL that lets a client PUT a file directly to GCS.
+        The client must send the same Content-Type header that was signed.
+        """
+        try:
+            blob = self.bucket.blob(gcs_path)
+            
+            expiration = datetime.utcnow() + timedelta(minutes=expiration_minutes)
+            
+            url = blob.generate_signed_url(
+                version="v4",
+                expiration=expiration,
+                method="PUT",
+                content_type=content_type
+            )
+            
+            return url
+        except Exception as e:
+            print(f"Error generating signed upload URL: {e}")
+            raise e
+    
     def get_file_info(self, gcs_path: str) -> Optional[dict]:
         """
         Get file metadata from GCS
@@ -73,6 +401,8 @@ class StorageService:
                 return {
                     'size': blob.size,
                     'content_type': blob.content_type,
+                    'md5_hash': blob.md5_hash,
+                    'crc32c': blob.crc32c,
                     'created': blob.time_created,
                     'updated': blob.updated
                 }
@@ -81,6 +411,20 @@ class StorageService:
             print(f"Error getting file info: {e}")
             return None
     
+    def get_object_info(self, gcs_path: str) -> Optional[dict]:
+        """
+        Get the metadata needed to serve an object, with a single request
+        """
+        blob = self.bucket.get_blob(gcs_path)
+        if blob is None:
+            return None
+        return {
+            'size': blob.size,
+            'content_type': blob.content_type,
+            'generation': blob.generation,
+            'updated': blob.updated
+        }
+    
     def file_exists(self, gcs_path: str) -> bool:
         """
         Check if file exists in GCS
@@ -0,0 +1,136 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, Optional
+from app.services.firestore import FirestoreService
+from app.services.storage import StorageService, CONTENT_PREFIX
+import io
+import multiprocessing
+import os
+import shutil
+import subprocess
+import threading
+import urllib.request
+
+# Pillow is optional; without it no image thumbnails are generated
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Worker processes rendering previews; 0 turns the pipeline off
+THUMBNAIL_WORKERS = int(os.getenv('THUMBNAIL_WORKERS', 2))
+# Longest edge of a preview, in pixels
+THUMBNAIL_SIZE = int(os.getenv('THUMBNAIL_SIZE', 256))
+# Images larger than this are not downloaded for a preview
+THUMBNAIL_MAX_SOURCE_BYTES = int(os.getenv('THUMBNAIL_MAX_SOURCE_BYTES', 50 * 1024 * 1024))
+# First-frame posters for videos need an ffmpeg binary on the PATH
+VIDEO_POSTERS = os.getenv('VIDEO_POSTERS', 'false').lower() == 'true'
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'}
+VIDEO_EXTENSIONS = {'.mp4', '.avi', '.mov', '.wmv', '.flv', '.webm'}
+
+def thumbnail_path(gcs_path: str) -> str:
+    """Get the GCS path of the preview stored next to an object"""
+    return f"{gcs_path}.thumb.jpg"
+
+def preview_kind(file_name: str) -> Optional[str]:
+    """'image' or 'video' if a preview can be made for this file, otherwise None"""
+    extension = os.path.splitext(file_name.lower())[1]
+    if extension in IMAGE_EXTENSIONS and Image is not None:
+        return 'image'
+    if extension in VIDEO_EXTENSIONS and VIDEO_POSTERS and shutil.which('ffmpeg'):
+        return 'video'
+    return None
+
+def render_image_thumbnail(data: bytes, size: int = THUMBNAIL_SIZE) -> bytes:
+    """Scale an image down to fit size x size and encode it as JPEG"""
+    with Image.open(io.BytesIO(data)) as image:
+        # Lets the JPEG decoder skip straight to a reduced resolution
+        image.draft('RGB', (size, size))
+        image.thumbnail((size, size))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=80, optimize=True)
+        return output.getvalue()
+
+def render_preview(kind: str, source_url: str, size: int = THUMBNAIL_SIZE) -> bytes:
+    """
+    Runs in a worker process: fetch the original from a signed URL and render
+    its preview. Only the small result is sent back to the server process.
+    """
+    if kind == 'video':
+        # ffmpeg reads the signed URL with range requests, so only the start
+        # of the video is downloaded
+        result = subprocess.run(
+            ['ffmpeg', '-loglevel', 'error', '-i', source_url, '-frames:v', '1',
+             '-vf', f"scale={size}:{size}:force_original_aspect_ratio=decrease",
+             '-f', 'image2', '-c:v', 'mjpeg', 'pipe:1'],
+            capture_output=True, timeout=60, check=True
+        )
+        return result.stdout
+    with urllib.request.urlopen(source_url, timeout=60) as response:
+        data = response.read(THUMBNAIL_MAX_SOURCE_BYTES + 1)
+    if len(data) > THUMBNAIL_MAX_SOURCE_BYTES:
+        raise ValueError("Image too large for a preview")
+    return render_image_thumbnail(data, size)
+
+class ThumbnailService:
+    """
+    Generates previews after uploads, off the request path. Rendering runs in
+    a bounded process pool so decoding large images does not hold the GIL of
+    the server process; a thread per worker process waits on the result,
+    stores the preview and records its path on the file record.
+    """
+    
+    def __init__(self, storage: StorageService):
+        self.storage = storage
+        self._processes = None
+        self._threads = None
+        self._lock = threading.Lock()
+    
+    def _pools(self):
+        with self._lock:
+            if self._processes is None:
+                # spawn, because forking a process that runs gRPC threads is unsafe
+                self._processes = ProcessPoolExecutor(
+                    max_workers=THUMBNAIL_WORKERS,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+                self._threads = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS, thread_name_prefix='thumbnails')
+            return self._processes, self._threads
+    
+    def schedule(self, file_id: str, file_data: Dict[str, Any]) -> bool:
+        """Queue a preview for a newly recorded file; returns False if none will be made"""
+        kind = preview_kind(file_data['file_name'])
+        if THUMBNAIL_WORKERS <= 0 or kind is None:
+            return False
+        _, threads = self._pools()
+        threads.submit(self._generate, file_id, file_data['user_id'], file_data['gcs_path'], kind)
+        return True
+    
+    def _generate(self, file_id: str, user_id: str, gcs_path: str, kind: str) -> None:
+        try:
+            preview_path = thumbnail_path(gcs_path)
+            # Content-addressed duplicates share their preview
+            if not self.storage.file_exists(preview_path):
+                processes, _ = self._pools()
+                source_url = self.storage.generate_signed_url(gcs_path)
+                preview = processes.submit(render_preview, kind, source_url).result()
+                self.storage.bucket.blob(preview_path).upload_from_string(preview, content_type='image/jpeg')
+            
+            # Fails if the file was deleted meanwhile; a private preview is then removed too
+            try:
+                FirestoreService.update_file_fields(file_id, user_id, {'thumbnail_path': preview_path})
+            except Exception:
+                if not gcs_path.startswith(CONTENT_PREFIX):
+                    self.storage.delete_file(preview_path)
+                raise
+        except Exception as e:
+            # Without a preview the file is simply listed with its icon
+            print(f"Error generating preview for {gcs_path}: {e}")
+    
+    def shutdown(self) -> None:
+        """Stop the worker processes"""
+        if self._processes is not None:
+            self._threads.shutdown(wait=False, cancel_futures=True)
+            self._processes.shutdown(wait=False, cancel_futures=True)
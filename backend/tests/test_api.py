@@ -2,6 +2,7 @@ import pytest
 import httpx
 from fastapi.testclient import TestClient
 from unittest.mock import Mock, patch
+from datetime import datetime, timedelta, timezone
 import os
 
 # Set test environment
@@ -52,6 +53,1490 @@ class TestFileValidation:
         
         # Should be 100MB
         assert MAX_FILE_SIZE == 100 * 1024 * 1024
+    
+    def test_every_allowed_extension_has_a_signature(self):
+        """Test that content sniffing covers every allowed extension"""
+        from backend.app.routes.files import ALLOWED_EXTENSIONS
+        from backend.app.services.sniffing import SIGNATURES
+        
+        assert ALLOWED_EXTENSIONS <= set(SIGNATURES)
+    
+    def test_content_must_match_extension(self):
+        """Test that file signatures are checked against the extension"""
+        from backend.app.services.sniffing import content_matches_extension
+        
+        assert content_matches_extension('.png', b'\x89PNG\r\n\x1a\n' + b'\x00' * 16)
+        assert content_matches_extension('.JPG', b'\xff\xd8\xff\xe0')
+        assert content_matches_extension('.txt', 'héllo wörld'.encode('utf-8')[:-1])
+        assert content_matches_extension('.txt', b'')
+        assert content_matches_extension('.csv', 'naïve;café;Größe\r\n'.encode('latin-1'))
+        assert content_matches_extension('.txt', '“quoted” – dash'.encode('cp1252'))
+        
+        # An executable renamed to look harmless
+        executable = b'MZ\x90\x00\x03\x00\x00\x00'
+        assert not content_matches_extension('.png', executable)
+        assert not content_matches_extension('.txt', executable)
+        assert not content_matches_extension('.csv', b'\x7fELF\x02\x01\x01')
+        pe_header = bytearray(b'MZ' + b'A' * 0x7E)
+        pe_header[0x3C:0x40] = (0x40).to_bytes(4, 'little')
+        pe_header[0x40:0x44] = b'PE\x00\x00'
+        assert not content_matches_extension('.js', bytes(pe_header))
+        # Text that merely starts with "MZ" is still text
+        assert content_matches_extension('.js', b'MZ' + b'A' * 50)
+        assert content_matches_extension('.csv', b'MZ Kennedy;Boston;42\r\n' * 4)
+        assert not content_matches_extension('.pdf', b'')
+    
+    def test_latin1_csv_upload_succeeds(self):
+        """Test that a CSV exported in Latin-1 is uploaded, not rejected by sniffing"""
+        import asyncio
+        import io
+        from fastapi import UploadFile
+        from starlette.datastructures import Headers
+        from backend.app.routes import files as files_routes
+        from backend.app.middleware.auth import AuthUser
+        from backend.app.services.concurrency import AsyncService
+        
+        user = AuthUser(uid="user-1", email="u@example.com", user_type="user")
+        storage_fake = Mock()
+        storage_fake.upload_stream.return_value = {
+            'gcs_path': 'user-1/export.csv', 'size': 32, 'md5_hash': 'm', 'crc32c': 'c'
+        }
+        firestore_fake = Mock()
+        firestore_fake.commit_file_changes.return_value = ['file-1']
+        quota_fake = Mock()
+        quota_fake.reserve.return_value = 'r1'
+        dedup_fake = Mock()
+        dedup_fake.store_upload.return_value = {'gcs_path': 'user-1/export.csv'}
+        
+        content = 'Nom;Préférence;Größe\r\nÉlodie;café;3\r\n'.encode('latin-1')
+        upload = UploadFile(
+            file=io.BytesIO(content), filename="export.csv", size=len(content),
+            headers=Headers({'content-type': 'text/csv'})
+        )
+        with patch.object(files_routes, 'storage_service', AsyncService(storage_fake)), \
+             patch.object(files_routes, 'firestore_service', AsyncService(firestore_fake)), \
+             patch.object(files_routes, 'quota_service', AsyncService(quota_fake)), \
+             patch.object(files_routes, 'dedup_service', AsyncService(dedup_fake)), \
+             patch.object(files_routes, 'thumbnail_service', Mock()):
+            response = asyncio.run(files_routes.upload_file(file=upload, current_user=user))
+        
+        assert response.file_id == 'file-1'
+        storage_fake.upload_stream.assert_called_once()
+    
+    def test_mismatched_upload_rejected_before_storage(self):
+        """Test that an upload failing the sniff check never reaches GCS"""
+        import asyncio
+        import io
+        from fastapi import HTTPException, UploadFile
+        from backend.app.routes import files
+        
+        upload = UploadFile(file=io.BytesIO(b'MZ\x90\x00' * 100), filename="photo.png")
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(files.validate_file(upload))
+        assert error.value.status_code == 400
+        
+        upload = UploadFile(file=io.BytesIO(b'\x89PNG\r\n\x1a\n' + b'\x00' * 5000), filename="photo.png")
+        asyncio.run(files.validate_file(upload))
+        # The stream is rewound for the upload itself
+        assert upload.file.tell() == 0
+
+class TestStreamingUpload:
+    """Test chunked streaming uploads to GCS"""
+    
+    def _make_service(self):
+        from backend.app.services.storage import StorageService
+        service = StorageService.__new__(StorageService)
+        service.bucket = Mock()
+        writer = Mock()
+        writer.closed = False
+        service.bucket.blob.return_value.open.return_value = writer
+        return service, writer
+    
+    def test_upload_stream_writes_in_chunks(self):
+        """Test that files are written chunk by chunk and the size and checksums are computed"""
+        import base64
+        import hashlib
+        import io
+        from backend.app.services.storage import UPLOAD_CHUNK_SIZE
+        service, writer = self._make_service()
+        data = b"x" * (UPLOAD_CHUNK_SIZE * 2 + 10)
+        
+        result = service.upload_stream(io.BytesIO(data), "report.pdf", "application/pdf", "user-1", sha256=True)
+        
+        assert result['size'] == len(data)
+        assert result['sha256'] == hashlib.sha256(data).hexdigest()
+        assert result['md5_hash'] == base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+        assert result['gcs_path'].startswith("user-1/") and result['gcs_path'].endswith(".pdf")
+        assert writer.write.call_count == 3
+        writer.close.assert_called_once()
+    
+    def test_upload_stream_enforces_size_limit(self):
+        """Test that the size limit is enforced before the upload is finalized"""
+        import io
+        from backend.app.services.storage import FileTooLargeError, UPLOAD_CHUNK_SIZE
+        service, writer = self._make_service()
+        data = b"x" * (UPLOAD_CHUNK_SIZE * 3)
+        
+        with pytest.raises(FileTooLargeError):
+            service.upload_stream(io.BytesIO(data), "big.zip", "application/zip", "user-1",
+                                  max_size=UPLOAD_CHUNK_SIZE)
+        
+        assert writer.write.call_count == 1
+        writer.close.assert_not_called()
+    
+    def test_crc32c_matches_gcs_encoding(self):
+        """Test that the CRC32C is the base64 big-endian form GCS reports"""
+        from backend.app.services.storage import UploadChecksums
+        
+        checksums = UploadChecksums()
+        checksums.update(b"123456789")
+        
+        # 0xE3069283 is the CRC32C check value for "123456789"
+        assert checksums.result()['crc32c'] == "4waSgw=="
+        assert 'sha256' not in checksums.result()
+    
+    @pytest.mark.slow
+    def test_checksum_throughput(self):
+        """Benchmark in-stream hashing against a single upload stream's bandwidth"""
+        import time
+        from backend.app.services.storage import UploadChecksums, UPLOAD_CHUNK_SIZE
+        
+        chunk = os.urandom(UPLOAD_CHUNK_SIZE)
+        total = 256 * 1024 * 1024
+        checksums = UploadChecksums()
+        started = time.perf_counter()
+        for _ in range(total // UPLOAD_CHUNK_SIZE):
+            checksums.update(chunk)
+        checksums.result()
+        throughput = total / (time.perf_counter() - started) / (1024 * 1024)
+        print(f"MD5 + CRC32C: {throughput:.0f} MB/s")
+        
+        # A single resumable upload rarely exceeds ~100 MB/s, so hashing must
+        # stay well clear of that to be invisible in upload throughput
+        assert throughput > 200
+
+class TestAsyncServiceLayer:
+    """Test that blocking service calls run off the event loop"""
+    
+    def _peak_concurrency(self, concurrency, barrier=None):
+        """Run a burst of concurrent blocking calls and return how many were ever active at once"""
+        import asyncio
+        import threading
+        from backend.app.services.concurrency import AsyncService
+        
+        class TrackingService:
+            def __init__(self):
+                self.lock = threading.Lock()
+                self.active = 0
+                self.peak = 0
+            
+            def blocking_call(self):
+                with self.lock:
+                    self.active += 1
+                    self.peak = max(self.peak, self.active)
+                try:
+                    # Only released once every call is in flight at the same time
+                    if barrier is not None:
+                        barrier.wait()
+                    return True
+                finally:
+                    with self.lock:
+                        self.active -= 1
+        
+        tracker = TrackingService()
+        service = AsyncService(tracker)
+        
+        async def burst():
+            return await asyncio.gather(*(service.blocking_call() for _ in range(concurrency)))
+        
+        assert all(asyncio.run(burst()))
+        return tracker.peak
+    
+    def test_concurrent_calls_overlap_on_thread_pool(self):
+        """Test that concurrent blocking calls overlap on the thread pool"""
+        import threading
+        
+        # A broken barrier (timeout) means the calls did not all overlap
+        barrier = threading.Barrier(8, timeout=5)
+        assert self._peak_concurrency(8, barrier) == 8
+        assert not barrier.broken
+    
+    def test_calls_serialize_without_thread_pool(self):
+        """Test that inline calls serialize, for comparison with the pool"""
+        from backend.app.services import concurrency
+        with patch.object(concurrency, '_executor', None):
+            assert self._peak_concurrency(8) == 1
+
+class TestBatchUpload:
+    """Test concurrent processing of batch uploads"""
+    
+    def test_memory_budget_limits_in_flight_bytes(self):
+        """Test that reservations wait until enough of the budget is released"""
+        import asyncio
+        from backend.app.services.concurrency import MemoryBudget
+        
+        async def scenario():
+            budget = MemoryBudget(100)
+            peak = 0
+            
+            async def worker():
+                nonlocal peak
+                async with budget.reserve(60):
+                    peak = max(peak, budget.in_use)
+                    await asyncio.sleep(0.01)
+            
+            await asyncio.gather(*(worker() for _ in range(4)))
+            return peak, budget.in_use
+        
+        peak, in_use = asyncio.run(scenario())
+        assert peak == 60
+        assert in_use == 0
+    
+    def test_batch_runs_files_concurrently_and_keeps_order(self):
+        """Test that batch files upload concurrently and results keep request order"""
+        import asyncio
+        import io
+        import threading
+        from starlette.datastructures import UploadFile, Headers
+        from backend.app.routes import files as files_routes
+        from backend.app.middleware.auth import AuthUser
+        from backend.app.services.concurrency import AsyncService, MemoryBudget
+        
+        # Only released once all eight valid files are uploading at the same time
+        barrier = threading.Barrier(8, timeout=5)
+        
+        class SlowStorage:
+            def upload_stream(self, file_obj, file_name, content_type, user_id, max_size=None, sha256=False):
+                barrier.wait()
+                return {'gcs_path': f"{user_id}/{file_name}", 'size': len(file_obj.read()),
+                        'md5_hash': "md5", 'crc32c': "crc32c"}
+        
+        class SlowFirestore:
+            def __init__(self):
+                self.commits = 0
+            
+            def commit_file_changes(self, created=None, deleted=None, reservation=None):
+                self.commits += 1
+                return [f"id-{file_data['file_name']}" for file_data in created]
+        
+        class FakeQuota:
+            def reserve(self, uid, file_count, byte_count=0):
+                return "reservation-1"
+            
+            def release(self, uid, reservation_id):
+                return True
+        
+        firestore_fake = SlowFirestore()
+        
+        def make_file(name, content_type='text/plain'):
+            return UploadFile(file=io.BytesIO(b"data"), filename=name, size=4,
+                              headers=Headers({'content-type': content_type}))
+        
+        uploads = [make_file(f"file{i}.txt") for i in range(8)]
+        uploads.insert(3, make_file("bad.exe"))
+        user = AuthUser(uid="user-1", email="u@example.com", user_type="user")
+        
+        with patch.object(files_routes, 'storage_service', AsyncService(SlowStorage())), \
+             patch.object(files_routes, 'firestore_service', AsyncService(firestore_fake)), \
+             patch.object(files_routes, 'quota_service', AsyncService(FakeQuota())), \
+             patch.object(files_routes, 'upload_memory_budget', MemoryBudget(1024 * 1024)), \
+             patch.object(files_routes, 'BATCH_UPLOAD_CONCURRENCY', 8):
+            response = asyncio.run(files_routes.upload_batch_files(files=uploads, current_user=user))
+        
+        assert not barrier.broken
+        assert response.total_files == 9
+        assert response.successful_count == 8
+        assert [u.file_id for u in response.successful_uploads] == [f"id-file{i}.txt" for i in range(8)]
+        assert response.failed_uploads[0]['file_name'] == "bad.exe"
+        assert firestore_fake.commits == 1
+
+class TestResumableUpload:
+    """Test the chunked resumable upload protocol"""
+    
+    def test_persisted_offset_from_gcs_response(self):
+        """Test that GCS status codes and Range headers map to stored offsets"""
+        from backend.app.services.storage import StorageService
+        
+        assert StorageService._persisted_offset(Mock(status_code=308, headers={'Range': 'bytes=0-262143'}), 10**6) == 262144
+        assert StorageService._persisted_offset(Mock(status_code=308, headers={}), 10**6) == 0
+        assert StorageService._persisted_offset(Mock(status_code=200, headers={}), 10**6) == 10**6
+        with pytest.raises(Exception):
+            StorageService._persisted_offset(Mock(status_code=410, headers={}, text='gone'), 10**6)
+    
+    def test_session_requests_use_authorized_session(self):
+        """Test that resumable session calls go through the service's own authorized session"""
+        from backend.app.services.storage import StorageService
+        
+        service = StorageService.__new__(StorageService)
+        service.http = Mock()
+        service.http.put.return_value = Mock(status_code=308, headers={'Range': 'bytes=0-524287'})
+        
+        assert service.write_resumable_chunk('https://gcs/session', 262144, b'x' * 262144, 10**6) == 524288
+        assert service.http.put.call_args[1]['headers'] == {'Content-Range': 'bytes 262144-524287/1000000'}
+        service.cancel_resumable_session('https://gcs/session')
+        service.http.delete.assert_called_once_with('https://gcs/session')
+    
+    def test_patch_forwards_aligned_chunks(self):
+        """Test that chunks go to GCS aligned, the unaligned tail is left out and offsets are checked"""
+        import asyncio
+        from fastapi import HTTPException
+        from starlette.requests import Request
+        from backend.app.routes import files as files_routes
+        from backend.app.middleware.auth import AuthUser
+        from backend.app.services.concurrency import AsyncService
+        
+        stored = {'offset': 0}
+        writes = []
+        
+        def write_resumable_chunk(uri, offset, data, size):
+            writes.append((offset, len(data)))
+            stored['offset'] = offset + len(data)
+            return stored['offset']
+        storage_fake = Mock()
+        storage_fake.resumable_offset.side_effect = lambda uri, size: stored['offset']
+        storage_fake.write_resumable_chunk.side_effect = write_resumable_chunk
+        firestore_fake = Mock()
+        firestore_fake.get_upload_session.return_value = {
+            'user_id': 'user-1', 'resumable_uri': 'https://gcs/session', 'file_size': 100,
+            'expires_at': datetime(2999, 1, 1)
+        }
+        firestore_fake.claim_upload_session.return_value = firestore_fake.get_upload_session.return_value
+        user = AuthUser(uid="user-1", email="u@example.com", user_type="user")
+        
+        def patch_request(offset, body_parts):
+            messages = [{'type': 'http.request', 'body': part, 'more_body': True} for part in body_parts]
+            messages.append({'type': 'http.request', 'body': b'', 'more_body': False})
+            
+            async def receive():
+                return messages.pop(0)
+            headers = [(b'content-type', b'application/offset+octet-stream'), (b'upload-offset', str(offset).encode())]
+            request = Request({'type': 'http', 'method': 'PATCH', 'headers': headers}, receive)
+            return asyncio.run(files_routes.patch_resumable_upload("s1", request, current_user=user))
+        
+        with patch.object(files_routes, 'storage_service', AsyncService(storage_fake)), \
+             patch.object(files_routes, 'firestore_service', AsyncService(firestore_fake)), \
+             patch.object(files_routes, 'RESUMABLE_CHUNK_SIZE', 8), \
+             patch.object(files_routes, 'RESUMABLE_ALIGNMENT', 4):
+            response = patch_request(0, [b'x' * 7, b'x' * 14])
+            assert response.headers['upload-offset'] == "20"
+            assert writes == [(0, 8), (8, 8), (16, 4)]
+            
+            with pytest.raises(HTTPException) as error:
+                patch_request(0, [b'x'])
+            assert error.value.status_code == 409
+            assert error.value.headers['Upload-Offset'] == "20"
+            
+            # The end of the file is sent whatever its length
+            response = patch_request(20, [b'x' * 80])
+            assert response.headers['upload-offset'] == "100"
+            assert writes[-1] == (92, 8)
+        
+        # Every PATCH held the session while it wrote and let it go afterwards
+        assert firestore_fake.claim_upload_session.call_args[0][2] == 'uploading'
+        assert firestore_fake.release_upload_session_claim.call_count == firestore_fake.claim_upload_session.call_count == 3
+    
+    def test_concurrent_patch_is_refused(self):
+        """Test that a PATCH arriving while another one writes gets 409 and writes nothing"""
+        import asyncio
+        from fastapi import HTTPException
+        from starlette.requests import Request
+        from backend.app.routes import files as files_routes
+        from backend.app.middleware.auth import AuthUser
+        from backend.app.services.concurrency import AsyncService
+        
+        storage_fake = Mock()
+        firestore_fake = Mock()
+        firestore_fake.get_upload_session.return_value = {
+            'user_id': 'user-1', 'resumable_uri': 'https://gcs/session', 'file_size': 100,
+            'expires_at': datetime(2999, 1, 1)
+        }
+        # The other PATCH claimed the session after this one loaded it
+        firestore_fake.claim_upload_session.side_effect = files_routes.UploadSessionClaimedError("Upload is already uploading")
+        user = AuthUser(uid="user-1", email="u@example.com", user_type="user")
+        headers = [(b'content-type', b'application/offset+octet-stream'), (b'upload-offset', b'0')]
+        request = Request({'type': 'http', 'method': 'PATCH', 'headers': headers})
+        
+        with patch.object(files_routes, 'storage_service', AsyncService(storage_fake)), \
+             patch.object(files_routes, 'firestore_service', AsyncService(firestore_fake)):
+            with pytest.raises(HTTPException) as error:
+                asyncio.run(files_routes.patch_resumable_upload("s1", request, current_user=user))
+        
+        assert error.value.status_code == 409
+        storage_fake.resumable_offset.assert_not_called()
+        storage_fake.write_resumable_chunk.assert_not_called()
+        firestore_fake.release_upload_session_claim.assert_not_called()
+    
+    def test_chunk_size_is_aligned(self):
+        """Test that a configured chunk size is rounded down to the GCS alignment"""
+        from backend.app.services.storage import aligned_chunk_size, RESUMABLE_ALIGNMENT, RESUMABLE_CHUNK_SIZE
+        
+        assert aligned_chunk_size(5000000) == 19 * RESUMABLE_ALIGNMENT
+        assert aligned_chunk_size(1000) == RESUMABLE_ALIGNMENT
+        assert RESUMABLE_CHUNK_SIZE % RESUMABLE_ALIGNMENT == 0
+    
+    def test_finalizing_upload_refuses_chunks_and_cancel(self):
+        """Test that a claimed resumable upload takes no more chunks and cannot be cancelled"""
+        import asyncio
+        from fastapi import HTTPException
+        from starlette.requests import Request
+        from backend.app.routes import files as files_routes
+        from backend.app.middleware.auth import AuthUser
+        from backend.app.services.concurrency import AsyncService
+        
+        storage_fake = Mock()
+        firestore_fake = Mock()
+        firestore_fake.get_upload_session.return_value = {
+            'user_id': 'user-1', 'resumable_uri': 'https://gcs/session', 'file_size': 100,
+            'expires_at': datetime(2999, 1, 1), 'status': 'finalizing', 'claimed_at': datetime.utcnow()
+        }
+        user = AuthUser(uid="user-1", email="u@example.com", user_type="user")
+        headers = [(b'content-type', b'application/offset+octet-stream'), (b'upload-offset', b'0')]
+        request = Request({'type': 'http', 'method': 'PATCH', 'headers': headers})
+        
+        with patch.object(files_routes, 'storage_service', AsyncService(storage_fake)), \
+             patch.object(files_routes, 'firestore_service', AsyncService(firestore_fake)):
+            for call in (files_routes.patch_resumable_upload("s1", request, current_user=user),
+                         files_routes.cancel_resumable_upload("s1", current_user=user)):
+                with pytest.raises(HTTPException) as error:
+                    asyncio.run(call)
+                assert error.value.status_code == 409
+        
+        storage_fake.write_resumable_chunk.assert_not_called()
+        storage_fake.cancel_resumable_session.assert_not_called()
+
+class TestQuotaReservation:
+    """Test transactional quota reservations"""
+    
+    def _reserve(self, user_data, file_count):
+        from backend.app.services import quota
+        
+        snapshot = Mock(exists=True)
+        snapshot.to_dict.return_value = user_data
+        db = Mock()
+        db.collection.return_value.document.return_value.get.return_value = snapshot
+        transaction = Mock()
+        db.transaction.return_value = transaction
+        
+        with patch.object(quota, 'get_firestore_client', return_value=db), \
+             patch.object(quota.firestore, 'transactional', lambda func: func):
+            reservation_id = quota.QuotaService.reserve("user-1", file_count, 10)
+        updates = transaction.update.call_args[0][1]
+        return reservation_id, updates
+    
+    def test_active_reservations_count_against_limit(self):
+        """Test that unexpired reservations use up the limit and expired ones do not"""
+        import time
+        from backend.app.services.quota import QuotaExceededError
+        
+        now = time.time()
+        user_data = {
+            'fileCount': 7,
+            'fileLimit': 10,
+            'reservations': {
+                'active': {'files': 2, 'bytes': 0, 'expires_at': now + 60},
+                'stale': {'files': 5, 'bytes': 0, 'expires_at': now - 60}
+            }
+        }
+        
+        reservation_id, updates = self._reserve(user_data, 1)
+        assert updates[f'reservations.{reservation_id}']['files'] == 1
+        assert 'reservations.stale' in updates
+        assert 'reservations.active' not in updates
+        
+        with pytest.raises(QuotaExceededError):
+            self._reserve(user_data, 2)
+
+class TestUploadSessionClaims:
+    """Test that an upload session is finalized at most once"""
+    
+    def _claim(self, session):
+        from backend.app.services import firestore as firestore_module
+        
+        snapshot = Mock(exists=True)
+        snapshot.to_dict.side_effect = lambda: dict(session)
+        db = Mock()
+        db.collection.return_value.document.return_value.get.return_value = snapshot
+        transaction = Mock()
+        transaction.update.side_effect = lambda ref, updates: session.update(updates)
+        db.transaction.return_value = transaction
+        
+        with patch.object(firestore_module, 'get_firestore_client', return_value=db), \
+             patch.object(firestore_module.firestore, 'transactional', lambda func: func):
+            return firestore_module.FirestoreService.claim_upload_session("s1", "user-1")
+    
+    def test_session_is_claimed_once(self):
+        """Test that a second claim is refused until the first one goes stale"""
+        from backend.app.services.firestore import UploadSessionClaimedError, UPLOAD_SESSION_CLAIM_TTL
+        session = {'user_id': 'user-1', 'expires_at': datetime(2999, 1, 1)}
+        
+        self._claim(session)
+        assert session['status'] == 'finalizing'
+        with pytest.raises(UploadSessionClaimedError):
+            self._claim(session)
+        
+        session['claimed_at'] = datetime.utcnow() - timedelta(seconds=UPLOAD_SESSION_CLAIM_TTL + 1)
+        self._claim(session)
+    
+    def test_expired_and_foreign_sessions_are_refused(self):
+        """Test that expired sessions and other users' sessions cannot be claimed"""
+        from backend.app.services.firestore import UploadSessionExpiredError
+        
+        with pytest.raises(UploadSessionExpiredError):
+            self._claim({'user_id': 'user-1', 'expires_at': datetime(2000, 1, 1)})
+        with pytest.raises(PermissionError):
+            self._claim({'user_id': 'user-2', 'expires_at': datetime(2999, 1, 1)})
+    
+    def test_retried_finalize_creates_one_record(self):
+        """Test that the session is deleted with the record and a second finalize gets 409"""
+        import asyncio
+        from fastapi import HTTPException
+        from backend.app.routes import files as files_routes
+        from backend.app.middleware.auth import AuthUser
+        from backend.app.services.concurrency import AsyncService
+        
+        session = {
+            'user_id': 'user-1', 'file_name': 'notes.txt', 'content_type': 'text/plain',
+            'gcs_path': 'user-1/notes.txt', 'reservation_id': 'r1', 'expires_at': datetime(2999, 1, 1)
+        }
+        firestore_fake = Mock()
+        firestore_fake.claim_upload_session.side_effect = [session, files_routes.UploadSessionClaimedError()]
+        firestore_fake.commit_file_changes.return_value = ['file-1']
+        storage_fake = Mock()
+        storage_fake.get_file_info.return_value = {
+            'size': 5, 'content_type': 'text/plain', 'md5_hash': 'm', 'crc32c': 'c'
+        }
+        storage_fake.read_head.return_value = b'hello'
+        user = AuthUser(uid="user-1", email="u@example.com", user_type="user")
+        
+        with patch.object(files_routes, 'firestore_service', AsyncService(firestore_fake)), \
+             patch.object(files_routes, 'storage_service', AsyncService(storage_fake)), \
+             patch.object(files_routes, 'thumbnail_service', Mock()):
+            response = asyncio.run(files_routes.finalize_upload_session("s1", current_user=user))
+            with pytest.raises(HTTPException) as error:
+                asyncio.run(files_routes.finalize_upload_session("s1", current_user=user))
+        
+        assert response.file_id == 'file-1'
+        assert error.value.status_code == 409
+        firestore_fake.commit_file_changes.assert_called_once()
+        assert firestore_fake.commit_file_changes.call_args[1]['upload_session_id'] == 's1'
+        firestore_fake.release_upload_session_claim.assert_not_called()
+
+    def test_sweep_cleans_up_expired_sessions(self):
+        """Test that abandoned sessions lose their object, GCS session and reservation"""
+        import asyncio
+        from backend.app.routes import files as files_routes
+        from backend.app.services.concurrency import AsyncService
+        
+        firestore_fake = Mock()
+        firestore_fake.get_expired_upload_sessions.return_value = [
+            {'id': 's1', 'user_id': 'user-1', 'gcs_path': 'user-1/a.txt', 'reservation_id': 'r1'},
+            {'id': 's2', 'user_id': 'user-1', 'gcs_path': 'user-1/b.txt', 'reservation_id': 'r2',
+             'resumable_uri': 'https://gcs/session'},
+            {'id': 's3', 'user_id': 'user-1', 'gcs_path': 'user-1/c.txt', 'reservation_id': 'r3',
+             'claimed_at': datetime.utcnow()}
+        ]
+        storage_fake = Mock()
+        quota_fake = Mock()
+        
+        with patch.object(files_routes, 'firestore_service', AsyncService(firestore_fake)), \
+             patch.object(files_routes, 'storage_service', AsyncService(storage_fake)), \
+             patch.object(files_routes, 'quota_service', AsyncService(quota_fake)):
+            swept = asyncio.run(files_routes.sweep_expired_upload_sessions())
+        
+        assert swept == 2
+        storage_fake.cancel_resumable_session.assert_called_once_with('https://gcs/session')
+        assert [c[0][0] for c in storage_fake.delete_file.call_args_list] == ['user-1/a.txt', 'user-1/b.txt']
+        assert [c[0][1] for c in quota_fake.release.call_args_list] == ['r1', 'r2']
+        assert [c[0][0] for c in firestore_fake.delete_upload_session.call_args_list] == ['s1', 's2']
+
+class TestDedupStorage:
+    """Test content-addressed storage with reference counting"""
+    
+    def test_duplicate_upload_reuses_stored_content(self):
+        """Test that an upload of known content drops its copy and points at the shared blob"""
+        from backend.app.services import dedup
+        from backend.app.services.storage import StorageService
+        
+        storage = Mock()
+        storage.content_path.side_effect = lambda sha256: StorageService.content_path(None, sha256)
+        upload = {'gcs_path': 'user-1/abc.txt', 'size': 4, 'sha256': 'f' * 64}
+        
+        with patch.object(dedup, 'DEDUP_STORAGE', True), \
+             patch.object(dedup.BlobRefService, 'acquire', return_value=False):
+            fields = dedup.DedupService(storage).store_upload(upload)
+        
+        assert fields == {'gcs_path': 'blobs/' + 'f' * 64, 'content_hash': 'f' * 64}
+        storage.delete_file.assert_called_once_with('user-1/abc.txt')
+        storage.store_content.assert_not_called()
+    
+    def test_blob_deleted_only_with_last_reference(self):
+        """Test that shared content survives until its refcount reaches zero"""
+        from backend.app.services import dedup
+        
+        storage = Mock()
+        service = dedup.DedupService(storage)
+        file_data = {'gcs_path': 'blobs/abc', 'content_hash': 'abc'}
+        
+        with patch.object(dedup.BlobRefService, 'release', return_value=(False, None)):
+            assert service.release_content(file_data)
+        storage.delete_file.assert_not_called()
+        
+        with patch.object(dedup.BlobRefService, 'release', return_value=(True, 7)):
+            service.release_content(file_data)
+        storage.delete_file.assert_any_call('blobs/abc.thumb.jpg')
+        storage.delete_file.assert_called_with('blobs/abc', if_generation_match=7)
+
+class TestZipArchive:
+    """Test streamed ZIP archives"""
+    
+    def test_archive_streams_files_with_bounded_prefetch(self):
+        """Test that the archive is valid and reads stay a bounded distance ahead of the output"""
+        import io
+        import threading
+        import zipfile
+        from backend.app.services import archive
+        
+        contents = {f"user-1/{i}.bin": os.urandom(1000 + i) for i in range(6)}
+        produced = 0
+        consumed = 0
+        max_ahead = 0
+        lock = threading.Lock()
+        
+        class FakeStorage:
+            def iter_chunks(self, gcs_path, chunk_size):
+                nonlocal produced
+                data = contents[gcs_path]
+                for start in range(0, len(data), chunk_size):
+                    with lock:
+                        produced += 1
+                    yield data[start:start + chunk_size]
+        
+        files_data = [
+            {'id': str(i), 'file_name': "same.bin" if i < 2 else f"{i}.bin", 'gcs_path': path,
+             'file_size': len(data), 'uploaded_at': datetime(2024, 1, 2, 3, 4, 5)}
+            for i, (path, data) in enumerate(contents.items())
+        ]
+        
+        output = io.BytesIO()
+        with patch.object(archive, 'ZIP_READ_CHUNK_SIZE', 100), \
+             patch.object(archive, 'ZIP_PREFETCH_FILES', 2), \
+             patch.object(archive, 'ZIP_PREFETCH_CHUNKS', 2):
+            for piece in archive.ArchiveService(FakeStorage()).stream_zip(archive.archive_entries(files_data)):
+                output.write(piece)
+                if piece:
+                    with lock:
+                        consumed += 1
+                        max_ahead = max(max_ahead, produced - consumed)
+        
+        with zipfile.ZipFile(output) as result:
+            assert result.namelist() == ["same.bin", "same (1).bin", "2.bin", "3.bin", "4.bin", "5.bin"]
+            for name, data in zip(result.namelist(), contents.values()):
+                assert result.read(name) == data
+        # Two files prefetching, each with at most two queued chunks plus one in hand
+        assert max_ahead <= 2 * (2 + 1) + 1
+
+    def test_zip_without_body_archives_whole_library(self):
+        """Test that a POST with no body at all archives every file of the user"""
+        import sys
+        from backend.app.middleware.auth import AuthUser
+        
+        # The app's routes are imported as app.*, not backend.app.*
+        live_routes = sys.modules['app.routes.files']
+        live_auth = sys.modules['app.middleware.auth']
+        firestore_fake = Mock()
+        firestore_fake.get_user_files.return_value = []
+        archive_fake = Mock()
+        archive_fake.stream_zip.return_value = iter([b'PK\x05\x06' + b'\x00' * 18])
+        
+        app.dependency_overrides[live_auth.get_current_user] = lambda: AuthUser(uid="user-1", email="u@example.com", user_type="user")
+        try:
+            with patch.object(live_routes, 'firestore_service', live_routes.AsyncService(firestore_fake)), \
+                 patch.object(live_routes, 'archive_service', archive_fake):
+                response = client.post("/api/files/download-zip")
+        finally:
+            app.dependency_overrides.clear()
+        
+        assert response.status_code == 200
+        assert response.headers['content-type'] == 'application/zip'
+        firestore_fake.get_user_files.assert_called_once_with("user-1")
+
+class TestProxiedDownload:
+    """Test downloads streamed through the backend"""
+    
+    def test_parse_range(self):
+        """Test single, open-ended, suffix, ignored and unsatisfiable ranges"""
+        from backend.app.services.downloads import parse_range, RangeNotSatisfiableError
+        
+        assert parse_range("bytes=0-99", 1000) == (0, 99)
+        assert parse_range("bytes=900-", 1000) == (900, 999)
+        assert parse_range("bytes=-100", 1000) == (900, 999)
+        assert parse_range("bytes=500-5000", 1000) == (500, 999)
+        assert parse_range(None, 1000) is None
+        assert parse_range("bytes=0-1,5-9", 1000) is None
+        assert parse_range("items=0-1", 1000) is None
+        with pytest.raises(RangeNotSatisfiableError):
+            parse_range("bytes=1000-", 1000)
+    
+    def test_range_and_conditional_responses(self):
+        """Test 206 streaming in chunks, 304 on a matching ETag and If-Range fallback to 200"""
+        import asyncio
+        from backend.app.services import downloads
+        
+        content = bytes(range(256)) * 40
+        storage_fake = Mock()
+        storage_fake.get_object_info.return_value = {
+            'size': len(content), 'content_type': 'video/mp4', 'generation': 42,
+            'updated': datetime(2024, 1, 2, 3, 4, 5, 600000, tzinfo=timezone.utc)
+        }
+        reads = []
+        
+        def iter_range(gcs_path, start, end, generation=None, chunk_size=None):
+            for position in range(start, end + 1, chunk_size):
+                reads.append((position, min(position + chunk_size - 1, end), generation))
+                yield content[position:min(position + chunk_size, end + 1)]
+        storage_fake.iter_range.side_effect = iter_range
+        
+        service = downloads.DownloadService(storage_fake)
+        file_data = {'gcs_path': 'u/v.mp4', 'file_name': 'v.mp4', 'content_type': 'video/mp4'}
+        
+        async def body(response):
+            return b''.join([chunk async for chunk in response.body_iterator])
+        
+        with patch.object(downloads, 'DOWNLOAD_CHUNK_SIZE', 1000):
+            response = service.response(file_data, {'range': 'bytes=1000-3499'})
+            assert response.status_code == 206
+            assert response.headers['content-range'] == f"bytes 1000-3499/{len(content)}"
+            assert response.headers['content-length'] == "2500"
+            assert response.headers['etag'] == '"42"'
+            assert response.headers['last-modified'] == "Tue, 02 Jan 2024 03:04:05 GMT"
+            assert asyncio.run(body(response)) == content[1000:3500]
+        assert reads == [(1000, 1999, 42), (2000, 2999, 42), (3000, 3499, 42)]
+        
+        assert service.response(file_data, {'if-none-match': 'W/"41", "42"'}).status_code == 304
+        assert service.response(file_data, {'if-modified-since': "Tue, 02 Jan 2024 03:04:05 GMT"}).status_code == 304
+        stale = service.response(file_data, {'range': 'bytes=0-9', 'if-range': '"41"'})
+        assert stale.status_code == 200
+        assert stale.headers['content-length'] == str(len(content))
+        assert service.response(file_data, {'range': f'bytes={len(content)}-'}).status_code == 416
+
+class TestBulkDelete:
+    """Test bulk deletion of files"""
+    
+    def test_storage_deletes_are_batched(self):
+        """Test that deletes go out in GCS batches and missing objects count as deleted"""
+        from contextlib import contextmanager
+        from google.api_core.exceptions import NotFound, InternalServerError
+        from backend.app.services import storage
+        
+        batches = []
+        single_deletes = []
+        
+        @contextmanager
+        def fake_batch(raise_exception=True):
+            batches.append([])
+            yield Mock()
+            # Like GCS batches, report only that a deferred request failed
+            paths = batches[-1]
+            batches.append(None)
+            if any(path in ("u/bad", "u/gone") for path in paths):
+                raise InternalServerError("batch had failures")
+        
+        service = storage.StorageService.__new__(storage.StorageService)
+        service.client = Mock()
+        service.client.batch.side_effect = fake_batch
+        service.bucket = Mock()
+        
+        def blob(gcs_path):
+            def delete(if_generation_match=None):
+                if batches and batches[-1] is not None:
+                    batches[-1].append(gcs_path)
+                    return
+                single_deletes.append(gcs_path)
+                if gcs_path == "u/gone":
+                    raise NotFound("gone")
+                if gcs_path == "u/bad":
+                    raise InternalServerError("bad")
+            return Mock(delete=delete)
+        service.bucket.blob.side_effect = blob
+        
+        objects = [(f"u/{i}", None) for i in range(150)] + [("u/gone", None), ("u/bad", 3)]
+        with patch.object(storage, 'STORAGE_BATCH_SIZE', 100):
+            failed = service.delete_files(objects)
+        
+        assert service.client.batch.call_count == 2
+        assert failed == ["u/bad"]
+        # Only the chunk whose batch reported a failure is retried one by one
+        assert len(single_deletes) == 52
+    
+    def test_bulk_delete_checks_ownership_and_commits_once(self):
+        """Test that only the caller's files are deleted, in one commit"""
+        import asyncio
+        from backend.app.routes import files as files_routes
+        from backend.app.middleware.auth import AuthUser
+        from backend.app.models.file import FileIdsRequest
+        from backend.app.services.concurrency import AsyncService
+        
+        firestore_fake = Mock()
+        firestore_fake.get_files_by_ids.return_value = {
+            'mine': {'id': 'mine', 'user_id': 'user-1', 'gcs_path': 'user-1/a', 'file_size': 1},
+            'theirs': {'id': 'theirs', 'user_id': 'user-2', 'gcs_path': 'user-2/b', 'file_size': 1}
+        }
+        dedup_fake = Mock()
+        dedup_fake.release_contents.return_value = []
+        user = AuthUser(uid="user-1", email="u@example.com", user_type="user")
+        
+        with patch.object(files_routes, 'firestore_service', AsyncService(firestore_fake)), \
+             patch.object(files_routes, 'dedup_service', AsyncService(dedup_fake)):
+            response = asyncio.run(files_routes.bulk_delete_files(
+                FileIdsRequest(file_ids=['mine', 'theirs', 'missing']), current_user=user
+            ))
+        
+        assert response.deleted == ['mine']
+        assert set(response.errors) == {'theirs', 'missing'}
+        firestore_fake.commit_file_changes.assert_called_once()
+        deleted = firestore_fake.commit_file_changes.call_args[1]['deleted']
+        assert [f['id'] for f in deleted] == ['mine']
+
+class TestUserPurge:
+    """Test the background user purge job"""
+    
+    def test_purge_deletes_records_objects_and_user(self):
+        """Test that a purge pages through records, clears the prefix and removes the user"""
+        from backend.app.services import purge
+        
+        def record(i):
+            return Mock(id=f"f{i}", to_dict=Mock(return_value={'user_id': 'user-1', 'file_size': 10, 'gcs_path': f"user-1/{i}"}))
+        
+        pages = [[record(i) for i in range(3)], [record(3)], []]
+        db = Mock()
+        collections = {name: Mock() for name in ('files', 'purge_jobs', 'users', 'upload_sessions')}
+        db.collection.side_effect = lambda name: collections[name]
+        collections['files'].where.return_value.limit.return_value.stream.side_effect = pages
+        collections['upload_sessions'].where.return_value.stream.return_value = []
+        job_ref = collections['purge_jobs'].document.return_value
+        job_ref.collection.return_value.stream.return_value = []
+        job_ref.collection.return_value.limit.return_value.stream.return_value = []
+        job_ref.get.return_value.to_dict.return_value = {
+            'user_id': 'user-1', 'status': 'running', 'phase': 'records',
+            'files_deleted': 0, 'objects_deleted': 0, 'bytes_deleted': 0, 'was_admin': False
+        }
+        storage = Mock()
+        storage.delete_prefix.return_value = (4, [])
+        
+        with patch.object(purge, 'get_firestore_client', return_value=db), \
+             patch.object(purge.FirestoreService, 'commit_file_changes') as commit:
+            purge.PurgeService(storage).run('user-1')
+        
+        assert commit.call_count == 2
+        assert all(call[1]['update_owners'] is False for call in commit.call_args_list)
+        assert storage.delete_prefix.call_args[0][0] == "user-1/"
+        collections['users'].document.return_value.delete.assert_called_once()
+        final_job = job_ref.set.call_args[0][0]
+        assert final_job['status'] == 'completed'
+        assert final_job['files_deleted'] == 4
+        assert final_job['bytes_deleted'] == 40
+
+    def test_release_resumes_after_crash_between_delete_and_release(self):
+        """Test that shared content of records deleted before a crash is released on resume"""
+        from backend.app.services import purge
+        
+        shared_record = Mock(id="f1", to_dict=Mock(return_value={
+            'user_id': 'user-1', 'file_size': 10, 'gcs_path': 'blobs/abc', 'content_hash': 'abc'
+        }))
+        db = Mock()
+        collections = {name: Mock() for name in ('files', 'purge_jobs', 'users', 'upload_sessions')}
+        db.collection.side_effect = lambda name: collections[name]
+        collections['files'].where.return_value.limit.return_value.stream.side_effect = [[shared_record], []]
+        collections['upload_sessions'].where.return_value.stream.return_value = []
+        job_ref = collections['purge_jobs'].document.return_value
+        job_ref.get.return_value.to_dict.side_effect = lambda: {
+            'user_id': 'user-1', 'status': 'running', 'phase': 'records',
+            'files_deleted': 0, 'objects_deleted': 0, 'bytes_deleted': 0, 'was_admin': False
+        }
+        
+        # Release markers, as stored under the job
+        markers = {}
+        releases = job_ref.collection.return_value
+        releases.document.side_effect = lambda file_id: Mock(id=file_id)
+        marker_docs = lambda: [
+            Mock(id=file_id, reference=Mock(id=file_id), to_dict=Mock(return_value=data))
+            for file_id, data in markers.items()
+        ]
+        releases.stream.side_effect = marker_docs
+        releases.limit.return_value.stream.side_effect = marker_docs
+        writer = Mock()
+        writer.set.side_effect = lambda ref, data: markers.__setitem__(ref.id, data)
+        
+        released = []
+        
+        def release_marked_contents(marks):
+            if not released:
+                released.append(None)
+                raise RuntimeError("instance stopped")
+            for mark in marks:
+                released.append(mark['content_hash'])
+                markers.pop(mark['marker'].id)
+            return []
+        
+        storage = Mock()
+        storage.delete_prefix.return_value = (0, [])
+        with patch.object(purge, 'get_firestore_client', return_value=db), \
+             patch.object(purge.FirestoreService, 'commit_file_changes') as commit, \
+             patch.object(purge.FirestoreService, 'batch_writer', return_value=writer):
+            service = purge.PurgeService(storage)
+            service.dedup = Mock()
+            service.dedup.release_marked_contents.side_effect = release_marked_contents
+            
+            service.run('user-1')
+            assert job_ref.update.call_args[0][0]['status'] == 'failed'
+            assert commit.call_count == 1
+            assert list(markers) == ['f1']
+            
+            service.run('user-1')
+        
+        assert released == [None, 'abc']
+        assert markers == {}
+        assert job_ref.set.call_args[0][0]['status'] == 'completed'
+    
+    def test_marked_release_drops_each_reference_once(self):
+        """Test that repeating a marked release does not drop the reference again"""
+        from backend.app.services import dedup
+        
+        existing = {'releases/f1', 'releases/f2', 'files/f2'}
+        blob = {'refs': 3, 'size': 10, 'generation': 7}
+        db = Mock()
+        blob_ref = db.collection.return_value.document.return_value
+        blob_ref.get.return_value = Mock(exists=True, to_dict=lambda: dict(blob))
+        db.get_all.side_effect = lambda refs, transaction=None: [
+            Mock(reference=ref, exists=ref.path in existing) for ref in refs
+        ]
+        transaction = Mock()
+        transaction.delete.side_effect = lambda ref: existing.discard(ref.path)
+        transaction.update.side_effect = lambda ref, updates: blob.update(updates)
+        db.transaction.return_value = transaction
+        # f1's record is gone; f2's record still exists, so its marker waits
+        marks = [(Mock(path='releases/f1'), Mock(path='files/f1')), (Mock(path='releases/f2'), Mock(path='files/f2'))]
+        
+        with patch.object(dedup, 'get_firestore_client', return_value=db), \
+             patch.object(dedup.firestore, 'transactional', lambda func: func):
+            assert dedup.BlobRefService.release_marked('abc', marks) == (False, None)
+            assert dedup.BlobRefService.release_marked('abc', marks) == (False, None)
+        
+        assert blob['refs'] == 2
+        assert existing == {'releases/f2', 'files/f2'}
+
+class TestThumbnails:
+    """Test preview generation"""
+    
+    def test_image_thumbnail_fits_bounding_box(self):
+        """Test that images are scaled down to fit the preview size and encoded as JPEG"""
+        import io
+        Image = pytest.importorskip("PIL.Image")
+        from backend.app.services.thumbnails import render_image_thumbnail
+        
+        source = io.BytesIO()
+        Image.new('RGBA', (1200, 600), (255, 0, 0, 128)).save(source, format='PNG')
+        
+        preview = render_image_thumbnail(source.getvalue(), size=256)
+        
+        with Image.open(io.BytesIO(preview)) as image:
+            assert image.format == 'JPEG'
+            assert image.size == (256, 128)
+        assert len(preview) < len(source.getvalue())
+    
+    def test_only_previewable_files_are_scheduled(self):
+        """Test that files without a preview type never reach the pools"""
+        from backend.app.services import thumbnails
+        
+        service = thumbnails.ThumbnailService(Mock())
+        with patch.object(thumbnails, 'preview_kind', return_value=None):
+            assert not service.schedule("f1", {'file_name': "notes.txt", 'gcs_path': "u/notes.txt"})
+        assert service._processes is None
+        assert thumbnails.thumbnail_path("u/a.png") == "u/a.png.thumb.jpg"
+
+class TestCaching:
+    """Test in-process caches"""
+    
+    def test_ttl_cache_evicts_least_recently_used(self):
+        """Test that the cache stays bounded and evicts the LRU entry"""
+        from backend.app.services.cache import TTLCache
+        cache = TTLCache(max_size=2, default_ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+        
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+        assert cache.stats()['size'] == 2
+    
+    def test_ttl_cache_expires_entries(self):
+        """Test that entries are dropped once their expiry time has passed"""
+        import time
+        from backend.app.services.cache import TTLCache
+        cache = TTLCache(max_size=10)
+        cache.set('expired', 1, expires_at=time.time() - 1)
+        cache.set('fresh', 2, expires_at=time.time() + 60)
+        
+        assert cache.get('expired') is None
+        assert cache.get('fresh') == 2
+        stats = cache.stats()
+        assert stats['hits'] == 1 and stats['misses'] == 1
+    
+    def test_verified_tokens_are_cached_until_exp(self):
+        """Test that repeat requests with one token verify it only once"""
+        import asyncio
+        import time
+        from backend.app.middleware import auth as auth_module
+        
+        decoded = {'uid': 'user-1', 'exp': time.time() + 3600}
+        with patch.object(auth_module.auth, 'verify_id_token', return_value=decoded) as verify, \
+             patch.object(auth_module, 'token_cache', auth_module.TTLCache(max_size=10)):
+            for _ in range(3):
+                assert asyncio.run(auth_module.verify_token('token-abc')) == decoded
+            
+            assert verify.call_count == 1
+            assert auth_module.token_cache.stats()['hits'] == 2
+    
+    def test_profile_cache_invalidated_on_write(self):
+        """Test that profile reads are cached and admin writes invalidate them"""
+        from backend.app.services import firestore as firestore_module
+        
+        db = Mock()
+        user_doc = db.collection.return_value.document.return_value.get.return_value
+        user_doc.exists = True
+        user_doc.to_dict.return_value = {'email': 'u@example.com', 'fileLimit': 500}
+        
+        with patch.object(firestore_module, 'get_firestore_client', return_value=db), \
+             patch.object(firestore_module, 'profile_cache', firestore_module.TTLCache(max_size=10, default_ttl=60)):
+            service = firestore_module.FirestoreService
+            assert service.get_user_profile('user-1')['fileLimit'] == 500
+            assert service.get_user_profile('user-1')['fileLimit'] == 500
+            assert user_doc.to_dict.call_count == 1
+            
+            user_doc.to_dict.return_value = {'email': 'u@example.com', 'fileLimit': 900}
+            assert service.update_user_file_limit('user-1', 900)
+            assert service.get_user_profile('user-1')['fileLimit'] == 900
+
+class TestSignedUrlCache:
+    """Test reuse of signed download URLs"""
+    
+    def test_signed_urls_reused_until_delete(self):
+        """Test that a path is signed once and re-signed after the file is deleted"""
+        from backend.app.services import storage as storage_module
+        service = storage_module.StorageService.__new__(storage_module.StorageService)
+        service.bucket = Mock()
+        blob = service.bucket.blob.return_value
+        blob.generate_signed_url.side_effect = ["https://signed/1", "https://signed/2"]
+        
+        with patch.object(storage_module, 'signed_url_cache', storage_module.TTLCache(max_size=10)):
+            assert service.generate_signed_url("user-1/a.pdf") == "https://signed/1"
+            assert service.generate_signed_url("user-1/a.pdf") == "https://signed/1"
+            assert blob.generate_signed_url.call_count == 1
+            
+            service.delete_file("user-1/a.pdf")
+            assert service.generate_signed_url("user-1/a.pdf") == "https://signed/2"
+
+class TestPagination:
+    """Test cursor pagination of file listings"""
+    
+    def test_cursor_round_trip(self):
+        """Test that a cursor decodes to the start_after values of the last file"""
+        from backend.app.services.firestore import encode_page_cursor, decode_page_cursor
+        uploaded_at = datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc)
+        
+        cursor = encode_page_cursor({'id': 'file-9', 'uploaded_at': uploaded_at})
+        
+        assert decode_page_cursor(cursor) == {'uploaded_at': uploaded_at, '__name__': 'file-9'}
+        with pytest.raises(ValueError):
+            decode_page_cursor("not-a-cursor")
+    
+    def test_files_page_returns_next_cursor_only_when_more(self):
+        """Test that one extra document is fetched to decide whether there is a next page"""
+        from backend.app.services import firestore as firestore_module
+        
+        def make_doc(i):
+            doc = Mock()
+            doc.id = f"file-{i}"
+            doc.to_dict.return_value = {'uploaded_at': datetime(2024, 5, 1, tzinfo=timezone.utc), 'user_id': 'u'}
+            return doc
+        
+        db = Mock()
+        query = db.collection.return_value.where.return_value.order_by.return_value.order_by.return_value
+        query.limit.return_value.stream.return_value = [make_doc(i) for i in range(3)]
+        
+        with patch.object(firestore_module, 'get_firestore_client', return_value=db):
+            files, next_cursor = firestore_module.FirestoreService.get_files_page('u', limit=2)
+            assert [f['id'] for f in files] == ['file-0', 'file-1']
+            assert firestore_module.decode_page_cursor(next_cursor)['__name__'] == 'file-1'
+            query.limit.assert_called_with(3)
+            
+            query.limit.return_value.stream.return_value = [make_doc(0)]
+            files, next_cursor = firestore_module.FirestoreService.get_files_page('u', limit=2)
+            assert len(files) == 1 and next_cursor is None
+
+class TestBatchedWrites:
+    """Test Firestore WriteBatch chunking"""
+    
+    def test_batch_writer_commits_in_chunks_of_500(self):
+        """Test that writes are split at Firestore's 500 operation limit"""
+        from backend.app.services.firestore import BatchWriter
+        db = Mock()
+        writer = BatchWriter(db)
+        
+        for i in range(1203):
+            writer.set(Mock(), {'n': i})
+        writer.commit()
+        
+        assert writer.commits == 3
+        assert db.batch.return_value.commit.call_count == 3
+    
+    def test_file_changes_aggregate_counts_per_user(self):
+        """Test that many records produce one count update per owner in one commit"""
+        from backend.app.services import firestore as firestore_module
+        db = Mock()
+        batch = db.batch.return_value
+        created = [{'user_id': 'u1', 'file_size': 10} for _ in range(3)]
+        deleted = [{'id': 'old', 'user_id': 'u2', 'file_size': 5}]
+        
+        with patch.object(firestore_module, 'get_firestore_client', return_value=db):
+            ids = firestore_module.FirestoreService.commit_file_changes(created=created, deleted=deleted)
+        
+        assert len(ids) == 3
+        assert batch.commit.call_count == 1
+        assert batch.set.call_count == 5  # three records, one tombstone and one stats shard
+        assert batch.update.call_count == 2  # one count update per user
+        assert batch.delete.call_count == 1
+
+class TestListingVersions:
+    """Test change versions and conditional listings"""
+    
+    def test_file_changes_bump_versions(self):
+        """Test that every owner with changed files and the stats shard get a new version"""
+        from backend.app.services import firestore as firestore_module
+        db = Mock()
+        batch = db.batch.return_value
+        created = [{'user_id': 'u1', 'file_size': 10}]
+        deleted = [{'id': 'old', 'user_id': 'u2', 'file_size': 10}]
+        
+        with patch.object(firestore_module, 'get_firestore_client', return_value=db):
+            firestore_module.FirestoreService.commit_file_changes(created=created, deleted=deleted)
+        
+        for call in batch.update.call_args_list:
+            assert 'changeVersion' in call[0][1]
+        shard_updates = batch.set.call_args_list[-1][0][1]
+        assert 'change_version' in shard_updates
+    
+    def test_unchanged_listing_is_not_modified(self):
+        """Test that a matching If-None-Match gets a 304 without reading the files collection"""
+        import asyncio
+        from starlette.requests import Request
+        from fastapi.responses import Response
+        from backend.app.routes import files as files_routes
+        from backend.app.middleware.auth import AuthUser
+        from backend.app.services.concurrency import AsyncService
+        
+        firestore_fake = Mock()
+        firestore_fake.get_change_version.return_value = 7
+        firestore_fake.get_files_page.return_value = ([], None)
+        storage_fake = Mock()
+        storage_fake.generate_signed_urls.return_value = {}
+        user = AuthUser(uid="user-1", email="u@example.com", user_type="user")
+        
+        def list_files(headers):
+            request = Request({'type': 'http', 'headers': [(k.encode(), v.encode()) for k, v in headers.items()]})
+            response = Response()
+            result = asyncio.run(files_routes.get_my_files(
+                request, response, limit=50, cursor=None, include_download_urls=True, current_user=user
+            ))
+            return result, response
+        
+        with patch.object(files_routes, 'firestore_service', AsyncService(firestore_fake)), \
+             patch.object(files_routes, 'storage_service', AsyncService(storage_fake)):
+            listing, response = list_files({})
+            etag = response.headers['etag']
+            assert etag.startswith('W/"')
+            assert firestore_fake.get_files_page.call_count == 1
+            
+            not_modified, _ = list_files({'if-none-match': etag})
+            assert not_modified.status_code == 304
+            assert firestore_fake.get_files_page.call_count == 1
+            
+            firestore_fake.get_change_version.return_value = 8
+            listing, response = list_files({'if-none-match': etag})
+            assert response.headers['etag'] != etag
+            assert firestore_fake.get_files_page.call_count == 2
+
+class TestDeltaSync:
+    """Test delta syncs of file lists"""
+    
+    def test_changes_report_creates_and_tombstones(self):
+        """Test that new records and tombstones since the token are returned, deletes winning"""
+        from backend.app.services import firestore as firestore_module
+        
+        def doc(doc_id, data=None):
+            return Mock(id=doc_id, to_dict=Mock(return_value=data or {}))
+        
+        files_query = Mock()
+        files_query.where.return_value = files_query
+        files_query.order_by.return_value = files_query
+        files_query.limit.return_value = files_query
+        files_query.stream.return_value = [doc('new', {'user_id': 'u1'}), doc('gone', {'user_id': 'u1'})]
+        tombstones_query = Mock()
+        tombstones_query.where.return_value = tombstones_query
+        tombstones_query.select.return_value = tombstones_query
+        tombstones_query.limit.return_value = tombstones_query
+        tombstones_query.stream.return_value = [doc('gone'), doc('old')]
+        db = Mock()
+        db.collection.side_effect = lambda name: files_query if name == 'files' else tombstones_query
+        
+        token = firestore_module.new_sync_token()
+        with patch.object(firestore_module, 'get_firestore_client', return_value=db):
+            changes = firestore_module.FirestoreService.get_changes('u1', token)
+            assert [f['id'] for f in changes['files']] == ['new']
+            assert changes['deleted'] == ['gone', 'old']
+            assert not changes['reset']
+            assert changes['sync_token']
+            
+            with patch.object(firestore_module, 'MAX_SYNC_CHANGES', 1):
+                assert firestore_module.FirestoreService.get_changes('u1', token)['reset']
+    
+    def test_expired_and_invalid_tokens_are_refused(self):
+        """Test that tokens past the tombstone retention or malformed ones are rejected"""
+        from backend.app.services import firestore as firestore_module
+        
+        with patch.object(firestore_module, 'TOMBSTONE_RETENTION_DAYS', 0):
+            token = firestore_module.new_sync_token()
+            with pytest.raises(firestore_module.SyncTokenExpiredError):
+                firestore_module.FirestoreService.get_changes('u1', token)
+        with pytest.raises(ValueError):
+            firestore_module.FirestoreService.get_changes('u1', 'not-a-token')
+    
+    def test_timezone_aware_tokens_are_normalized(self):
+        """Test that a crafted token with a UTC offset decodes to naive UTC instead of failing comparisons"""
+        import base64
+        import json
+        from backend.app.services import firestore as firestore_module
+        
+        def craft(since):
+            return base64.urlsafe_b64encode(json.dumps({'since': since}).encode('utf-8')).decode('ascii')
+        
+        assert firestore_module.decode_sync_token(craft('2024-01-01T12:00:00+02:00')) == datetime(2024, 1, 1, 10, 0)
+        with pytest.raises(firestore_module.SyncTokenExpiredError):
+            firestore_module.FirestoreService.get_changes('u1', craft('2000-01-01T00:00:00+00:00'))
+
+class TestEventBroker:
+    """Test the in-process event fan-out"""
+    
+    def test_snapshot_changes_reach_every_subscriber(self):
+        """Test that one listener feeds all subscribers and stops with the last one"""
+        import asyncio
+        import threading
+        from backend.app.services import events
+        
+        watch = Mock()
+        change = Mock(document=Mock(id='f1', to_dict=Mock(return_value={'file_name': 'a.txt', 'user_id': 'u1'})))
+        change.type.name = 'ADDED'
+        
+        async def scenario():
+            broker = events.EventBroker()
+            with patch.object(events.EventBroker, '_start_watches', return_value=[watch]) as start:
+                first = await broker.subscribe()
+                second = await broker.subscribe()
+                assert start.call_count == 1
+            
+            # Snapshot callbacks arrive on Firestore's own threads
+            listener = threading.Thread(target=broker._on_files, args=([], [change], None))
+            listener.start()
+            listener.join()
+            
+            received = [await asyncio.wait_for(queue.get(), timeout=1) for queue in (first, second)]
+            await broker.unsubscribe(first)
+            assert not watch.unsubscribe.called
+            await broker.unsubscribe(second)
+            assert watch.unsubscribe.called
+            return received
+        
+        received = asyncio.run(scenario())
+        assert all(event['type'] == 'file-created' and event['data']['id'] == 'f1' for event in received)
+    
+    def test_users_listener_is_scoped_to_recent_updates(self):
+        """Test that the users listener does not start by reading every user"""
+        from backend.app.services import events
+        
+        db = Mock()
+        with patch.object(events, 'get_firestore_client', return_value=db):
+            events.EventBroker()._start_watches()
+        
+        users = [c for c in db.collection.call_args_list if c[0][0] == 'users']
+        assert len(users) == 1
+        assert db.collection.return_value.where.call_args_list[-1][0][:2] == ('updatedAt', '>')
+    
+    def test_only_shown_user_fields_are_pushed(self):
+        """Test that reservation and counter bookkeeping on a user sends no event"""
+        from backend.app.services import events
+        
+        def snapshot_change(user_data, kind='MODIFIED'):
+            change = Mock(document=Mock(id='u1', to_dict=Mock(return_value=user_data)))
+            change.type.name = kind
+            return change
+        user = {'email': 'a@example.com', 'fileCount': 1, 'fileLimit': 500}
+        
+        broker = events.EventBroker()
+        published = []
+        broker._publish = lambda event_type, data: published.append((event_type, data))
+        # A user first seen by the listener was updated after it started
+        broker._on_users([], [snapshot_change(user, 'ADDED')], None)
+        assert [(t, d['file_count']) for t, d in published] == [('user-updated', 1)]
+        
+        broker._on_users([], [snapshot_change({**user, 'reservations': {'r1': {}}, 'changeVersion': 3})], None)
+        assert len(published) == 1
+        
+        broker._on_users([], [snapshot_change({**user, 'fileCount': 2, 'storageBytes': 10})], None)
+        assert [(t, d['file_count']) for t, d in published] == [('user-updated', 1), ('user-updated', 2)]
+        
+        broker._on_users([], [snapshot_change(user, 'REMOVED')], None)
+        assert published[-1] == ('user-deleted', {'uid': 'u1'})
+    
+    def test_stream_ticket_works_once(self):
+        """Test that a stream ticket is stored hashed and is used up by the first stream"""
+        import asyncio
+        from fastapi import HTTPException
+        from backend.app.middleware import auth
+        
+        tickets = {}
+        
+        def redeem(key):
+            ticket = tickets.pop(key, None)
+            return ticket and ticket[0]
+        profile = {'userType': 'admin', 'email': 'a@example.com'}
+        
+        with patch.object(auth.FirestoreService, 'create_stream_ticket', side_effect=lambda key, uid, expires_at: tickets.__setitem__(key, (uid, expires_at))), \
+             patch.object(auth.FirestoreService, 'redeem_stream_ticket', side_effect=redeem), \
+             patch.object(auth.FirestoreService, 'get_user_profile', return_value=profile):
+            ticket = asyncio.run(auth.create_stream_ticket(auth.AuthUser(uid="admin-1", email="a@example.com", user_type="admin")))
+            assert ticket not in tickets
+            
+            user = asyncio.run(auth.get_admin_user_from_ticket(ticket))
+            assert user.uid == "admin-1"
+            with pytest.raises(HTTPException) as error:
+                asyncio.run(auth.get_admin_user_from_ticket(ticket))
+            assert error.value.status_code == 401
+    
+    def test_slow_subscriber_gets_reset(self):
+        """Test that a full queue is replaced by a single reset event"""
+        import asyncio
+        from backend.app.services import events
+        
+        async def scenario():
+            broker = events.EventBroker()
+            with patch.object(events, 'EVENT_QUEUE_SIZE', 2), \
+                 patch.object(events.EventBroker, '_start_watches', return_value=[Mock()]):
+                queue = await broker.subscribe()
+            for n in range(3):
+                broker._deliver({'type': 'file-deleted', 'data': {'id': str(n)}})
+            return [queue.get_nowait() for _ in range(queue.qsize())]
+        
+        assert asyncio.run(scenario()) == [{'type': 'reset', 'data': {}}]
+
+class TestSystemStats:
+    """Test materialized system statistics"""
+    
+    def test_stats_shards_are_summed(self):
+        """Test that counters from every shard are added together"""
+        from backend.app.services import firestore as firestore_module
+        
+        shards = []
+        for values in [{'total_files': 3, 'total_storage_bytes': 300}, {'total_files': -1, 'admin_users': 2}]:
+            doc = Mock()
+            doc.to_dict.return_value = values
+            shards.append(doc)
+        db = Mock()
+        db.collection.return_value.document.return_value.collection.return_value.stream.return_value = shards
+        
+        with patch.object(firestore_module, 'get_firestore_client', return_value=db):
+            stats = firestore_module.FirestoreService.get_system_stats()
+        
+        assert stats == {'total_files': 2, 'total_storage_bytes': 300, 'admin_users': 2}
+    
+    def test_increment_writes_only_nonzero_counters(self):
+        """Test that increments go to a single shard and skip zero deltas"""
+        from backend.app.services import firestore as firestore_module
+        
+        db = Mock()
+        shard_ref = db.collection.return_value.document.return_value.collection.return_value.document.return_value
+        
+        with patch.object(firestore_module, 'get_firestore_client', return_value=db):
+            assert firestore_module.FirestoreService.increment_system_stats(total_files=1, admin_users=0)
+        
+        updates = shard_ref.set.call_args[0][0]
+        assert list(updates) == ['total_files']
+        assert shard_ref.set.call_args[1] == {'merge': True}
+
+    def test_role_change_and_admin_count_share_a_transaction(self):
+        """Test that the role update and the admin count change are written in one transaction"""
+        from backend.app.services import firestore as firestore_module
+        
+        user_doc = Mock(exists=True)
+        user_doc.to_dict.return_value = {'userType': 'user'}
+        db = Mock()
+        db.collection.return_value.document.return_value.get.return_value = user_doc
+        transaction = Mock()
+        db.transaction.return_value = transaction
+        
+        with patch.object(firestore_module, 'get_firestore_client', return_value=db), \
+             patch.object(firestore_module.firestore, 'transactional', lambda func: func):
+            assert firestore_module.FirestoreService.update_user_type("u1", "admin")
+            user_doc.to_dict.return_value = {'userType': 'admin'}
+            assert firestore_module.FirestoreService.update_user_type("u1", "admin")
+        
+        assert transaction.update.call_count == 2
+        assert transaction.update.call_args[0][1]['userType'] == 'admin'
+        # Only the first call changed the role
+        transaction.set.assert_called_once()
+        assert transaction.set.call_args[0][1]['admin_users'].value == 1
+        assert transaction.set.call_args[1] == {'merge': True}
+        db.collection.return_value.document.return_value.update.assert_not_called()
+
+class TestReconciliation:
+    """Test aggregation-based file count reconciliation"""
+    
+    def test_only_drifted_users_are_rewritten(self):
+        """Test that users are fixed from aggregation totals and drift is reported"""
+        from backend.app.services import firestore as firestore_module
+        
+        stored = {
+            'ok': {'fileCount': 2, 'storageBytes': 20},
+            'drifted': {'fileCount': 5, 'storageBytes': 20}
+        }
+        actual = {'ok': (2, 20), 'drifted': (3, 30)}
+        refs = {}
+        
+        def document(uid):
+            ref = refs.setdefault(uid, Mock(id=uid))
+            ref.get.return_value = Mock(exists=True, to_dict=Mock(return_value=stored[uid]))
+            return ref
+        
+        def aggregate(uid):
+            file_count, storage_bytes = actual[uid]
+            return {'file_count': file_count, 'storage_bytes': storage_bytes}
+        
+        db = Mock()
+        db.collection.return_value.document.side_effect = document
+        db.collection.return_value.list_documents.return_value = [Mock(id='ok'), Mock(id='drifted')]
+        
+        with patch.object(firestore_module, 'get_firestore_client', return_value=db), \
+             patch.object(firestore_module.FirestoreService, 'aggregate_user_files', side_effect=aggregate):
+            report = firestore_module.FirestoreService.reconcile_all_users(max_workers=2)
+        
+        assert report['users_checked'] == 2
+        assert report['counts_drifted'] == 1
+        assert report['drifted_users'] == [{'uid': 'drifted', 'previous_file_count': 5, 'file_count': 3}]
+        refs['drifted'].update.assert_called_once_with({
+            'fileCount': 3, 'storageBytes': 30, 'updatedAt': firestore_module.firestore.SERVER_TIMESTAMP
+        })
+        refs['ok'].update.assert_not_called()
 
 class TestCORSConfiguration:
     """Test CORS configuration"""
@@ -82,6 +1567,87 @@ class TestAuthentication:
         """Test that upload endpoint requires authentication"""
         response = client.post("/api/files/upload")
         assert response.status_code == 403
+    
+    def test_upload_session_endpoints_require_auth(self):
+        """Test that direct upload session endpoints require authentication"""
+        response = client.post("/api/files/upload-sessions", json={
+            "file_name": "a.pdf", "file_size": 10, "content_type": "application/pdf"
+        })
+        assert response.status_code == 403
+        
+        response = client.post("/api/files/upload-sessions/abc/finalize")
+        assert response.status_code == 403
+    
+    def test_download_urls_endpoints_require_auth(self):
+        """Test that batch signing endpoints require authentication"""
+        response = client.post("/api/files/download-urls", json={"file_ids": ["a"]})
+        assert response.status_code == 403
+        
+        response = client.post("/api/admin/files/download-urls", json={"file_ids": ["a"]})
+        assert response.status_code == 403
+    
+    def test_zip_download_endpoints_require_auth(self):
+        """Test that archive downloads require authentication"""
+        response = client.post("/api/files/download-zip", json={})
+        assert response.status_code == 403
+        
+        response = client.post("/api/admin/users/user-1/files/download-zip")
+        assert response.status_code == 403
+    
+    def test_bulk_delete_endpoints_require_auth(self):
+        """Test that bulk deletes require authentication"""
+        response = client.post("/api/files/bulk-delete", json={"file_ids": ["a"]})
+        assert response.status_code == 403
+        
+        response = client.post("/api/admin/files/bulk-delete", json={"file_ids": ["a"]})
+        assert response.status_code == 403
+    
+    def test_purge_endpoints_require_auth(self):
+        """Test that user purges require authentication"""
+        response = client.post("/api/admin/users/user-1/purge")
+        assert response.status_code == 403
+        
+        response = client.get("/api/admin/users/user-1/purge")
+        assert response.status_code == 403
+    
+    def test_changes_endpoints_require_auth(self):
+        """Test that delta syncs require authentication"""
+        response = client.get("/api/files/changes", params={"since": "abc"})
+        assert response.status_code == 403
+        
+        response = client.get("/api/admin/files/changes", params={"since": "abc"})
+        assert response.status_code == 403
+    
+    def test_event_stream_requires_admin_ticket(self):
+        """Test that the event stream needs a valid ticket, which itself needs authentication"""
+        response = client.get("/api/admin/events")
+        assert response.status_code == 403
+        
+        response = client.get("/api/admin/events", params={"ticket": "invalid"})
+        assert response.status_code == 401
+        
+        response = client.post("/api/admin/events/ticket")
+        assert response.status_code == 403
+    
+    def test_resumable_upload_endpoints_require_auth(self):
+        """Test that every resumable upload endpoint requires authentication"""
+        response = client.post("/api/files/resumable-uploads", json={
+            "file_name": "a.zip", "file_size": 10, "content_type": "application/zip"
+        })
+        assert response.status_code == 403
+        
+        assert client.head("/api/files/resumable-uploads/abc").status_code == 403
+        assert client.patch("/api/files/resumable-uploads/abc", content=b"x").status_code == 403
+        assert client.post("/api/files/resumable-uploads/abc/finalize").status_code == 403
+        assert client.delete("/api/files/resumable-uploads/abc").status_code == 403
+    
+    def test_content_download_endpoints_require_auth(self):
+        """Test that proxied downloads require authentication"""
+        response = client.get("/api/files/abc/content", headers={"Range": "bytes=0-9"})
+        assert response.status_code == 403
+        
+        response = client.head("/api/admin/files/abc/content")
+        assert response.status_code == 403
 
 if __name__ == "__main__":
     pytest.main([__file__])
@@ -45,6 +45,7 @@ def create_admin_user():
             'fileLimit': 1000,  # Higher limit for admin
             'fileCount': 0,
             'createdAt': datetime.now(),
+            'updatedAt': firestore.SERVER_TIMESTAMP,
             'isAdmin': True,
             'permissions': {
                 'canViewAllFiles': True,
@@ -80,6 +81,7 @@ def create_admin_user():
                 'fileLimit': 1000,
                 'fileCount': 0,
                 'createdAt': datetime.now(),
+                'updatedAt': firestore.SERVER_TIMESTAMP,
                 'isAdmin': True,
                 'permissions': {
                     'canViewAllFiles': True,
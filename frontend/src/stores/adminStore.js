@@ -5,6 +5,7 @@ import api from '@/services/api'
 export const useAdminStore = defineStore('admin', () => {
   const users = ref([])
   const allFiles = ref([])
+  const allFilesCursor = ref(null)
   const stats = ref({})
   const loading = ref(false)
   const error = ref(null)
@@ -16,10 +17,13 @@ export const useAdminStore = defineStore('admin', () => {
   const regularUsers = computed(() => 
     users.value.filter(user => user.user_type === 'user')
   )
+  const hasMoreFiles = computed(() => allFilesCursor.value !== null)
   const totalUsers = computed(() => users.value.length)
-  const totalFiles = computed(() => allFiles.value.length)
+  // allFiles only holds the pages loaded so far, so prefer the server-side totals
+  const totalFiles = computed(() => stats.value.total_files ?? allFiles.value.length)
   const totalStorage = computed(() => 
-    allFiles.value.reduce((total, file) => total + file.file_size, 0)
+    stats.value.total_storage_bytes ??
+      allFiles.value.reduce((total, file) => total + file.file_size, 0)
   )
 
   // Format file size
@@ -50,14 +54,18 @@ export const useAdminStore = defineStore('admin', () => {
     }
   }
 
-  // Get all files
+  // Get all files (first page)
   const fetchAllFiles = async () => {
     try {
       loading.value = true
       error.value = null
       
-      const response = await api.get('/api/admin/files')
-      allFiles.value = response.data
+      // Download URLs are signed on demand when a file is downloaded
+      const response = await api.get('/api/admin/files', {
+        params: { include_download_urls: false }
+      })
+      allFiles.value = response.data.files
+      allFilesCursor.value = response.data.next_cursor
       
       return response.data
     } catch (error) {
@@ -69,6 +77,29 @@ export const useAdminStore = defineStore('admin', () => {
     }
   }
 
+  // Append the next page of all files
+  const fetchMoreFiles = async () => {
+    if (!allFilesCursor.value) return
+    try {
+      loading.value = true
+      error.value = null
+      
+      const response = await api.get('/api/admin/files', {
+        params: { include_download_urls: false, cursor: allFilesCursor.value }
+      })
+      allFiles.value = [...allFiles.value, ...response.data.files]
+      allFilesCursor.value = response.data.next_cursor
+      
+      return response.data
+    } catch (error) {
+      console.error('Error fetching more files:', error)
+      error.value = error.response?.data?.detail || 'Failed to fetch files'
+      throw error
+    } finally {
+      loading.value = false
+    }
+  }
+
   // Get admin stats
   const fetchStats = async () => {
     try {
@@ -88,11 +119,19 @@ export const useAdminStore = defineStore('admin', () => {
     }
   }
 
-  // Get files for specific user
+  // Get every file of a specific user, following next_cursor to the last page
   const fetchUserFiles = async (userId) => {
     try {
-      const response = await api.get(`/api/admin/users/${userId}/files`)
-      return response.data
+      const files = []
+      let cursor = null
+      do {
+        const response = await api.get(`/api/admin/users/${userId}/files`, {
+          params: { include_download_urls: false, limit: 1000, cursor: cursor ?? undefined }
+        })
+        files.push(...response.data.files)
+        cursor = response.data.next_cursor
+      } while (cursor)
+      return files
     } catch (error) {
       console.error('Error fetching user files:', error)
       error.value = error.response?.data?.detail || 'Failed to fetch user files'
@@ -178,6 +217,34 @@ export const useAdminStore = defineStore('admin', () => {
     }
   }
 
+  // Start deleting a user and all of their files; returns the purge job
+  const purgeUser = async (userId) => {
+    try {
+      error.value = null
+      
+      const response = await api.post(`/api/admin/users/${userId}/purge`)
+      return response.data
+    } catch (error) {
+      console.error('Error starting user purge:', error)
+      error.value = error.response?.data?.detail || 'Failed to start user purge'
+      throw error
+    }
+  }
+
+  // Poll a user's purge job; the user leaves local state once it completes
+  const getPurgeStatus = async (userId) => {
+    try {
+      const response = await api.get(`/api/admin/users/${userId}/purge`)
+      if (response.data.status === 'completed') {
+        users.value = users.value.filter(u => u.uid !== userId)
+      }
+      return response.data
+    } catch (error) {
+      console.error('Error getting purge status:', error)
+      throw error
+    }
+  }
+
   // Delete any file
   const deleteAnyFile = async (fileId) => {
     try {
@@ -199,6 +266,28 @@ export const useAdminStore = defineStore('admin', () => {
     }
   }
 
+  // Delete many files of any users in one request
+  const deleteAnyFiles = async (fileIds) => {
+    try {
+      loading.value = true
+      error.value = null
+      
+      const response = await api.post('/api/admin/files/bulk-delete', { file_ids: fileIds })
+      const deleted = new Set(response.data.deleted)
+      
+      // Remove from local state
+      allFiles.value = allFiles.value.filter(file => !deleted.has(file.id))
+      
+      return response.data
+    } catch (error) {
+      console.error('Error deleting files:', error)
+      error.value = error.response?.data?.detail || 'Failed to delete files'
+      throw error
+    } finally {
+      loading.value = false
+    }
+  }
+
   // Get download URL for any file (admin endpoint)
   const getDownloadUrl = async (fileId) => {
     try {
@@ -227,6 +316,83 @@ export const useAdminStore = defineStore('admin', () => {
     }
   }
 
+  // Live updates: one server-sent event stream shared by every admin view
+  let eventSource = null
+  let eventSubscribers = 0
+  let reconnectTimer = null
+
+  const connectEvents = async () => {
+    reconnectTimer = null
+    if (eventSource || eventSubscribers === 0) return
+    // EventSource cannot send headers, so a single-use ticket goes in the
+    // query string instead of the ID token
+    let ticket
+    try {
+      const response = await api.post('/api/admin/events/ticket')
+      ticket = response.data.ticket
+    } catch (error) {
+      console.error('Error getting event stream ticket:', error)
+    }
+    if (eventSource || eventSubscribers === 0) return
+    if (!ticket) {
+      if (!reconnectTimer) reconnectTimer = setTimeout(connectEvents, 3000)
+      return
+    }
+    
+    eventSource = new EventSource(
+      `${api.defaults.baseURL}/api/admin/events?ticket=${encodeURIComponent(ticket)}`
+    )
+    eventSource.addEventListener('file-created', (event) => {
+      const file = JSON.parse(event.data)
+      if (!allFiles.value.some(known => known.id === file.id)) {
+        allFiles.value = [file, ...allFiles.value]
+      }
+    })
+    eventSource.addEventListener('file-deleted', (event) => {
+      const { id } = JSON.parse(event.data)
+      allFiles.value = allFiles.value.filter(file => file.id !== id)
+    })
+    eventSource.addEventListener('user-updated', (event) => {
+      const user = JSON.parse(event.data)
+      const index = users.value.findIndex(known => known.uid === user.uid)
+      if (index === -1) {
+        users.value = [...users.value, user]
+      } else {
+        users.value.splice(index, 1, user)
+      }
+    })
+    eventSource.addEventListener('user-deleted', (event) => {
+      const { uid } = JSON.parse(event.data)
+      users.value = users.value.filter(user => user.uid !== uid)
+    })
+    // Events were dropped for this client: reload the lists
+    eventSource.addEventListener('reset', () => {
+      fetchUsers().catch(() => {})
+      fetchAllFiles().catch(() => {})
+    })
+    // Tickets work once, so every reconnect gets a new one
+    eventSource.onerror = () => {
+      eventSource.close()
+      eventSource = null
+      if (eventSubscribers > 0 && !reconnectTimer) {
+        reconnectTimer = setTimeout(connectEvents, 3000)
+      }
+    }
+  }
+
+  const subscribeEvents = () => {
+    eventSubscribers += 1
+    connectEvents()
+  }
+
+  const unsubscribeEvents = () => {
+    eventSubscribers = Math.max(0, eventSubscribers - 1)
+    if (eventSubscribers === 0 && eventSource) {
+      eventSource.close()
+      eventSource = null
+    }
+  }
+
   // Clear error
   const clearError = () => {
     error.value = null
@@ -243,6 +409,7 @@ export const useAdminStore = defineStore('admin', () => {
     // Computed
     adminUsers,
     regularUsers,
+    hasMoreFiles,
     totalUsers,
     totalFiles,
     totalStorage,
@@ -250,15 +417,21 @@ export const useAdminStore = defineStore('admin', () => {
     // Actions
     fetchUsers,
     fetchAllFiles,
+    fetchMoreFiles,
     fetchStats,
     fetchUserFiles,
     updateUserFileLimit,
     updateUserFileSizeLimit,
     updateUserType,
+    purgeUser,
+    getPurgeStatus,
     deleteAnyFile,
+    deleteAnyFiles,
     getDownloadUrl,
     downloadFile,
     formatFileSize,
+    subscribeEvents,
+    unsubscribeEvents,
     clearError
   }
 })
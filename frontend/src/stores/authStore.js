@@ -6,7 +6,7 @@ import {
   signOut, 
   onAuthStateChanged
 } from 'firebase/auth'
-import { doc, getDoc, setDoc } from 'firebase/firestore'
+import { doc, getDoc, setDoc, serverTimestamp } from 'firebase/firestore'
 import { auth, db } from '@/firebase'
 
 export const useAuthStore = defineStore('auth', () => {
@@ -117,7 +117,9 @@ export const useAuthStore = defineStore('auth', () => {
         userType: 'user',
         fileLimit: 500,
         fileCount: 0,
-        createdAt: new Date()
+        createdAt: new Date(),
+        // Lets admin views that are open see the new user
+        updatedAt: serverTimestamp()
       })
       
       await fetchUserProfile(result.user.uid)
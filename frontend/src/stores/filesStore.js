@@ -2,6 +2,11 @@ import { defineStore } from 'pinia'
 import { ref, computed } from 'vue'
 import api from '@/services/api'
 
+// Files larger than this are uploaded in resumable chunks, so a dropped
+// connection only costs the chunk in flight
+const RESUMABLE_THRESHOLD = 32 * 1024 * 1024
+const RESUMABLE_MAX_RETRIES = 5
+
 export const useFilesStore = defineStore('files', () => {
   const files = ref([])
   const loading = ref(false)
@@ -9,6 +14,8 @@ export const useFilesStore = defineStore('files', () => {
   const uploadProgress = ref({})
   const userFileLimit = ref(500)
   const userFileCount = ref(0)
+  const nextCursor = ref(null)
+  const syncToken = ref(null)
 
   // Computed properties
   const filesCount = computed(() => files.value.length)
@@ -21,6 +28,7 @@ export const useFilesStore = defineStore('files', () => {
   const remainingSlots = computed(() => 
     userFileLimit.value - userFileCount.value
   )
+  const hasMoreFiles = computed(() => nextCursor.value !== null)
 
   // Format file size
   const formatFileSize = (bytes) => {
@@ -31,16 +39,21 @@ export const useFilesStore = defineStore('files', () => {
     return parseFloat((bytes / Math.pow(k, i)).toFixed(2)) + ' ' + sizes[i]
   }
 
-  // Get user's files
+  // Get user's files (first page)
   const fetchFiles = async () => {
     try {
       loading.value = true
       error.value = null
       
-      const response = await api.get('/api/files/my-files')
+      // Download URLs are signed on demand when a file is downloaded
+      const response = await api.get('/api/files/my-files', {
+        params: { include_download_urls: false }
+      })
       files.value = response.data.files
+      nextCursor.value = response.data.next_cursor
       userFileLimit.value = response.data.user_file_limit
       userFileCount.value = response.data.user_file_count
+      syncToken.value = response.data.sync_token
       
       return response.data
     } catch (error) {
@@ -52,9 +65,105 @@ export const useFilesStore = defineStore('files', () => {
     }
   }
 
+  // Append the next page of user's files
+  const fetchMoreFiles = async () => {
+    if (!nextCursor.value) return
+    try {
+      loading.value = true
+      error.value = null
+      
+      const response = await api.get('/api/files/my-files', {
+        params: { include_download_urls: false, cursor: nextCursor.value }
+      })
+      files.value = [...files.value, ...response.data.files]
+      nextCursor.value = response.data.next_cursor
+      
+      return response.data
+    } catch (error) {
+      console.error('Error fetching more files:', error)
+      error.value = error.response?.data?.detail || 'Failed to fetch files'
+      throw error
+    } finally {
+      loading.value = false
+    }
+  }
+
+  // Apply only what changed since the last listing, falling back to a full reload
+  const syncFiles = async () => {
+    if (!syncToken.value) return fetchFiles()
+    try {
+      const response = await api.get('/api/files/changes', {
+        params: { since: syncToken.value, include_download_urls: false }
+      })
+      if (response.data.reset) return fetchFiles()
+      
+      // Changes can repeat, so known files are replaced rather than added again
+      const deleted = new Set(response.data.deleted)
+      const changed = new Map(response.data.files.map(file => [file.id, file]))
+      const kept = files.value.filter(file => !deleted.has(file.id))
+      const known = new Set(files.value.map(file => file.id))
+      const added = response.data.files.filter(file => !known.has(file.id))
+      userFileCount.value += added.length - (files.value.length - kept.length)
+      files.value = [...added, ...kept.map(file => changed.get(file.id) || file)]
+      syncToken.value = response.data.sync_token
+      
+      return response.data
+    } catch (error) {
+      // An expired sync token (410) or anything else: reload the list
+      console.error('Error syncing files:', error)
+      return fetchFiles()
+    }
+  }
+
+  // Upload a large file in chunks with the resumable protocol, continuing
+  // from the last stored offset after a failed chunk
+  const uploadResumable = async (file) => {
+    const { data: upload } = await api.post('/api/files/resumable-uploads', {
+      file_name: file.name,
+      file_size: file.size,
+      content_type: file.type || 'application/octet-stream'
+    })
+    
+    let offset = upload.upload_offset
+    let failures = 0
+    while (offset < file.size) {
+      try {
+        const response = await api.patch(upload.upload_url, file.slice(offset, offset + upload.chunk_size), {
+          headers: {
+            'Content-Type': 'application/offset+octet-stream',
+            'Upload-Offset': String(offset)
+          },
+          timeout: 5 * 60 * 1000
+        })
+        offset = Number(response.headers['upload-offset'])
+        failures = 0
+        uploadProgress.value[file.name] = Math.round((offset * 100) / file.size)
+      } catch (error) {
+        if (++failures > RESUMABLE_MAX_RETRIES) throw error
+        await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** failures))
+        try {
+          const status = await api.head(upload.upload_url)
+          offset = Number(status.headers['upload-offset'])
+        } catch (statusError) {
+          // Retry the same chunk
+        }
+      }
+    }
+    
+    const response = await api.post(`${upload.upload_url}/finalize`)
+    return response.data
+  }
+
   // Upload single file
   const uploadFile = async (file) => {
     try {
+      if (file.size > RESUMABLE_THRESHOLD) {
+        const result = await uploadResumable(file)
+        delete uploadProgress.value[file.name]
+        await syncFiles()
+        return result
+      }
+      
       const formData = new FormData()
       formData.append('file', file)
       
@@ -82,7 +191,7 @@ export const useFilesStore = defineStore('files', () => {
       delete uploadProgress.value[file.name]
       
       // Refresh files list
-      await fetchFiles()
+      await syncFiles()
       
       return response.data
     } catch (error) {
@@ -129,7 +238,7 @@ export const useFilesStore = defineStore('files', () => {
       })
       
       // Refresh files list
-      await fetchFiles()
+      await syncFiles()
       
       return response.data
     } catch (error) {
@@ -164,6 +273,29 @@ export const useFilesStore = defineStore('files', () => {
     }
   }
 
+  // Delete many files in one request
+  const deleteFiles = async (fileIds) => {
+    try {
+      loading.value = true
+      error.value = null
+      
+      const response = await api.post('/api/files/bulk-delete', { file_ids: fileIds })
+      const deleted = new Set(response.data.deleted)
+      
+      // Remove from local state
+      files.value = files.value.filter(file => !deleted.has(file.id))
+      userFileCount.value -= deleted.size
+      
+      return response.data
+    } catch (error) {
+      console.error('Error deleting files:', error)
+      error.value = error.response?.data?.detail || 'Failed to delete files'
+      throw error
+    } finally {
+      loading.value = false
+    }
+  }
+
   // Get download URL
   const getDownloadUrl = async (fileId) => {
     try {
@@ -216,12 +348,16 @@ export const useFilesStore = defineStore('files', () => {
     totalSize,
     canUploadMore,
     remainingSlots,
+    hasMoreFiles,
     
     // Actions
     fetchFiles,
+    fetchMoreFiles,
+    syncFiles,
     uploadFile,
     uploadBatchFiles,
     deleteFile,
+    deleteFiles,
     getDownloadUrl,
     downloadFile,
     formatFileSize,
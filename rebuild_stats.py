@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Script to rebuild the materialized system statistics in Firestore
+"""
+import os
+import sys
+import firebase_admin
+from firebase_admin import credentials
+
+# Add the backend directory to Python path to import our modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+
+from app.services.firestore import FirestoreService
+
+def rebuild_stats():
+    # Initialize Firebase Admin SDK
+    cred_path = os.path.join(os.path.dirname(__file__), 'globaldashboard-4598e-firebase-adminsdk-fbsvc-8820178d65.json')
+    cred = credentials.Certificate(cred_path)
+    
+    # Initialize Firebase Admin (only if not already initialized)
+    try:
+        firebase_admin.initialize_app(cred)
+    except ValueError:
+        # App already initialized
+        pass
+    
+    try:
+        stats = FirestoreService.rebuild_system_stats()
+        
+        print(f"✅ Rebuilt system statistics")
+        print(f"📁 Files: {stats['total_files']}")
+        print(f"💾 Storage: {round(stats['total_storage_bytes'] / (1024 * 1024), 2)} MB")
+        print(f"👑 Admins: {stats['admin_users']}")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Error rebuilding statistics: {e}")
+        return False
+
+if __name__ == "__main__":
+    print("🚀 Rebuilding system statistics")
+    print("=" * 50)
+    
+    success = rebuild_stats()
+    
+    print("=" * 50)
+    if not success:
+        print("❌ Failed to rebuild statistics")
+        sys.exit(1)
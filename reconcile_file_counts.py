@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Script to reconcile every user's file count and storage total in Firestore
+"""
+import os
+import sys
+import firebase_admin
+from firebase_admin import credentials
+
+# Add the backend directory to Python path to import our modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+
+from app.services.firestore import FirestoreService, RECONCILE_CONCURRENCY
+
+def reconcile_file_counts(max_workers):
+    # Initialize Firebase Admin SDK
+    cred_path = os.path.join(os.path.dirname(__file__), 'globaldashboard-4598e-firebase-adminsdk-fbsvc-8820178d65.json')
+    cred = credentials.Certificate(cred_path)
+    
+    # Initialize Firebase Admin (only if not already initialized)
+    try:
+        firebase_admin.initialize_app(cred)
+    except ValueError:
+        # App already initialized
+        pass
+    
+    try:
+        report = FirestoreService.reconcile_all_users(max_workers=max_workers)
+        
+        print(f"✅ Checked {report['users_checked']} users")
+        print(f"📁 File counts corrected: {report['counts_drifted']}")
+        print(f"💾 Storage totals corrected: {report['bytes_drifted']}")
+        for user in report['drifted_users']:
+            print(f"   {user['uid']}: {user['previous_file_count']} -> {user['file_count']}")
+        if report['failed_users']:
+            print(f"⚠️  Failed users: {', '.join(report['failed_users'])}")
+        
+        return not report['failed_users']
+        
+    except Exception as e:
+        print(f"❌ Error reconciling file counts: {e}")
+        return False
+
+if __name__ == "__main__":
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else RECONCILE_CONCURRENCY
+    
+    print(f"🚀 Reconciling file counts ({max_workers} users at a time)")
+    print("=" * 50)
+    
+    success = reconcile_file_counts(max_workers)
+    
+    print("=" * 50)
+    if not success:
+        print("❌ Reconciliation finished with errors")
+        sys.exit(1)